@@ -15,6 +15,7 @@ from __future__ import annotations
 # ---------------------------
 # БАЗОВЫЕ ИМПОРТЫ
 # ---------------------------
+import abc
 import sys
 import tempfile
 import asyncio
@@ -26,11 +27,17 @@ import csv
 import io
 import zipfile
 import functools
+import heapq
+import string
+import hashlib
+import threading
+import sqlite3
 import aiohttp
 import random
+import time
 from datetime import datetime, timezone
-from aiogram.exceptions import TelegramBadRequest
-from typing import Optional, Tuple, Dict, Any, List
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from typing import Optional, Tuple, Dict, Any, List, Iterable
 from asyncio import get_running_loop
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
@@ -41,7 +48,8 @@ if sys.platform == "win32":
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
 import requests
-from aiogram import Bot, Dispatcher, types, F
+from aiogram import Bot, Dispatcher, types, F, BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
 from aiogram.types import FSInputFile  # добавь импорт
 from aiogram.filters import Command, StateFilter
 from aiogram.filters import Command, CommandStart
@@ -49,9 +57,12 @@ from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
 from aiogram.utils.chat_action import ChatActionSender
-from collections import deque
-from contextlib import suppress
+from collections import deque, OrderedDict
+from contextlib import suppress, contextmanager, asynccontextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace as dataclass_replace
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
 # (если где-то используешь еще ChatJoinRequest, ShippingQuery и т.п. — тоже добавь)
 # === ENV LOADING (Render-friendly) ===
@@ -152,6 +163,18 @@ LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 logging.basicConfig(level=LOG_LEVEL, format="%(asctime)s | %(levelname)s | %(message)s")
 
 
+# === ПУЛ ФОНОВОГО I/O ===
+# Диск и тяжёлый CPU (zip, csv, json) уходят в ограниченный пул потоков,
+# чтобы один админский бэкап не останавливал event loop для всех остальных.
+IO_MAX_WORKERS = int(os.getenv("IO_MAX_WORKERS") or 4)
+_IO_POOL = ThreadPoolExecutor(max_workers=max(1, IO_MAX_WORKERS), thread_name_prefix="kit-io")
+
+async def run_io(fn, *args, **kwargs):
+    """Выполнить синхронную функцию в пуле I/O и вернуть её результат."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_IO_POOL, functools.partial(fn, *args, **kwargs))
+
+
 # === JSON HELPERS ===
 def _parse_ts_hhmmss(s: str):
     # ожидаем "YYYY-mm-dd HH:MM:SS"
@@ -164,7 +187,7 @@ def summarize_recent_changes(max_items: int = 5) -> tuple[str, dict]:
     """
     Возвращает (текст для подписи, meta-словарь) по последним изменениям:
     - kit_assets.json: последние обновлённые ключи (по updated_at)
-    - paid_users.json: общее количество и последние n покупателей (если есть paid_at/created_at/updated_at)
+    - пользователи: общее количество и последние n покупателей (по дате покупки)
     """
     now = datetime.now(timezone.utc)
     lines = []
@@ -174,6 +197,8 @@ def summarize_recent_changes(max_items: int = 5) -> tuple[str, dict]:
     assets = _read_json_safe(ASSETS_FILE) or {}
     items = []
     for k, v in (assets.items() if isinstance(assets, dict) else []):
+        if k == FILE_CACHE_ASSET_KEY:
+            continue  # служебный кэш file_id, не материал
         if isinstance(v, dict):
             upd = v.get("updated_at")
             ts = _parse_ts_hhmmss(upd) if isinstance(upd, str) else None
@@ -190,31 +215,100 @@ def summarize_recent_changes(max_items: int = 5) -> tuple[str, dict]:
         meta["assets"].append({"key": k, "updated_at": upd})
 
     # --- users ---
-    users = _read_json_safe(DATA_FILE)
-    if isinstance(users, dict):
-        meta["users"]["total"] = len(users)
-        recs = []
-        for uid, rec in users.items():
-            paid_at = None
-            if isinstance(rec, dict):
-                paid_at = rec.get("paid_at") or rec.get("created_at") or rec.get("updated_at")
-            ts = _parse_ts_hhmmss(paid_at) if isinstance(paid_at, str) else None
-            recs.append((uid, rec.get("username") or "unknown", ts, paid_at))
-        recs.sort(key=lambda t: (t[2] is None, t[2] or datetime.min.replace(tzinfo=timezone.utc)), reverse=True)
-        recent = recs[:max_items]
-        meta["users"]["recent"] = [{"id": uid, "username": uname, "paid_at": paid_at} for uid, uname, _, paid_at in recent]
+    records = USERS.records()
+    if records:
+        meta["users"]["total"] = len(records)
+        paid = sorted((r for r in records if r.purchased_at), key=lambda r: r.purchased_at, reverse=True)
+        recent = paid[:max_items]
+        meta["users"]["recent"] = [{"id": r.id, "username": r.username, "paid_at": r.purchase_date} for r in recent]
         if meta["users"]["total"] > 0:
-            last_str = ", ".join([f"@{r['username']}" if r["username"] != "unknown" else str(r["id"]) for r in meta["users"]["recent"]])
+            last_str = ", ".join([f"@{r['username']}" if r["username"] != "unknown" else str(r["id"]) for r in meta["users"]["recent"]]) or "—"
             lines.append(f"• покупателей: <b>{meta['users']['total']}</b> (последние: {last_str})")
 
     text = "Последние изменения:\n" + ("\n".join(lines) if lines else "• нет данных об изменениях")
     return text, meta
     
+# === МЕЖПРОЦЕССНЫЕ БЛОКИРОВКИ ФАЙЛОВ ===
+# Несколько uvicorn-воркеров делят один DATA_DIR: запись в общий файл идёт под
+# fcntl.flock на <file>.lock. На платформах без fcntl (Windows) — no-op.
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+_FILE_LOCKS_HELD = threading.local()
+
+@contextmanager
+def _file_lock(path: str):
+    """Эксклюзивная advisory-блокировка файла; повторный вход из того же потока не блокирует."""
+    if fcntl is None:
+        yield
+        return
+    held = getattr(_FILE_LOCKS_HELD, "paths", None)
+    if held is None:
+        held = _FILE_LOCKS_HELD.paths = {}
+    key = os.path.abspath(path)
+    if key in held:
+        held[key] += 1
+        try:
+            yield
+        finally:
+            held[key] -= 1
+        return
+    fd = os.open(key + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        held[key] = 1
+        try:
+            yield
+        finally:
+            del held[key]
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+# === КЭШ ЧТЕНИЯ JSON ===
+# Разобранный объект отдаётся повторно, пока у файла не изменились
+# (st_mtime_ns, st_size, st_ino). Свои записи кэш сбрасывают явно, чужие
+# (restore, ручная замена файла) ловятся по изменившемуся stat.
+# Возвращаемый объект общий — менять его можно только перед сохранением в тот же файл.
+_JSON_CACHE: Dict[str, Tuple[Tuple[int, int, int], Any]] = {}
+_JSON_CACHE_LOCK = threading.Lock()
+_JSON_CACHE_STATS = {"hits": 0, "misses": 0}
+
+def _file_stamp(path: str) -> Optional[Tuple[int, int, int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def _invalidate_json_cache(path: str):
+    with _JSON_CACHE_LOCK:
+        _JSON_CACHE.pop(os.path.abspath(path), None)
+
+def _load_json_cached(path: str):
+    """json.load с кэшем по stat. Ошибки (в т.ч. FileNotFoundError) пробрасываются и не кэшируются."""
+    key = os.path.abspath(path)
+    stamp = _file_stamp(path)
+    if stamp is not None:
+        with _JSON_CACHE_LOCK:
+            hit = _JSON_CACHE.get(key)
+            if hit is not None and hit[0] == stamp:
+                _JSON_CACHE_STATS["hits"] += 1
+                return hit[1]
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    with _JSON_CACHE_LOCK:
+        _JSON_CACHE_STATS["misses"] += 1
+        if stamp is not None and stamp == _file_stamp(path):
+            _JSON_CACHE[key] = (stamp, data)
+    return data
+
 def _read_json_safe(path: str):
     """Безопасное чтение JSON (возвращает dict или None при ошибке)."""
     try:
-        with open(path, "r", encoding="utf-8") as f:
-            return json.load(f)
+        return _load_json_cached(path)
     except FileNotFoundError:
         return {}
     except Exception as e:
@@ -224,56 +318,287 @@ def _read_json_safe(path: str):
 
 def _write_json_atomic(path: str, data):
     """Атомарная запись JSON с резервной копией."""
-    tmp = f"{path}.tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-    # резервная копия предыдущего
-    if os.path.exists(path):
-        shutil.copy2(path, f"{path}.bak")
-    os.replace(tmp, path)
-
-def make_backup_zip_file() -> tuple[str, str, str]:
+    with _file_lock(path):
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        # резервная копия предыдущего
+        if os.path.exists(path):
+            shutil.copy2(path, f"{path}.bak")
+        os.replace(tmp, path)
+    _invalidate_json_cache(path)
+
+# === ЦЕПОЧКА БЭКАПОВ (полный + дельты) ===
+# Полный архив — вся база; дельта — только записи, изменившиеся с прошлого бэкапа
+# (по хэшу содержимого записи). Каждый архив несёт в _meta.json свой hash и hash
+# родителя — при восстановлении дельты применяются строго по цепочке.
+# Дельты делает только плановый бэкап (архивы лежат в BACKUP_DIR рядом со своим полным);
+# ручной /backup уходит админу и поэтому всегда полный.
+# chain.json — только заголовок звена; хэши записей: chain_hashes.json — снимок на момент
+# полного архива, chain_hashes.log — по строке изменённых хэшей на каждую дельту,
+# так что дельта пишет O(изменений), а не O(всех пользователей).
+BACKUP_DIR = os.path.join(DATA_DIR, "backups")
+BACKUP_CHAIN_FILE = os.path.join(BACKUP_DIR, "chain.json")
+BACKUP_CHAIN_HASHES_FILE = os.path.join(BACKUP_DIR, "chain_hashes.json")
+BACKUP_CHAIN_LOG_FILE = os.path.join(BACKUP_DIR, "chain_hashes.log")
+BACKUP_FULL_EVERY = int(os.getenv("BACKUP_FULL_EVERY") or 7)              # дельт между полными
+BACKUP_DELTA_MAX_RATIO = float(os.getenv("BACKUP_DELTA_MAX_RATIO") or 0.5)  # больше — делаем полный
+BACKUP_COMPRESSLEVEL = int(os.getenv("BACKUP_COMPRESSLEVEL") or 6)
+# хранение: последние N архивов + последний за каждый из D дней + последний за каждую из W недель
+BACKUP_KEEP_LAST = int(os.getenv("BACKUP_KEEP_LAST") or 10)
+BACKUP_KEEP_DAILY = int(os.getenv("BACKUP_KEEP_DAILY") or 7)
+BACKUP_KEEP_WEEKLY = int(os.getenv("BACKUP_KEEP_WEEKLY") or 4)
+BACKUP_PREFIX = "ai_business_kit_backup_"
+
+def _sha1_json(obj) -> str:
+    return hashlib.sha1(json.dumps(obj, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+def _load_backup_chain() -> Dict[str, Any]:
+    """Заголовок звена + "hashes" на его момент (снимок полного архива и изменения из дельт)."""
+    chain = _read_json_safe(BACKUP_CHAIN_FILE)
+    if not isinstance(chain, dict) or not chain.get("chain_id"):
+        return {}
+    chain = dict(chain)
+    if "hashes" in chain:
+        return chain  # chain.json старого формата: все хэши внутри, перепишется при следующем бэкапе
+    base = _read_json_safe(BACKUP_CHAIN_HASHES_FILE)
+    if not isinstance(base, dict) or base.get("chain_id") != chain["chain_id"]:
+        chain["hashes"] = {}  # снимка нет — ближайший бэкап выйдет полным
+        return chain
+    hashes = dict(base.get("hashes") or {})
+    with suppress(FileNotFoundError), open(BACKUP_CHAIN_LOG_FILE, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                ev = json.loads(line)
+            except ValueError:
+                continue  # хвост, недописанный при падении
+            if ev.get("chain_id") != chain["chain_id"]:
+                continue
+            hashes.update(ev.get("put") or {})
+            for uid in ev.get("del") or []:
+                hashes.pop(uid, None)
+    chain["hashes"] = hashes
+    chain["_snapshot"] = True
+    return chain
+
+def _save_backup_chain(chain: Dict[str, Any], meta: Dict[str, Any], assets_hash: str,
+                       hashes: Dict[str, str], put: Dict[str, Any], dropped: List[str]):
+    """
+    Полный архив (или нет снимка для звена) — новый chain_hashes.json и пустой журнал;
+    дельта — одна строка в журнал. Заголовок пишется до журнала: если упадём между
+    ними, следующая дельта просто повторит часть изменений.
+    """
+    snapshot = meta["kind"] == "full" or not chain.get("_snapshot")
+    if snapshot:
+        _atomic_write(BACKUP_CHAIN_HASHES_FILE, {"chain_id": meta["chain_id"], "hashes": hashes})
+    _atomic_write(BACKUP_CHAIN_FILE, {
+        "chain_id": meta["chain_id"],
+        "seq": meta["seq"],
+        "hash": meta["hash"],
+        "deltas": 0 if meta["kind"] == "full" else int(chain.get("deltas", 0)) + 1,
+        "assets_hash": assets_hash,
+    })
+    mode = "w" if snapshot else "a"
+    line = "" if snapshot else json.dumps({
+        "chain_id": meta["chain_id"], "seq": meta["seq"],
+        "put": {uid: hashes[uid] for uid in put}, "del": dropped,
+    }, ensure_ascii=False) + "\n"
+    with open(BACKUP_CHAIN_LOG_FILE, mode, encoding="utf-8") as f:
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+
+def list_backup_archives() -> List[str]:
+    """Архивы в BACKUP_DIR по возрастанию времени (имя начинается с даты)."""
+    try:
+        names = os.listdir(BACKUP_DIR)
+    except FileNotFoundError:
+        return []
+    return [os.path.join(BACKUP_DIR, n) for n in sorted(names)
+            if n.startswith(BACKUP_PREFIX) and n.endswith(".zip")]
+
+def prune_backups() -> List[str]:
+    """
+    Прореживание архивов по политике хранения. Дельта без своего полного архива
+    и предыдущих дельт бесполезна, поэтому оставленная дельта тянет за собой всю цепочку до полного.
+    Возвращает список удалённых файлов.
+    """
+    paths = list_backup_archives()
+    keep = set(paths[-BACKUP_KEEP_LAST:]) if BACKUP_KEEP_LAST > 0 else set()
+    days: Dict[str, str] = {}
+    weeks: Dict[Tuple[int, int], str] = {}
+    for path in paths:  # по возрастанию — в словаре остаётся последний за период
+        stamp = os.path.basename(path)[len(BACKUP_PREFIX):len(BACKUP_PREFIX) + 10]
+        try:
+            day = datetime.strptime(stamp, "%Y-%m-%d")
+        except ValueError:
+            keep.add(path)  # чужое имя — не трогаем
+            continue
+        days[stamp] = path
+        weeks[tuple(day.isocalendar()[:2])] = path
+    keep.update(list(days.values())[-BACKUP_KEEP_DAILY:] if BACKUP_KEEP_DAILY > 0 else [])
+    keep.update(list(weeks.values())[-BACKUP_KEEP_WEEKLY:] if BACKUP_KEEP_WEEKLY > 0 else [])
+
+    # дотягиваем цепочки: от каждой оставленной дельты назад до полного архива
+    needed = False
+    for path in reversed(paths):
+        if path in keep:
+            needed = True
+        elif needed:
+            keep.add(path)
+        if not path.endswith("_delta.zip"):
+            needed = False
+
+    removed = []
+    for path in paths:
+        if path not in keep:
+            with suppress(FileNotFoundError):
+                os.remove(path)
+                removed.append(path)
+    if removed:
+        logging.info("[BACKUP] pruned %d archive(s), kept %d", len(removed), len(paths) - len(removed))
+    return removed
+
+def make_backup_zip_file(force_full: bool = False) -> tuple[str, str, str]:
     """
     Создать ZIP-бэкап и вернуть (zip_path, human_datetime, changes_text).
-    Имя файла красивое: ai_business_kit_backup_YYYY-MM-DD_HH-MM.zip
-    Внутрь кладём _meta.json с версией и сводкой изменений.
+    Бэкапы (ручные, по расписанию, из других воркеров) идут строго по одному —
+    под блокировкой манифеста цепочки; после записи старые архивы прореживаются.
+    """
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    with _file_lock(BACKUP_CHAIN_FILE):
+        taken = USERS.backup_changes()
+        try:
+            result = _write_backup_archive(force_full, taken)
+        except BaseException:
+            if taken is None:
+                USERS.backup_reset()  # отслеживание началось с этого бэкапа, а он не записан
+            raise
+        USERS.backup_done(taken)
+        with suppress(Exception):
+            prune_backups()
+    return result
+
+def _scan_users() -> Tuple[Dict[str, Any], Dict[str, str]]:
+    """Полный обход: все записи и их хэши."""
+    users = {str(r.id): r.to_dict() for r in USERS.records()}
+    return users, {uid: _sha1_json(rec)[:16] for uid, rec in users.items()}
+
+def _delta_from_changes(prev: Dict[str, str], taken: Dict[int, int]):
+    """Хэшируем только изменённые с прошлого бэкапа: (put, dropped, hashes для put)."""
+    put: Dict[str, Any] = {}
+    dropped: List[str] = []
+    hashes: Dict[str, str] = {}
+    for uid in taken:
+        key = str(uid)
+        rec = USERS.record(uid)
+        if rec is None:
+            if key in prev:
+                dropped.append(key)
+            continue
+        d = rec.to_dict()
+        h = _sha1_json(d)[:16]
+        if prev.get(key) != h:
+            put[key], hashes[key] = d, h
+    return put, sorted(dropped), hashes
+
+def _write_backup_archive(force_full: bool, taken: Optional[Dict[int, int]] = None) -> tuple[str, str, str]:
+    """
+    Имя файла красивое: ai_business_kit_backup_YYYY-MM-DD_HH-MM-SS[_delta].zip
+    Полный архив — раз в BACKUP_FULL_EVERY бэкапов (или если изменилась большая часть базы),
+    между ними — дельты. Внутрь кладём _meta.json с версией, звеном цепочки и сводкой изменений.
+    taken — изменённые с прошлого бэкапа (USERS.backup_changes()): дельта хэширует только их;
+    None — набор неизвестен (первый бэкап после старта), записи обходятся все.
     """
     now = datetime.now()
-    ts_file = now.strftime("%Y-%m-%d_%H-%M")
+    ts_file = now.strftime("%Y-%m-%d_%H-%M-%S")
     human = now.strftime("%d.%m.%Y %H:%M")
-    zip_name = f"ai_business_kit_backup_{ts_file}.zip"
-
-    tmp_dir = os.path.join(DATA_DIR, "backups")
-    os.makedirs(tmp_dir, exist_ok=True)
-    zip_path = os.path.join(tmp_dir, zip_name)
+    os.makedirs(BACKUP_DIR, exist_ok=True)
 
     changes_text, changes_meta = summarize_recent_changes()
 
-    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
-        meta = {
-            "created_at": human,
-            "files": [],
-            "app": "AI Business Kit",
-            "version": "2.1",
-            "recent_changes": changes_meta,
-        }
-        mapping = {
-            "paid_users.json": DATA_FILE,
-            "kit_assets.json": ASSETS_FILE,
-        }
-        for arcname, realpath in mapping.items():
+    assets_raw = _read_json_safe(ASSETS_FILE)
+    assets_hash = _sha1_json(assets_raw)[:16] if assets_raw is not None else ""
+
+    chain = _load_backup_chain()
+    prev = chain.get("hashes", {})
+    full = force_full or not chain or int(chain.get("deltas", 0)) >= BACKUP_FULL_EVERY
+    users: Optional[Dict[str, Any]] = None
+    if not full and taken is not None and chain.get("_snapshot"):
+        # O(изменений): хэши остальных записей не менялись с прошлого бэкапа
+        put, dropped, hashes = _delta_from_changes(prev, taken)
+        total = USERS.count()
+    else:
+        users, hashes = _scan_users()
+        put = {uid: users[uid] for uid, h in hashes.items() if prev.get(uid) != h}
+        dropped = sorted(set(prev) - set(hashes))
+        total = len(users)
+    full = full or len(put) + len(dropped) > BACKUP_DELTA_MAX_RATIO * max(1, total)
+    if full and users is None:
+        users, hashes = _scan_users()
+
+    zip_name = f"{BACKUP_PREFIX}{ts_file}{'' if full else '_delta'}.zip"
+    zip_path = os.path.join(BACKUP_DIR, zip_name)
+    meta = {
+        "created_at": human,
+        "files": [],
+        "app": "AI Business Kit",
+        "version": "2.2",
+        "kind": "full" if full else "delta",
+        "chain_id": (now.strftime("%Y%m%d%H%M%S") if full else chain["chain_id"]),
+        "seq": 0 if full else int(chain.get("seq", 0)) + 1,
+        "parent": None if full else chain.get("hash"),
+        "recent_changes": changes_meta,
+    }
+
+    with zipfile.ZipFile(zip_path, "w", compression=zipfile.ZIP_DEFLATED,
+                         compresslevel=BACKUP_COMPRESSLEVEL) as zf:
+        if full:
+            # пользователи — из активного хранилища, в едином JSON-формате
+            body = json.dumps(users, ensure_ascii=False, indent=2)
+            zf.writestr("paid_users.json", body)
+            meta["files"].append("paid_users.json")
+            # раскладка по корзинам — как есть, чтобы её можно было вернуть без пересборки
+            if isinstance(USERS, ShardedUserRepository):
+                try:
+                    USERS.flush()
+                    for path in USERS.files():
+                        arcname = f"users/{os.path.basename(path)}"
+                        zf.write(path, arcname)
+                        meta["files"].append(arcname)
+                except Exception as e:
+                    zf.writestr("users.error", str(e))
+        else:
+            body = json.dumps({"put": put, "del": dropped}, ensure_ascii=False)
+            zf.writestr("users_delta.json", body)
+            meta["files"].append("users_delta.json")
+            meta["delta"] = {"put": len(put), "del": len(dropped)}
+        meta["hash"] = hashlib.sha1(((meta["parent"] or "") + body).encode("utf-8")).hexdigest()
+
+        # материалы — в полном всегда, в дельте только если поменялись
+        if full or assets_hash != chain.get("assets_hash"):
             try:
-                if os.path.exists(realpath):
-                    zf.write(realpath, arcname)
-                    meta["files"].append(arcname)
+                if os.path.exists(ASSETS_FILE):
+                    zf.write(ASSETS_FILE, "kit_assets.json")
+                    meta["files"].append("kit_assets.json")
                 else:
-                    zf.writestr(arcname + ".missing", "FILE_NOT_FOUND")
+                    zf.writestr("kit_assets.json.missing", "FILE_NOT_FOUND")
             except Exception as e:
-                zf.writestr(arcname + ".error", str(e))
+                zf.writestr("kit_assets.json.error", str(e))
         zf.writestr("_meta.json", json.dumps(meta, ensure_ascii=False, indent=2))
 
-    logging.info("[BACKUP] File created: %s", zip_path)
-    return zip_path, human, changes_text
+    _save_backup_chain(chain, meta, assets_hash, hashes, put, dropped)
+
+    if full:
+        kind_text = f"📦 Тип: <b>полный</b> ({len(users)} записей)"
+    else:
+        kind_text = (
+            f"🧩 Тип: <b>дельта #{meta['seq']}</b> к полному от {meta['chain_id'][:8]} "
+            f"(изменено {len(put)}, удалено {len(dropped)})\n"
+            "Для восстановления нужен полный архив и все дельты после него по порядку."
+        )
+    logging.info("[BACKUP] File created: %s (%s, seq=%s)", zip_path, meta["kind"], meta["seq"])
+    return zip_path, human, kind_text + "\n\n" + changes_text
     
 # ---------------------------
 # НАСТРОЙКИ ИЗ ENV
@@ -381,15 +706,90 @@ async def stop_heartbeat():
         logging.info("[HEARTBEAT] stopped")
 # ======================================================================
 
-ADMIN_AI_RATE_LIMIT_SEC = 2
-_last_admin_ai_ts: dict[int, float] = {}
+# === BACKUP SCHEDULER ==================================================
+# Архив собирается и сжимается в пуле ввода-вывода, цикл только ждёт и отправляет.
+# Срок следующего бэкапа считается от времени последнего архива на диске,
+# поэтому перезапуски сервиса расписание не сбивают.
+BACKUP_INTERVAL_SEC = int(os.getenv("BACKUP_INTERVAL_SEC") or 86400)   # 0 — расписание выключено
+BACKUP_STARTUP_DELAY_SEC = int(os.getenv("BACKUP_STARTUP_DELAY_SEC") or 120)
+try:
+    BACKUP_CHAT_ID = int(os.getenv("BACKUP_CHAT_ID") or 0)               # 0 — архивы никуда не отправляем
+except Exception:
+    BACKUP_CHAT_ID = 0
+
+_backup_task: asyncio.Task | None = None
+
+def _backup_due_in() -> float:
+    """Сколько секунд до следующего планового бэкапа (<= 0 — пора)."""
+    paths = list_backup_archives()
+    if not paths:
+        return 0
+    with suppress(OSError):
+        return os.path.getmtime(paths[-1]) + BACKUP_INTERVAL_SEC - time.time()
+    return 0
+
+def run_scheduled_backup() -> Optional[tuple[str, str, str]]:
+    """Сделать плановый бэкап, если он ещё нужен (другой воркер мог успеть раньше)."""
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    with _file_lock(BACKUP_CHAIN_FILE):
+        if _backup_due_in() > 0:
+            return None
+        return make_backup_zip_file()
 
-def _admin_ai_too_fast(uid: int) -> bool:
-    import time
-    now = time.time()
-    ts = _last_admin_ai_ts.get(uid, 0)
-    _last_admin_ai_ts[uid] = now
-    return (now - ts) < ADMIN_AI_RATE_LIMIT_SEC
+async def _send_backup_archive(zip_path: str, human: str, changes_text: str):
+    zip_name = os.path.basename(zip_path)
+    size_mb = os.path.getsize(zip_path) / (1024 * 1024)
+    await bot.send_document(
+        chat_id=BACKUP_CHAT_ID,
+        document=FSInputFile(zip_path, filename=zip_name),
+        caption=(
+            f"🗓 <b>Плановый бэкап:</b> <code>{zip_name}</code>\n"
+            f"🕒 Дата/время: <b>{human}</b>\n"
+            f"📦 Размер: <b>{size_mb:.2f} MB</b>\n\n"
+            f"{changes_text}"
+        )[:1024],
+        parse_mode="HTML",
+    )
+
+async def _backup_loop():
+    await asyncio.sleep(BACKUP_STARTUP_DELAY_SEC)
+    try:
+        while True:
+            wait = await run_io(_backup_due_in)
+            if wait > 0:
+                await asyncio.sleep(min(wait, 3600))
+                continue
+            try:
+                result = await run_io(run_scheduled_backup)
+                if result:
+                    logging.info("[BACKUP] scheduled backup done: %s", os.path.basename(result[0]))
+                    if BACKUP_CHAT_ID:
+                        await _send_backup_archive(*result)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.warning("[BACKUP] scheduled backup failed: %s", e)
+                await asyncio.sleep(min(BACKUP_INTERVAL_SEC, 600))  # не долбим диск при постоянной ошибке
+    except asyncio.CancelledError:
+        logging.info("[BACKUP] scheduler cancelled; exiting loop")
+        return
+
+async def start_backup_scheduler():
+    global _backup_task
+    if BACKUP_INTERVAL_SEC > 0 and _backup_task is None:
+        _backup_task = asyncio.create_task(_backup_loop())
+        logging.info("[BACKUP] scheduler started → interval=%ss, keep last=%s daily=%s weekly=%s, chat_id=%s",
+                     BACKUP_INTERVAL_SEC, BACKUP_KEEP_LAST, BACKUP_KEEP_DAILY, BACKUP_KEEP_WEEKLY,
+                     BACKUP_CHAT_ID or "-")
+
+async def stop_backup_scheduler():
+    global _backup_task
+    if _backup_task is not None:
+        _backup_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await _backup_task
+        _backup_task = None
+# ======================================================================
 
 SBP_QR_FILE_ID     = (os.getenv("SBP_QR_FILE_ID") or "").strip()
 SBP_QR_URL         = (os.getenv("SBP_QR_URL") or "").strip()
@@ -427,17 +827,56 @@ def _sanitize_prompt_template(tpl: str) -> str:
     """
     return re.sub(r"\{(\w+)[^}]*\}", r"{\1}", tpl)
 
+# поля, которые подставляются в момент вызова; всё остальное резолвится при компиляции
+PROMPT_CALL_FIELDS = frozenset({"user_id", "is_admin"})
+
+class CompiledPrompt:
+    """
+    Шаблон, разобранный один раз: кортеж сегментов, где str — готовый текст
+    (бренд-константы уже подставлены), а (name,) — поле, заполняемое при вызове.
+    Шаблон без таких полей отрисован заранее (static).
+    """
+    __slots__ = ("segments", "static")
+
+    def __init__(self, tpl: str):
+        brand = {
+            "BRAND_CREATED_AT": BRAND_CREATED_AT,
+            "BRAND_NAME":       BRAND_NAME,
+            "BRAND_OWNER":      BRAND_OWNER,
+            "BRAND_URL":        BRAND_URL,
+            "BRAND_SUPPORT_TG": BRAND_SUPPORT_TG,
+        }
+        segments: List[Any] = []
+        for literal, field, _, _ in string.Formatter().parse(_sanitize_prompt_template(tpl)):
+            if literal:
+                segments.append(literal)
+            if field is None:
+                continue
+            if field in PROMPT_CALL_FIELDS:
+                segments.append((field,))
+            else:
+                segments.append(str(brand.get(field, "N/A")))
+        # склеиваем соседние литералы
+        merged: List[Any] = []
+        for seg in segments:
+            if isinstance(seg, str) and merged and isinstance(merged[-1], str):
+                merged[-1] += seg
+            else:
+                merged.append(seg)
+        self.segments = tuple(merged)
+        self.static = "".join(self.segments) if all(isinstance(x, str) for x in merged) else None
+
+    def render(self, **fields) -> str:
+        if self.static is not None:
+            return self.static
+        return "".join(seg if isinstance(seg, str) else str(fields.get(seg[0], "N/A")) for seg in self.segments)
+
+@functools.lru_cache(maxsize=64)
+def _compile_prompt(tpl: str) -> CompiledPrompt:
+    return CompiledPrompt(tpl)
+
 def _fmt_prompt(tpl: str, **kwargs) -> str:
-    tpl = _sanitize_prompt_template(tpl)
-    base = {
-        "BRAND_CREATED_AT": BRAND_CREATED_AT,
-        "BRAND_NAME":       BRAND_NAME,
-        "BRAND_OWNER":      BRAND_OWNER,
-        "BRAND_URL":        BRAND_URL,
-        "BRAND_SUPPORT_TG": BRAND_SUPPORT_TG,
-    }
-    base.update(kwargs)
-    return tpl.format_map(_SafeDict(base))
+    return _compile_prompt(tpl).render(**kwargs)
 
 # ---------------------------
 # ХЕЛПЕР ДЛЯ ОБЯЗАТЕЛЬНЫХ ПЕРЕМЕННЫХ
@@ -585,24 +1024,6 @@ async def _send_guide_pack(user_id: int):
         file_id_override=get_asset_file_id("guide")
     )
 
-def _today_key() -> str:
-    return datetime.now().strftime("%Y%m%d")
-
-def _demo_quota_ok(uid: int) -> Tuple[bool, str]:
-    if not DEMO_AI_ENABLED:
-        return False, "Демо-режим временно отключён."
-    day = _today_key()
-    cnt = (_demo_hits.get(uid) or {}).get(day, 0)
-    if cnt >= DEMO_AI_DAILY_LIMIT:
-        return False, f"Лимит демо-чата исчерпан на сегодня ({DEMO_AI_DAILY_LIMIT}). Оформите доступ — и лимитов не будет."
-    return True, ""
-
-def _demo_register_hit(uid: int):
-    day = _today_key()
-    d = _demo_hits.get(uid) or {}
-    d[day] = d.get(day, 0) + 1
-    _demo_hits[uid] = d
-
 # ---------------------------
 # СИСТЕМНЫЕ ПРОМПТЫ ДЛЯ ИИ (ЕДИНАЯ СХЕМА)
 # ---------------------------
@@ -661,6 +1082,75 @@ AI_SYSTEM_PROMPT_ADMIN_RAW = _env_or_default(
     "При критике формируй служебный сигнал ##ADMIN_ALERT##."
 )
 
+# === РЕЕСТР ПРОМПТОВ ===
+# Режим → (переменная окружения, значение на старте). Шаблоны компилируются один раз;
+# готовый (и обрезанный по бюджету токенов) текст статичных режимов запоминается.
+# /reload_prompts перечитывает .env и перекомпилирует изменившиеся шаблоны.
+class PromptRegistry:
+    def __init__(self, sources: Dict[str, Tuple[str, str]]):
+        self.sources = sources
+        self._compiled: Dict[str, CompiledPrompt] = {}
+        self._texts: Dict[str, str] = {}
+        self._rendered: Dict[Tuple[str, Optional[int]], str] = {}
+        self.reload(reread_env=False)
+
+    def reload(self, reread_env: bool = True) -> List[str]:
+        """Перекомпилировать шаблоны; возвращает список изменившихся режимов."""
+        if reread_env:
+            for env_file in (os.getenv("APP_ENV_FILE"), ".env.kit", ".env"):
+                if env_file and os.path.exists(env_file):
+                    load_dotenv(env_file, override=True)
+                    break
+        changed = []
+        for mode, (env_key, boot_text) in self.sources.items():
+            text = _env_or_default(env_key, boot_text)
+            if self._texts.get(mode) != text:
+                self._texts[mode] = text
+                self._compiled[mode] = _compile_prompt(text)
+                changed.append(mode)
+        if changed:
+            self._rendered.clear()
+        return changed
+
+    def render(self, mode: str, limit: Optional[int] = None, **fields) -> str:
+        compiled = self._compiled.get(mode) or self._compiled["user"]
+        if compiled.static is not None:
+            key = (mode, limit)
+            text = self._rendered.get(key)
+            if text is None:
+                text = self._rendered[key] = _trim_to_tokens(compiled.static, limit) if limit else compiled.static
+            return text
+        text = compiled.render(**fields)
+        return _trim_to_tokens(text, limit) if limit else text
+
+PROMPTS = PromptRegistry({
+    "setup":     ("AI_SYSTEM_PROMPT_SETUP", AI_SYSTEM_PROMPT_SETUP_RAW),
+    "universal": ("AI_SYSTEM_PROMPT_UNIVERSAL", AI_SYSTEM_PROMPT_UNIVERSAL_RAW),
+    "brand":     ("AI_SYSTEM_PROMPT_BRAND", AI_SYSTEM_PROMPT_BRAND_RAW),
+    "pay":       ("AI_SYSTEM_PROMPT_PAY", AI_SYSTEM_PROMPT_PAY_RAW),
+    "user_demo": ("AI_SYSTEM_PROMPT_USER_DEMO", AI_SYSTEM_PROMPT_USER_DEMO_RAW),
+    "user":      ("AI_SYSTEM_PROMPT_USER_KIT", AI_SYSTEM_PROMPT_USER_RAW),
+    "admin":     ("AI_SYSTEM_PROMPT_ADMIN_KIT", AI_SYSTEM_PROMPT_ADMIN_RAW),
+})
+
+# ai_mode из состояния чата → шаблон реестра
+_AI_MODE_PROMPTS = {
+    "demo": "user_demo",
+    "standard": "user",
+    "generator": "universal",
+    "universal": "universal",
+    "setup": "setup",
+    "brand": "brand",
+    "pay": "pay",
+    "admin": "admin",
+}
+
+def _prompt_mode_for(ai_mode: str, is_demo: bool, is_admin: bool) -> str:
+    if ai_mode in _AI_MODE_PROMPTS:
+        return _AI_MODE_PROMPTS[ai_mode]
+    # консультант по умолчанию: до оплаты — демо-промпт
+    return "admin" if is_admin else "user_demo" if is_demo else "user"
+
 # ---------------------------
 # БАЗЫ ДАННЫХ (JSON файлы)
 # ---------------------------
@@ -668,13 +1158,559 @@ DATA_FILE   = os.path.join(DATA_DIR, "paid_users.json")
 ASSETS_FILE = os.path.join(DATA_DIR, "kit_assets.json")
 
 # === ASSETS CACHE ===
+# Реестр материалов в памяти (зеркало kit_assets.json): грузится в on_startup,
+# обновляется на месте через set_asset_file_id и /bind_*, перечитывается после restore.
 ASSETS_CACHE: dict = {}
 
+# ---------------------------
+# БЭКЕНД ХРАНИЛИЩА И ЧИСЛО ВОРКЕРОВ
+# ---------------------------
+STORAGE_BACKEND = (os.getenv("STORAGE_BACKEND") or "json").strip().lower()
+# после /migrate_storage (или CLI migrate-storage) бэкенд зафиксирован маркером —
+# иначе рестарт со старым STORAGE_BACKEND вернул бы бота к устаревшему файлу
+STORAGE_MARKER_FILE = os.path.join(DATA_DIR, "storage_backend.json")
+_storage_marker = _read_json_safe(STORAGE_MARKER_FILE)
+if isinstance(_storage_marker, dict) and _storage_marker.get("backend"):
+    if _storage_marker["backend"] != STORAGE_BACKEND:
+        logging.warning("[USERS] STORAGE_BACKEND=%s overridden by %s → %s (migrated %s)",
+                        STORAGE_BACKEND, os.path.basename(STORAGE_MARKER_FILE),
+                        _storage_marker["backend"], _storage_marker.get("migrated_at"))
+    STORAGE_BACKEND = _storage_marker["backend"]
+# Число uvicorn-воркеров (web_bot.py) — одно эффективное значение для всего процесса:
+# journal и sharded держат файлы только одного процесса, для них воркер всегда один.
+# От него зависят FSM-кэш, вебхук и то, где живут лимиты (память или общий SQLite).
+WEB_WORKERS = max(1, int(os.getenv("WEB_WORKERS") or 1))
+if WEB_WORKERS > 1 and STORAGE_BACKEND in ("journal", "sharded"):
+    logging.warning("[WORKERS] STORAGE_BACKEND=%s is single-process — forcing WEB_WORKERS=1", STORAGE_BACKEND)
+    WEB_WORKERS = 1
+
+# ---------------------------
+# FSM-ХРАНИЛИЩЕ (FSM_STORAGE=sqlite|memory)
+# ---------------------------
+FSM_STORAGE = (os.getenv("FSM_STORAGE") or "sqlite").strip().lower()
+FSM_DB_FILE = os.getenv("FSM_DB_FILE") or os.path.join(DATA_DIR, "fsm.sqlite3")
+FSM_STATE_TTL_SEC = int(os.getenv("FSM_STATE_TTL_SEC") or 2 * 24 * 3600)
+# при нескольких воркерах состояние читается из базы и фиксируется сразу
+_FSM_MULTI_WORKER = WEB_WORKERS > 1
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE") or (0 if _FSM_MULTI_WORKER else 5000))
+FSM_COMMIT_DELAY_SEC = float(os.getenv("FSM_COMMIT_DELAY_SEC") or (0 if _FSM_MULTI_WORKER else 0.5))
+FSM_SWEEP_EVERY_SEC = 600
+
+class SqliteFSMStorage(BaseStorage):
+    """
+    FSM-состояния в SQLite: переживают рестарт и общие для воркеров.
+    - LRU в памяти (FSM_CACHE_SIZE ключей) со сквозной записью: чтения горячих
+      ключей не ходят в базу, изменения сразу видны в кэше;
+    - изменения копятся FSM_COMMIT_DELAY_SEC и фиксируются одной транзакцией в пуле I/O;
+    - updated_at — время последнего обращения, а не записи: чтение, которому больше
+      ttl/2, освежает отметку (в кэше и отдельным UPDATE в ближайшем коммите), так что
+      идущий диалог с одними get_data не истекает;
+    - состояние, к которому не обращались FSM_STATE_TTL_SEC, считается брошенным:
+      при чтении отдаётся пустым, из базы периодически вычищается.
+    """
+
+    def __init__(self, path: str, ttl: int = FSM_STATE_TTL_SEC, cache_size: int = FSM_CACHE_SIZE,
+                 commit_delay: float = FSM_COMMIT_DELAY_SEC):
+        self.path = path
+        self.ttl = max(60, ttl)
+        self.cache_size = max(0, cache_size)
+        self.commit_delay = max(0.0, commit_delay)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS fsm (
+                key        TEXT PRIMARY KEY,
+                state      TEXT,
+                data       TEXT,
+                updated_at REAL NOT NULL
+            )"""
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_fsm_updated ON fsm(updated_at)")
+        self._db_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[str, Tuple[Optional[str], Dict[str, Any], float]]" = OrderedDict()
+        self._pending: Dict[str, Optional[Tuple[Optional[str], str, float]]] = {}
+        self._touched: Dict[str, float] = {}  # key -> время обращения (только отметка, без данных)
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._last_sweep = 0.0
+        self._closed = False
+        self.stats = {"hits": 0, "misses": 0, "commits": 0, "expired": 0}
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(str(x) for x in (
+            key.bot_id, key.chat_id, key.user_id, key.thread_id or 0,
+            key.business_connection_id or "", key.destiny,
+        ))
+
+    # --- чтение ---
+    def _select(self, k: str) -> Tuple[Optional[str], Dict[str, Any], float]:
+        with self._db_lock:
+            row = self._conn.execute("SELECT state, data, updated_at FROM fsm WHERE key=?", (k,)).fetchone()
+        if row is None:
+            return None, {}, 0.0
+        return row[0], (json.loads(row[1]) if row[1] else {}), float(row[2])
+
+    def _remember(self, k: str, ent: Tuple[Optional[str], Dict[str, Any], float]):
+        if not self.cache_size:
+            return
+        self._cache[k] = ent
+        self._cache.move_to_end(k)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _load(self, k: str) -> Tuple[Optional[str], Dict[str, Any], float]:
+        ent = self._cache.get(k)
+        if ent is not None:
+            self._cache.move_to_end(k)
+            self.stats["hits"] += 1
+        else:
+            self.stats["misses"] += 1
+            with self._lock:
+                pending = self._pending.get(k, False)
+            if pending is not False:  # вытеснен из LRU, но ещё не зафиксирован
+                ent = (pending[0], json.loads(pending[1]), pending[2]) if pending else (None, {}, 0.0)
+            else:
+                ent = await run_io(self._select, k)
+            self._remember(k, ent)
+        now = time.time()
+        if ent[2] and now - ent[2] > self.ttl:
+            self.stats["expired"] += 1
+            ent = (None, {}, 0.0)
+            await self._write(k, None, {})
+        elif ent[2] and now - ent[2] > self.ttl / 2:
+            await self._touch(k, ent, now)
+        return ent
+
+    async def _touch(self, k: str, ent: Tuple[Optional[str], Dict[str, Any], float], now: float):
+        """Освежить время обращения, не переписывая данные (другой воркер мог их уже изменить)."""
+        if k in self._cache:
+            self._remember(k, (ent[0], ent[1], now))
+        with self._lock:
+            pending = self._pending.get(k, False)
+            if pending:
+                self._pending[k] = (pending[0], pending[1], now)
+            elif pending is False:
+                self._touched[k] = now
+        await self._schedule_commit()
+
+    # --- запись ---
+    async def _write(self, k: str, state: Optional[str], data: Dict[str, Any]):
+        now = time.time()
+        self._remember(k, (state, data, now))
+        with self._lock:
+            if state is None and not data:
+                self._pending[k] = None  # пустое состояние — строку удаляем
+            else:
+                self._pending[k] = (state, json.dumps(data, ensure_ascii=False), now)
+            self._touched.pop(k, None)
+        await self._schedule_commit()
+
+    async def _schedule_commit(self):
+        if self.commit_delay <= 0:
+            await run_io(self._commit)
+        elif self._flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self._flush_handle = loop.call_later(self.commit_delay, self._commit_in_background)
+
+    def _commit(self):
+        with self._lock:
+            batch, self._pending = self._pending, {}
+            touched, self._touched = self._touched, {}
+        now = time.time()
+        if not batch and not touched and now - self._last_sweep < FSM_SWEEP_EVERY_SEC:
+            return
+        try:
+            with self._db_lock:
+                self._conn.execute("BEGIN")
+                try:
+                    upserts = [(k, v[0], v[1], v[2]) for k, v in batch.items() if v is not None]
+                    deletes = [(k,) for k, v in batch.items() if v is None]
+                    if upserts:
+                        self._conn.executemany(
+                            "INSERT OR REPLACE INTO fsm(key, state, data, updated_at) VALUES (?,?,?,?)", upserts
+                        )
+                    if deletes:
+                        self._conn.executemany("DELETE FROM fsm WHERE key=?", deletes)
+                    touches = [(ts, k) for k, ts in touched.items() if k not in batch]
+                    if touches:
+                        self._conn.executemany(
+                            "UPDATE fsm SET updated_at=MAX(updated_at, ?) WHERE key=?", touches
+                        )
+                    if now - self._last_sweep >= FSM_SWEEP_EVERY_SEC:
+                        cur = self._conn.execute("DELETE FROM fsm WHERE updated_at < ?", (now - self.ttl,))
+                        if cur.rowcount:
+                            logging.info("[FSM] expired %s abandoned states", cur.rowcount)
+                        self._last_sweep = now
+                except Exception:
+                    self._conn.execute("ROLLBACK")
+                    raise
+                self._conn.execute("COMMIT")
+            self.stats["commits"] += 1
+        except Exception:
+            with self._lock:  # вернём несохранённое, не затирая более свежие изменения
+                for k, v in batch.items():
+                    self._pending.setdefault(k, v)
+                for k, ts in touched.items():
+                    if k not in self._pending:
+                        self._touched.setdefault(k, ts)
+            raise
+
+    def _commit_in_background(self):
+        self._flush_handle = None
+        loop = asyncio.get_running_loop()
+        fut = loop.run_in_executor(_IO_POOL, self._commit)
+
+        def _done(f: asyncio.Future):
+            if f.exception() is not None:
+                logging.warning("[FSM] commit failed: %s", f.exception())
+                if self._flush_handle is None and not self._closed:
+                    self._flush_handle = loop.call_later(max(1.0, self.commit_delay), self._commit_in_background)
+
+        fut.add_done_callback(_done)
+
+    # --- интерфейс BaseStorage ---
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k = self._key(key)
+        _, data, _ = await self._load(k)
+        await self._write(k, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._load(self._key(key)))[0]
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        k = self._key(key)
+        state, _, _ = await self._load(k)
+        await self._write(k, state, dict(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict((await self._load(self._key(key)))[1])
+
+    async def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        try:
+            self._commit()  # синхронно: пул I/O к этому моменту может быть уже остановлен
+        except Exception as e:
+            logging.warning("[FSM] final commit failed: %s", e)
+        with self._db_lock, suppress(Exception):
+            self._conn.close()
+
+def _make_fsm_storage() -> BaseStorage:
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    if FSM_STORAGE != "sqlite":
+        logging.warning("[FSM] unknown FSM_STORAGE=%s, falling back to sqlite", FSM_STORAGE)
+    logging.info("[FSM] storage=sqlite (%s, cache=%s, commit_delay=%ss)", FSM_DB_FILE, FSM_CACHE_SIZE, FSM_COMMIT_DELAY_SEC)
+    return SqliteFSMStorage(FSM_DB_FILE)
+
 # ---------------------------
 # БОТ/ДИСПЕТЧЕР
 # ---------------------------
 bot = Bot(token=TOKEN)
-dp  = Dispatcher(storage=MemoryStorage())
+dp  = Dispatcher(storage=_make_fsm_storage())
+
+# ---------------------------
+# ОГРАНИЧЕНИЕ ЧАСТОТЫ (token bucket)
+# ---------------------------
+RATE_LIMIT_ENABLED    = (os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true")
+RATE_LIMIT_IDLE_SEC   = int(os.getenv("RATE_LIMIT_IDLE_SEC") or 600)
+RATE_LIMIT_MAX_KEYS   = int(os.getenv("RATE_LIMIT_MAX_KEYS") or 50000)
+RATE_LIMIT_NOTICE_SEC = int(os.getenv("RATE_LIMIT_NOTICE_SEC") or 10)
+
+# Политики: rate — токенов в секунду, burst — ёмкость ведра (на пользователя);
+# global_* — общее ведро политики на всех (0 — без общего лимита);
+# exempt_admin — админ не ограничивается.
+RATE_LIMITS: Dict[str, Dict[str, float]] = {
+    "ai":       {"rate": 1 / 4,  "burst": 4, "global_rate": 5,  "global_burst": 20, "exempt_admin": 1},
+    "ai_admin": {"rate": 1 / 2,  "burst": 1, "global_rate": 0,  "global_burst": 0,  "exempt_admin": 0},
+    "support":  {"rate": 1 / 30, "burst": 3, "global_rate": 1,  "global_burst": 10, "exempt_admin": 1},
+    "relay":    {"rate": 1,      "burst": 5, "global_rate": 10, "global_burst": 30, "exempt_admin": 1},
+    "demo":     {"rate": 1 / DEMO_AI_COOLDOWN_SEC if DEMO_AI_COOLDOWN_SEC > 0 else 0,
+                 "burst": 1, "global_rate": 0, "global_burst": 0, "exempt_admin": 0},
+}
+with suppress(Exception):
+    for _name, _p in json.loads(os.getenv("RATE_LIMITS") or "{}").items():
+        RATE_LIMITS.setdefault(_name, dict(RATE_LIMITS["relay"])).update(
+            {k: float(v) for k, v in _p.items()})
+
+RATE_LIMIT_DB_FILE = os.getenv("RATE_LIMIT_DB_FILE") or os.path.join(DATA_DIR, "limits.sqlite3")
+
+
+class SharedLimitStore:
+    """
+    Вёдра и дневные счётчики в SQLite — общие для всех воркеров при WEB_WORKERS > 1:
+    в памяти у каждого процесса был бы свой лимит, то есть в N раз мягче.
+    - каждая операция — одна короткая транзакция BEGIN IMMEDIATE; вызывать через run_io;
+    - время — time.time(): monotonic у разных процессов не сравним;
+    - раз в SWEEP_EVERY_SEC выбрасываются простаивающие вёдра и счётчики прошлых дней.
+    """
+
+    SWEEP_EVERY_SEC = 300
+
+    def __init__(self, path: str, idle_sec: int = RATE_LIMIT_IDLE_SEC):
+        self.path = path
+        self.idle_sec = max(1, idle_sec)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=OFF")  # пара токенов, потерянных при падении, не страшна
+        self._conn.execute("PRAGMA busy_timeout=5000")
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS buckets (
+                key    TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                ts     REAL NOT NULL
+            )"""
+        )
+        self._conn.execute(
+            """CREATE TABLE IF NOT EXISTS counters (
+                key TEXT PRIMARY KEY,
+                day TEXT NOT NULL,
+                n   INTEGER NOT NULL,
+                ts  REAL NOT NULL
+            )"""
+        )
+        self._lock = threading.Lock()
+        self._last_sweep = 0.0
+
+    @staticmethod
+    def _key(key: Tuple[Any, ...]) -> str:
+        return "|".join(str(x) for x in key)
+
+    @contextmanager
+    def _tx(self):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def take(self, key: Tuple[Any, ...], rate: float, burst: float, cost: float = 1.0,
+             peek: bool = False) -> float:
+        k, now = self._key(key), time.time()
+        with self._tx() as c:
+            row = c.execute("SELECT tokens, ts FROM buckets WHERE key=?", (k,)).fetchone()
+            tokens = float(burst) if row is None else min(float(burst), row[0] + max(0.0, now - row[1]) * rate)
+            wait = 0.0 if tokens >= cost else (cost - tokens) / rate
+            if not peek:
+                c.execute("INSERT OR REPLACE INTO buckets(key, tokens, ts) VALUES (?,?,?)",
+                          (k, tokens if wait else tokens - cost, now))
+        self._maybe_sweep(now)
+        return wait
+
+    def refund(self, key: Tuple[Any, ...], burst: float, cost: float = 1.0):
+        with self._tx() as c:
+            c.execute("UPDATE buckets SET tokens = MIN(?, tokens + ?) WHERE key=?",
+                      (float(burst), cost, self._key(key)))
+
+    def count(self, key: Tuple[Any, ...], day: str) -> int:
+        with self._lock:
+            row = self._conn.execute("SELECT n FROM counters WHERE key=? AND day=?",
+                                     (self._key(key), day)).fetchone()
+        return int(row[0]) if row else 0
+
+    def incr(self, key: Tuple[Any, ...], day: str) -> int:
+        k = self._key(key)
+        with self._tx() as c:
+            row = c.execute("SELECT day, n FROM counters WHERE key=?", (k,)).fetchone()
+            n = row[1] + 1 if row and row[0] == day else 1
+            c.execute("INSERT OR REPLACE INTO counters(key, day, n, ts) VALUES (?,?,?,?)", (k, day, n, time.time()))
+        return n
+
+    def clear(self, prefix: str):
+        """Сбросить вёдра и счётчики с ключами prefix* (напр. "demo|" при очистке базы)."""
+        with self._tx() as c:
+            c.execute("DELETE FROM buckets WHERE key LIKE ?", (prefix + "%",))
+            c.execute("DELETE FROM counters WHERE key LIKE ?", (prefix + "%",))
+
+    def day_rows(self, prefix: str, day: str) -> List[Tuple[str, int, float]]:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT key, n, ts FROM counters WHERE day=? AND key LIKE ? ORDER BY n DESC, ts DESC",
+                (day, prefix + "%"),
+            ).fetchall()
+
+    def _maybe_sweep(self, now: float):
+        if now - self._last_sweep < self.SWEEP_EVERY_SEC:
+            return
+        self._last_sweep = now
+        with suppress(Exception), self._tx() as c:
+            c.execute("DELETE FROM buckets WHERE ts < ?", (now - self.idle_sec,))
+            c.execute("DELETE FROM counters WHERE day < ?", (datetime.now().strftime("%Y-%m-%d"),))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+LIMITS_STORE: Optional[SharedLimitStore] = SharedLimitStore(RATE_LIMIT_DB_FILE) if WEB_WORKERS > 1 else None
+
+
+class TokenBucketLimiter:
+    """
+    In-memory token bucket: ведро на (политика, uid) и общее ведро (политика, "*").
+    - токены доливаются лениво при обращении, отдельного таймера нет;
+    - вёдра лежат в OrderedDict по времени последнего обращения; при создании нового
+      ведра с головы выбрасываются простаивающие дольше RATE_LIMIT_IDLE_SEC и уже
+      полностью долитые (для них «забыть» == «полное ведро»), а сверх
+      RATE_LIMIT_MAX_KEYS — самые старые в любом случае;
+    - rate <= 0 — без ограничения;
+    - с store (WEB_WORKERS > 1) вёдра политик живут в SharedLimitStore, и из
+      event loop проверять нужно через acheck(); троттлинг предупреждений — всегда локальный.
+    """
+
+    def __init__(self, idle_sec: int = RATE_LIMIT_IDLE_SEC, max_keys: int = RATE_LIMIT_MAX_KEYS,
+                 store: Optional[SharedLimitStore] = None):
+        self.idle_sec = max(1, idle_sec)
+        self.max_keys = max(100, max_keys)
+        self.store = store
+        # key → [tokens, ts последнего обращения, секунд до полного ведра с нуля]
+        self._buckets: "OrderedDict[Tuple[Any, ...], List[float]]" = OrderedDict()
+        self.stats: Dict[str, Dict[str, int]] = {}
+        self.evicted = 0
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def _evict(self, now: float):
+        while self._buckets:
+            _, b = next(iter(self._buckets.items()))
+            if len(self._buckets) < self.max_keys and now - b[1] < max(self.idle_sec, b[2]):
+                break
+            self._buckets.popitem(last=False)
+            self.evicted += 1
+
+    def _bucket(self, key: Tuple[Any, ...], rate: float, burst: float, now: float) -> List[float]:
+        b = self._buckets.get(key)
+        if b is None:
+            self._evict(now)
+            b = self._buckets[key] = [float(burst), now, burst / rate]
+        else:
+            self._buckets.move_to_end(key)
+            b[0] = min(float(burst), b[0] + (now - b[1]) * rate)
+            b[1] = now
+        return b
+
+    def _take_local(self, key: Tuple[Any, ...], rate: float, burst: float, cost: float = 1.0,
+                    now: Optional[float] = None) -> float:
+        if rate <= 0:
+            return 0.0
+        b = self._bucket(key, rate, burst, time.monotonic() if now is None else now)
+        if b[0] >= cost:
+            b[0] -= cost
+            return 0.0
+        return (cost - b[0]) / rate
+
+    def take(self, key: Tuple[Any, ...], rate: float, burst: float, cost: float = 1.0,
+             now: Optional[float] = None) -> float:
+        """Списать cost токенов. 0 — можно; иначе — сколько секунд ждать."""
+        if rate <= 0:
+            return 0.0
+        if self.store is not None:
+            return self.store.take(key, rate, burst, cost)
+        return self._take_local(key, rate, burst, cost, now)
+
+    def peek(self, key: Tuple[Any, ...], rate: float, burst: float, cost: float = 1.0) -> float:
+        """Как take, но ничего не списывает."""
+        if rate <= 0:
+            return 0.0
+        if self.store is not None:
+            return self.store.take(key, rate, burst, cost, peek=True)
+        b = self._bucket(key, rate, burst, time.monotonic())
+        return 0.0 if b[0] >= cost else (cost - b[0]) / rate
+
+    def refund(self, key: Tuple[Any, ...], burst: float, cost: float = 1.0):
+        """Вернуть cost токенов, но не выше burst — повторный возврат не даёт сверх ёмкости."""
+        if self.store is not None:
+            self.store.refund(key, burst, cost)
+            return
+        b = self._buckets.get(key)
+        if b is not None:
+            b[0] = min(float(burst), b[0] + cost)
+
+    @staticmethod
+    def _policy(name: str, admin: bool = False) -> Optional[Dict[str, float]]:
+        """Политика name, если она действует (None — лимиты выключены, политики нет, админ освобождён)."""
+        pol = RATE_LIMITS.get(name)
+        if not RATE_LIMIT_ENABLED or pol is None or (admin and pol.get("exempt_admin")):
+            return None
+        return pol
+
+    def check(self, name: str, uid: int, admin: bool = False) -> float:
+        """Пропустить событие по политике name: сначала ведро пользователя, потом общее."""
+        pol = self._policy(name, admin)
+        if pol is None:
+            return 0.0
+        st = self.stats.setdefault(name, {"allowed": 0, "limited": 0, "global": 0})
+        now = time.monotonic()
+        wait = self.take((name, uid), pol["rate"], pol["burst"], now=now)
+        if not wait and pol.get("global_rate", 0) > 0:
+            wait = self.take((name, "*"), pol["global_rate"], pol["global_burst"], now=now)
+            if wait:
+                self.refund((name, uid), pol["burst"])  # упёрлись в общий лимит — личный токен не сгорает
+                st["global"] += 1
+        st["limited" if wait else "allowed"] += 1
+        return wait
+
+    def peek_policy(self, name: str, uid: int, admin: bool = False) -> float:
+        """Как check() по личному ведру, но ничего не списывает."""
+        pol = self._policy(name, admin)
+        return 0.0 if pol is None else self.peek((name, uid), pol["rate"], pol["burst"])
+
+    async def acheck(self, name: str, uid: int, admin: bool = False) -> float:
+        """check() из event loop: с общим хранилищем — через run_io."""
+        if self.store is None:
+            return self.check(name, uid, admin)
+        return await run_io(self.check, name, uid, admin)
+
+    def notice_due(self, name: str, uid: int) -> bool:
+        """Предупреждение «слишком часто» — не чаще раза в RATE_LIMIT_NOTICE_SEC."""
+        return not self._take_local(("notice", name, uid), 1 / max(1, RATE_LIMIT_NOTICE_SEC), 1)
+
+    def clear(self):
+        self._buckets.clear()
+
+
+RATE_LIMITER = TokenBucketLimiter(store=LIMITS_STORE)
+
+
+class RateLimitMiddleware(BaseMiddleware):
+    """
+    Внутренняя middleware (после фильтров): политика берётся из флага хендлера
+    flags={"rate_limit": "<политика>"}. Без флага событие идёт дальше как есть.
+    Сверх лимита апдейт отбрасывается: для callback — всплывашка, для сообщений —
+    короткий ответ, но не чаще раза в RATE_LIMIT_NOTICE_SEC, чтобы не отвечать на спам спамом.
+    """
+
+    async def __call__(self, handler, event, data):
+        name = get_flag(data, "rate_limit")
+        user = getattr(event, "from_user", None)
+        if not name or user is None:
+            return await handler(event, data)
+        wait = await RATE_LIMITER.acheck(name, user.id, admin=user.id == ADMIN_ID)
+        if not wait:
+            return await handler(event, data)
+        text = f"⏳ Слишком часто. Попробуйте через {max(1, int(wait + 0.999))} сек."
+        if isinstance(event, types.CallbackQuery):
+            await _safe_cb_answer(event, text)
+        elif RATE_LIMITER.notice_due(name, user.id):
+            logging.info("[RATE] %s uid=%s limited, retry in %.1fs", name, user.id, wait)
+            with suppress(Exception):
+                await event.answer(text)
+        return None
+
+
+dp.message.middleware(RateLimitMiddleware())
+dp.callback_query.middleware(RateLimitMiddleware())
 
 # ---------------------------
 # БЕЗОПАСНЫЙ ОТВЕТ НА CALLBACK
@@ -725,97 +1761,106 @@ _active_user_chats: Dict[int, int] = {}  # user_id -> admin_id
 # ---------------------------
 # ИСТОРИЯ ДЛЯ ИИ
 # ---------------------------
+# Размер промпта ограничен бюджетами в токенах (по режимам): системный промпт,
+# история и вопрос пользователя. Токены считаются tiktoken один раз — при добавлении
+# реплики в историю — и хранятся вместе с ней. Без tiktoken — оценка по длине текста.
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover
+    tiktoken = None
+
 _user_histories: Dict[str, deque] = {}
 
-# Демо-квоты (на день)
-_demo_hits: Dict[int, Dict[str, int]] = {}  # {uid: {YYYYMMDD: count}}
-_demo_last: Dict[int, float] = {}           # {uid: last_ts}
+# бюджеты в токенах; AI_TOKEN_BUDGETS='{"demo": {"history": 400}}' переопределяет частично
+AI_TOKEN_BUDGETS: Dict[str, Dict[str, int]] = {
+    "default": {"system": 1500, "history": 2000, "user": 1000},
+    "demo":    {"system": 1000, "history": 600,  "user": 400},
+    "admin":   {"system": 2000, "history": 4000, "user": 3000},
+}
+with suppress(Exception):
+    for _mode, _b in json.loads(os.getenv("AI_TOKEN_BUDGETS") or "{}").items():
+        AI_TOKEN_BUDGETS.setdefault(_mode, dict(AI_TOKEN_BUDGETS["default"])).update(
+            {k: int(v) for k, v in _b.items()})
+
+def _token_budget(mode: str) -> Dict[str, int]:
+    return AI_TOKEN_BUDGETS.get(mode or "consultant") or AI_TOKEN_BUDGETS["default"]
+
+@functools.lru_cache(maxsize=4)
+def _token_encoder(model: str = ""):
+    """Энкодер на модель — один раз на процесс (загрузка словаря небыстрая)."""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model.split("/")[-1])
+    except Exception:
+        pass
+    try:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logging.warning("[AI] tiktoken unavailable (%s), token counts are estimated", e)
+        return None
 
-def _desired_hist_maxlen() -> int:
-    pairs = max(1, min(50, AI_MAX_HISTORY))
-    return pairs * 2  # user+assistant
+def count_tokens(text: str) -> int:
+    enc = _token_encoder(OPENAI_MODEL)
+    if enc is None:
+        return len(text or "") // 3 + 1
+    return len(enc.encode(text or "", disallowed_special=()))
+
+def _trim_to_tokens(text: str, limit: int) -> str:
+    """Обрезать текст до limit токенов (с многоточием)."""
+    text = text or ""
+    enc = _token_encoder(OPENAI_MODEL)
+    if enc is None:
+        return text if len(text) <= limit * 3 else text[:limit * 3] + "…"
+    tokens = enc.encode(text, disallowed_special=())
+    return text if len(tokens) <= limit else enc.decode(tokens[:limit]) + "…"
 
 def _hist_key(uid: int, is_admin: bool) -> str:
     return f"{'admin' if is_admin else 'user'}:{uid}"
 
 def _push_history(uid: int, is_admin: bool, role: str, content: str, desired: Optional[int] = None):
     """
-    Кладём событие в историю. Если задан desired — после добавления
+    Кладём реплику (с числом токенов) в историю. Если задан desired — после добавления
     обрезаем историю до desired последних СООБЩЕНИЙ (не пар).
     """
     key = _hist_key(uid, is_admin)
     dq = _user_histories.get(key)
     if dq is None:
-        dq = deque(maxlen=AI_MAX_HISTORY * 2)  # запас по умолчанию
+        dq = deque(maxlen=AI_MAX_HISTORY * 2)  # AI_MAX_HISTORY — пары user+assistant
         _user_histories[key] = dq
 
-    dq.append({"role": role, "content": content})
+    dq.append({"role": role, "content": content, "tokens": count_tokens(content)})
 
     if desired is not None:
         # мягкая обрезка без изменения dq.maxlen (его менять нельзя)
         while len(dq) > desired:
             dq.popleft()
 
-def _demo_quota_ok(uid: int) -> tuple[bool, str]:
-    today = datetime.now().strftime("%Y-%m-%d")
-    rec = _demo_hits.get(uid)
-    if not rec or rec.get("date") != today:
-        return True, ""
-    if rec.get("count", 0) < DEMO_AI_DAILY_LIMIT:
-        return True, ""
-    return False, f"Лимит демо-диалога на сегодня исчерпан ({DEMO_AI_DAILY_LIMIT}). Оформите доступ, чтобы общаться без ограничений."
-
-def _demo_register_hit(uid: int):
-    today = datetime.now().strftime("%Y-%m-%d")
-    rec = _demo_hits.get(uid)
-    if not rec or rec.get("date") != today:
-        _demo_hits[uid] = {"date": today, "count": 1}
-    else:
-        rec["count"] = rec.get("count", 0) + 1
-
-def _hist_key(uid: int, is_admin: bool) -> str:
-    return f"{'admin' if is_admin else 'user'}:{uid}"
-
-def _push_history(uid: int, is_admin: bool, role: str, content: str, desired: Optional[int] = None):
+def _history_within(dq, budget: int) -> List[Dict[str, str]]:
+    """Последние реплики, укладывающиеся в budget токенов (по сохранённым счётчикам)."""
+    picked: List[Dict[str, str]] = []
+    used = 0
+    for item in reversed(dq):
+        used += item.get("tokens") or count_tokens(item["content"])
+        if used > budget:
+            break
+        picked.append({"role": item["role"], "content": item["content"]})
+    picked.reverse()
+    return picked
+
+def _build_messages(uid: int, is_admin: bool, user_text: str, is_demo: bool = False,
+                    mode: Optional[str] = None, prompt: Optional[str] = None) -> List[Dict[str, str]]:
     """
-    desired — желаемая общая длина deque (кол-во сообщений user+assistant),
-    чтобы в демо урезать историю.
+    [system, история, вопрос] в пределах бюджета режима mode
+    (по умолчанию — demo/admin/default по флагам). prompt — шаблон из PROMPTS
+    (по умолчанию admin/user). Текущий вопрос в историю ещё не добавлен.
     """
-    key = _hist_key(uid, is_admin)
-    maxlen = desired or (AI_MAX_HISTORY * 2)  # пары user+assistant
-    dq = _user_histories.get(key)
-    if dq is None or dq.maxlen != maxlen:
-        dq = deque(maxlen=maxlen)
-        _user_histories[key] = dq
-    dq.append({"role": role, "content": content})
-
-    # вычислим текущий желаемый лимит сообщений
-    default_max = AI_MAX_HISTORY * 2  # AI_MAX_HISTORY — кол-во ПАР; умножаем на 2 → сообщения
-    msg_max = int(desired) if desired and desired > 0 else default_max
-    msg_max = max(2, min(msg_max, default_max))  # не дать вырасти выше прод-лимита и ниже 2
-
-    dq = _user_histories.get(key)
-
-    if dq is None:
-        dq = deque(maxlen=msg_max)
-        _user_histories[key] = dq
-    else:
-        # если лимит поменялся — пересоберём очередь с новым maxlen
-        if dq.maxlen != msg_max:
-            dq = deque(dq, maxlen=msg_max)
-            _user_histories[key] = dq
-
-    dq.append({"role": role, "content": content})
-
-def _build_messages(uid: int, is_admin: bool, user_text: str, is_demo: bool = False) -> List[Dict[str, str]]:
-    sys_prompt = _fmt_prompt(
-        AI_SYSTEM_PROMPT_ADMIN_RAW if is_admin else AI_SYSTEM_PROMPT_USER_RAW,
-        user_id=uid, is_admin=is_admin
-    )
+    budget = _token_budget(mode or ("demo" if is_demo else "admin" if is_admin else "default"))
+    sys_prompt = PROMPTS.render(prompt or ("admin" if is_admin else "user"), budget["system"],
+                                user_id=uid, is_admin=is_admin)
     msgs = [{"role": "system", "content": sys_prompt}]
-    dq = _user_histories.get(_hist_key(uid, is_admin)) or []
-    msgs.extend(dq)
-    msgs.append({"role": "user", "content": user_text})
+    msgs.extend(_history_within(_user_histories.get(_hist_key(uid, is_admin)) or (), budget["history"]))
+    msgs.append({"role": "user", "content": _trim_to_tokens(user_text, budget["user"])})
     return msgs
 
 def _headers_for_openai():
@@ -824,6 +1869,51 @@ def _headers_for_openai():
     h["X-Title"] = BRAND_NAME
     return h
 
+# === HTTP-КЛИЕНТ ИИ ===
+# Одна долгоживущая сессия на процесс: соединения к OPENAI_BASE_URL переиспользуются
+# (без DNS + TCP/TLS на каждое сообщение). Создаётся в on_startup, закрывается в on_shutdown;
+# если запрос пришёл раньше (или из другого входа) — сессия создаётся лениво.
+AI_HTTP_LIMIT = int(os.getenv("AI_HTTP_LIMIT") or 100)                    # всего соединений
+AI_HTTP_LIMIT_PER_HOST = int(os.getenv("AI_HTTP_LIMIT_PER_HOST") or 20)
+AI_HTTP_KEEPALIVE_SEC = float(os.getenv("AI_HTTP_KEEPALIVE_SEC") or 60)
+AI_HTTP_DNS_TTL_SEC = int(os.getenv("AI_HTTP_DNS_TTL_SEC") or 300)
+AI_HTTP_CONNECT_TIMEOUT_SEC = float(os.getenv("AI_HTTP_CONNECT_TIMEOUT_SEC") or 10)
+AI_TIMEOUT_SEC = float(os.getenv("AI_TIMEOUT_SEC") or 45)
+AI_DEMO_TIMEOUT_SEC = float(os.getenv("AI_DEMO_TIMEOUT_SEC") or 30)
+
+class AIHttpClient:
+    def __init__(self):
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    def session(self) -> aiohttp.ClientSession:
+        # без await внутри — две корутины не создадут две сессии
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=AI_HTTP_LIMIT,
+                limit_per_host=AI_HTTP_LIMIT_PER_HOST,
+                keepalive_timeout=AI_HTTP_KEEPALIVE_SEC,
+                ttl_dns_cache=AI_HTTP_DNS_TTL_SEC,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, headers=_headers_for_openai())
+            logging.info("[AI-HTTP] session opened (limit=%s, per_host=%s, keepalive=%ss)",
+                         AI_HTTP_LIMIT, AI_HTTP_LIMIT_PER_HOST, AI_HTTP_KEEPALIVE_SEC)
+        return self._session
+
+    @staticmethod
+    def timeout(total: float) -> aiohttp.ClientTimeout:
+        return aiohttp.ClientTimeout(total=total, connect=AI_HTTP_CONNECT_TIMEOUT_SEC)
+
+    async def start(self):
+        self.session()
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logging.info("[AI-HTTP] session closed")
+        self._session = None
+
+AI_HTTP = AIHttpClient()
+
 async def _post_async(url, headers, json, timeout=60):
     """Асинхронный POST-запрос (fallback-метод, если aiohttp не используется напрямую)."""
     loop = asyncio.get_running_loop()
@@ -843,24 +1933,24 @@ async def _ai_complete(uid: int, is_admin: bool, user_text: str) -> str:
         "temperature": 0.2,
     }
     url = f"{OPENAI_BASE_URL.rstrip('/')}/chat/completions"
-    timeout = aiohttp.ClientTimeout(total=45, connect=10)
+    timeout = AI_HTTP.timeout(AI_TIMEOUT_SEC)
 
     try:
-        async with aiohttp.ClientSession(timeout=timeout, headers=_headers_for_openai()) as s:
-            for attempt in range(3):  # ретраи
-                async with s.post(url, json=payload) as resp:
-                    txt = await resp.text()
-                    logging.info("[AI] HTTP %s attempt=%s body=%s", resp.status, attempt, txt[:300])
-                    if resp.status == 200:
-                        try:
-                            data = json.loads(txt)
-                        except Exception:
-                            data = await resp.json()
-                        return (data.get("choices") or [{}])[0].get("message", {}).get("content", "") or "⚠️ Пустой ответ модели."
-                    if resp.status in (429, 500, 502, 503, 504):
-                        await asyncio.sleep(1.5 * attempt + 0.5)
-                        continue
-                    return f"⚠️ Ошибка ИИ: {resp.status} {txt[:200]}"
+        s = AI_HTTP.session()
+        for attempt in range(3):  # ретраи
+            async with s.post(url, json=payload, timeout=timeout) as resp:
+                txt = await resp.text()
+                logging.info("[AI] HTTP %s attempt=%s body=%s", resp.status, attempt, txt[:300])
+                if resp.status == 200:
+                    try:
+                        data = json.loads(txt)
+                    except Exception:
+                        data = await resp.json()
+                    return (data.get("choices") or [{}])[0].get("message", {}).get("content", "") or "⚠️ Пустой ответ модели."
+                if resp.status in (429, 500, 502, 503, 504):
+                    await asyncio.sleep(1.5 * attempt + 0.5)
+                    continue
+                return f"⚠️ Ошибка ИИ: {resp.status} {txt[:200]}"
     except asyncio.CancelledError:
         raise
     except Exception as e:
@@ -881,29 +1971,288 @@ async def _ai_complete_demo(uid: int, is_admin: bool, prepared_messages: List[Di
         # "max_tokens": 400,  # можно включить при желании
     }
     url = f"{OPENAI_BASE_URL.rstrip('/')}/chat/completions"
-    timeout = aiohttp.ClientTimeout(total=30, connect=10)
+    timeout = AI_HTTP.timeout(AI_DEMO_TIMEOUT_SEC)
 
     try:
-        async with aiohttp.ClientSession(timeout=timeout, headers=_headers_for_openai()) as s:
-            for attempt in range(3):
-                async with s.post(url, json=payload) as resp:
-                    txt = await resp.text()
-                    logging.info("[AI-DEMO] HTTP %s attempt=%s body=%s", resp.status, attempt, txt[:300])
-                    if resp.status == 200:
-                        try:
-                            data = json.loads(txt)
-                        except Exception:
-                            data = await resp.json()
-                        return (data.get("choices") or [{}])[0].get("message", {}).get("content", "") or "⚠️ Пустой ответ модели."
-                    if resp.status in (429, 500, 502, 503, 504):
-                        await asyncio.sleep(1.5 * attempt + 0.5)
-                        continue
-                    return f"⚠️ Ошибка ИИ (демо): {resp.status} {txt[:200]}"
+        s = AI_HTTP.session()
+        for attempt in range(3):
+            async with s.post(url, json=payload, timeout=timeout) as resp:
+                txt = await resp.text()
+                logging.info("[AI-DEMO] HTTP %s attempt=%s body=%s", resp.status, attempt, txt[:300])
+                if resp.status == 200:
+                    try:
+                        data = json.loads(txt)
+                    except Exception:
+                        data = await resp.json()
+                    return (data.get("choices") or [{}])[0].get("message", {}).get("content", "") or "⚠️ Пустой ответ модели."
+                if resp.status in (429, 500, 502, 503, 504):
+                    await asyncio.sleep(1.5 * attempt + 0.5)
+                    continue
+                return f"⚠️ Ошибка ИИ (демо): {resp.status} {txt[:200]}"
     except Exception as e:
         logging.exception("AI demo error: %s", e)
         return f"⚠️ Исключение (демо): {e}"
 
-    return "⚠️ Таймаут ИИ (демо). Попробуйте ещё раз."        
+    return "⚠️ Таймаут ИИ (демо). Попробуйте ещё раз."
+
+class AIStreamError(Exception):
+    """Стрим не дал ни одного токена (HTTP-ошибка, нет ключа)."""
+
+async def _ai_stream(prepared_messages: List[Dict[str, str]], timeout_sec: float = AI_DEMO_TIMEOUT_SEC):
+    """
+    Потоковый /chat/completions (stream: true, SSE): отдаёт куски текста по мере генерации.
+    Ретраи — только пока не пришёл первый токен; дальше обрыв пробрасывается как есть.
+    """
+    if not OPENAI_API_KEY:
+        raise AIStreamError("⚠️ OPENAI_API_KEY не задан в .env")
+    payload = {
+        "model": OPENAI_MODEL,
+        "messages": prepared_messages,
+        "temperature": 0.2,
+        "stream": True,
+    }
+    url = f"{OPENAI_BASE_URL.rstrip('/')}/chat/completions"
+    timeout = AI_HTTP.timeout(timeout_sec)
+    s = AI_HTTP.session()
+    for attempt in range(3):
+        async with s.post(url, json=payload, timeout=timeout) as resp:
+            if resp.status != 200:
+                txt = await resp.text()
+                logging.info("[AI-STREAM] HTTP %s attempt=%s body=%s", resp.status, attempt, txt[:300])
+                if resp.status in (429, 500, 502, 503, 504) and attempt < 2:
+                    await asyncio.sleep(1.5 * attempt + 0.5)
+                    continue
+                raise AIStreamError(f"⚠️ Ошибка ИИ: {resp.status} {txt[:200]}")
+            async for raw in resp.content:  # построчно
+                line = raw.decode("utf-8", "ignore").strip()
+                if not line.startswith("data:"):
+                    continue  # пустые строки-разделители и ": keep-alive"-комментарии
+                data = line[5:].strip()
+                if data == "[DONE]":
+                    return
+                try:
+                    chunk = json.loads(data)
+                except ValueError:
+                    continue
+                piece = ((chunk.get("choices") or [{}])[0].get("delta") or {}).get("content")
+                if piece:
+                    yield piece
+            return
+
+# === КЭШ ОТВЕТОВ ИИ ===
+# Одинаковые вопросы («как оплатить», «что в наборе») отдаются из памяти без запроса к модели.
+# Ключ — хэш нормализованных (модель, системный промпт режима, последние реплики истории, вопрос).
+AI_CACHE_SIZE = int(os.getenv("AI_CACHE_SIZE") or 500)              # 0 — кэш выключен
+AI_CACHE_TTL_SEC = int(os.getenv("AI_CACHE_TTL_SEC") or 6 * 3600)
+AI_CACHE_HISTORY_MSGS = int(os.getenv("AI_CACHE_HISTORY_MSGS") or 2)  # сколько прошлых реплик входят в ключ
+# режимы ai_mode, для которых кэш включён ("consultant" — режим по умолчанию, '')
+AI_CACHE_MODES = {m.strip() for m in (os.getenv("AI_CACHE_MODES") or "consultant,universal,demo").split(",") if m.strip()}
+
+_WS_RE = re.compile(r"\s+")
+
+def _norm_cache_text(text: str) -> str:
+    return _WS_RE.sub(" ", (text or "").lower()).strip(" .!?…")
+
+class AICompletionCache:
+    def __init__(self, size: int = AI_CACHE_SIZE, ttl: int = AI_CACHE_TTL_SEC):
+        self.size = size
+        self.ttl = ttl
+        self._items: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0}
+
+    def enabled_for(self, mode: str) -> bool:
+        return self.size > 0 and (mode or "consultant") in AI_CACHE_MODES
+
+    @staticmethod
+    def key(mode: str, messages: List[Dict[str, str]]) -> str:
+        system = [m["content"] for m in messages[:1] if m.get("role") == "system"]
+        body = messages[len(system):]
+        history = body[:-1][-AI_CACHE_HISTORY_MSGS:] if AI_CACHE_HISTORY_MSGS > 0 else []
+        parts = [
+            OPENAI_MODEL,
+            mode or "consultant",
+            system[0] if system else "",
+            [(m.get("role"), _norm_cache_text(m.get("content"))) for m in history],
+            _norm_cache_text(body[-1].get("content") if body else ""),
+        ]
+        return hashlib.sha1(json.dumps(parts, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        item = self._items.get(key)
+        if item is not None and item[0] < time.monotonic():
+            del self._items[key]
+            self.stats["expired"] += 1
+            item = None
+        if item is None:
+            self.stats["misses"] += 1
+            return None
+        self._items.move_to_end(key)
+        self.stats["hits"] += 1
+        return item[1]
+
+    def put(self, key: str, text: str):
+        if self.size <= 0 or not text or text.startswith("⚠️"):
+            return  # ошибки и пустые ответы не кэшируем
+        self._items[key] = (time.monotonic() + self.ttl, text)
+        self._items.move_to_end(key)
+        self.stats["stores"] += 1
+        while len(self._items) > self.size:
+            self._items.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def clear(self):
+        self._items.clear()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+AI_CACHE = AICompletionCache()
+
+# === SINGLEFLIGHT ДЛЯ ИИ ===
+# Одинаковые вопросы, пришедшие одновременно (всплеск после рассылки/поста), ждут один
+# запрос к модели: первый ведёт вызов, остальные получают его ответ. В отличие от ключа кэша,
+# ключ — хэш всего запроса (модель, системный промпт, вся история, вопрос): общий ответ получают
+# только полностью одинаковые диалоги. Склеиваются лишь клиентские режимы из AI_CACHE_MODES —
+# в админке, настройке, бренде и т.п. ответ личный, даже если текст совпал.
+class AISingleFlight:
+    def __init__(self):
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.stats = {"leaders": 0, "coalesced": 0, "fallbacks": 0}
+
+    @staticmethod
+    def shareable(mode: str, is_admin: bool) -> bool:
+        return not is_admin and (mode or "consultant") in AI_CACHE_MODES
+
+    @staticmethod
+    def key(messages: List[Dict[str, str]]) -> str:
+        parts = [OPENAI_MODEL, [(m.get("role"), m.get("content")) for m in messages]]
+        return hashlib.sha1(json.dumps(parts, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def waiter(self, key: str) -> Optional[asyncio.Future]:
+        """Future идущего вызова с таким ключом (или None — вызова нет)."""
+        return self._inflight.get(key)
+
+    async def wait(self, fut: asyncio.Future) -> Optional[str]:
+        """Ответ ведущего; None — у него не вышло, нужно спросить модель самому."""
+        reply = await asyncio.shield(fut)  # отмена ожидающего не трогает ведущего
+        self.stats["coalesced" if reply is not None else "fallbacks"] += 1
+        return reply
+
+    @contextmanager
+    def lead(self, key: str):
+        """Вести вызов: ответ кладётся в flight["reply"]; без него ожидающие получат None."""
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        self.stats["leaders"] += 1
+        flight: Dict[str, Any] = {}
+        try:
+            yield flight
+        finally:
+            if self._inflight.get(key) is fut:
+                del self._inflight[key]
+            fut.set_result(flight.get("reply"))
+
+AI_FLIGHTS = AISingleFlight()
+
+# === ПЛАНИРОВЩИК ЗАПРОСОВ К ИИ ===
+# Не больше AI_MAX_CONCURRENCY одновременных вызовов модели; остальные ждут в очереди
+# по приоритету (админ → покупатели → бренд/оплата → демо). Очередь ограничена: когда она
+# полна, демо получает «занято» сразу, а платный запрос вытесняет самого дальнего из демо.
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY") or 8)
+AI_QUEUE_MAX = int(os.getenv("AI_QUEUE_MAX") or 50)
+AI_QUEUE_MAX_WAIT_SEC = float(os.getenv("AI_QUEUE_MAX_WAIT_SEC") or 30)
+
+AI_PRIO_ADMIN, AI_PRIO_BUYER, AI_PRIO_SALES, AI_PRIO_DEMO = range(4)
+AI_PRIO_NAMES = {AI_PRIO_ADMIN: "admin", AI_PRIO_BUYER: "buyer", AI_PRIO_SALES: "brand/pay", AI_PRIO_DEMO: "demo"}
+
+class AIBusy(Exception):
+    """Нет места в очереди к ИИ (или ожидание вышло за AI_QUEUE_MAX_WAIT_SEC)."""
+
+def _ai_priority(uid: int, is_admin: bool, verified: bool, ai_mode: str) -> int:
+    if is_admin or uid == ADMIN_ID:
+        return AI_PRIO_ADMIN
+    if verified:
+        return AI_PRIO_BUYER
+    if ai_mode in ("brand", "pay"):
+        return AI_PRIO_SALES
+    return AI_PRIO_DEMO
+
+class AIScheduler:
+    def __init__(self, limit: int = AI_MAX_CONCURRENCY, queue_max: int = AI_QUEUE_MAX,
+                 max_wait: float = AI_QUEUE_MAX_WAIT_SEC):
+        self.limit = max(1, limit)
+        self.queue_max = max(0, queue_max)
+        self.max_wait = max_wait
+        self.active = 0
+        self._heap: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = 0
+        self.stats = {"started": 0, "queued": 0, "busy": 0, "timeouts": 0, "evicted": 0,
+                      "max_depth": 0, "wait_total": 0.0, "wait_max": 0.0}
+
+    @property
+    def depth(self) -> int:
+        return sum(1 for *_, fut in self._heap if not fut.done())
+
+    def _evict_worse(self, prio: int) -> bool:
+        """Освободить место в очереди: выкинуть самого позднего из худшего класса (хуже prio)."""
+        victims = [item for item in self._heap if item[0] > prio and not item[2].done()]
+        if not victims:
+            return False
+        victim = max(victims)
+        victim[2].set_exception(AIBusy("вытеснен более приоритетным запросом"))
+        self._heap.remove(victim)
+        heapq.heapify(self._heap)
+        self.stats["evicted"] += 1
+        return True
+
+    def _release(self):
+        # слот передаётся лучшему ожидающему, иначе освобождается
+        while self._heap:
+            _, _, fut = heapq.heappop(self._heap)
+            if not fut.done():
+                fut.set_result(None)
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self, prio: int):
+        if self.active < self.limit and not self.depth:
+            self.active += 1
+        else:
+            if self.depth >= self.queue_max and (prio == AI_PRIO_DEMO or not self._evict_worse(prio)):
+                self.stats["busy"] += 1
+                raise AIBusy("очередь заполнена")
+            fut = asyncio.get_running_loop().create_future()
+            self._seq += 1
+            heapq.heappush(self._heap, (prio, self._seq, fut))
+            self.stats["queued"] += 1
+            self.stats["max_depth"] = max(self.stats["max_depth"], self.depth)
+            started = time.monotonic()
+            try:
+                await asyncio.wait_for(asyncio.shield(fut), self.max_wait)
+            except asyncio.TimeoutError:
+                if fut.done() and not fut.cancelled() and fut.exception() is None:
+                    self._release()  # слот успел прийти в момент таймаута — возвращаем
+                else:
+                    fut.cancel()
+                self.stats["timeouts"] += 1
+                raise AIBusy("ожидание в очереди истекло")
+            except asyncio.CancelledError:
+                if fut.done() and not fut.cancelled() and fut.exception() is None:
+                    self._release()
+                else:
+                    fut.cancel()
+                raise
+            waited = time.monotonic() - started
+            self.stats["wait_total"] += waited
+            self.stats["wait_max"] = max(self.stats["wait_max"], waited)
+        self.stats["started"] += 1
+        try:
+            yield
+        finally:
+            self._release()
+
+AI_SCHED = AIScheduler()
 
 # ---------------------------
 # ПРИМИТИВНАЯ «БАЗА ДАННЫХ» (JSON)
@@ -912,146 +2261,2238 @@ def _demo_today_str() -> str:
     return datetime.now().strftime("%Y-%m-%d")
 
 def _get_demo_stats(uid: int) -> Dict[str, Any]:
-    users = load_paid_users()
-    rec = users.get(str(uid)) or {}
-    demo = rec.get("demo_ai") or {"date": _demo_today_str(), "count": 0, "last_ts": 0}
-    return demo
+    rec = USERS.record(uid)
+    demo = (rec.demo_ai if rec else None) or {"date": _demo_today_str(), "count": 0, "last_ts": 0}
+    return dict(demo)
 
 def _save_demo_stats(uid: int, demo: Dict[str, Any]):
-    users = load_paid_users()
-    rec = users.get(str(uid)) or {}
-    rec["demo_ai"] = demo
-    users[str(uid)] = rec
-    save_users(users)
-
-def _demo_quota_ok(uid: int) -> Tuple[bool, str]:
-    if not DEMO_AI_ENABLED:
-        return False, "Демо-режим временно отключён."
-    demo = _get_demo_stats(uid)
-    # сброс по дате
-    if demo.get("date") != _demo_today_str():
-        demo["date"] = _demo_today_str()
-        demo["count"] = 0
-    # cooldown
-    now_ts = int(datetime.now().timestamp())
-    last_ts = int(demo.get("last_ts", 0))
-    if now_ts - last_ts < DEMO_AI_COOLDOWN_SEC:
-        return False, f"Подождите {DEMO_AI_COOLDOWN_SEC - (now_ts - last_ts)} сек. перед следующим вопросом."
-    # лимит в день
-    if int(demo.get("count", 0)) >= DEMO_AI_DAILY_LIMIT:
-        return False, f"Лимит в демо {DEMO_AI_DAILY_LIMIT}/день исчерпан. Оформите доступ, чтобы общаться без ограничений."
-    return True, ""
-
-def _demo_register_hit(uid: int):
-    demo = _get_demo_stats(uid)
-    if demo.get("date") != _demo_today_str():
-        demo["date"] = _demo_today_str()
-        demo["count"] = 0
-    demo["count"] = int(demo.get("count", 0)) + 1
-    demo["last_ts"] = int(datetime.now().timestamp())
-    _save_demo_stats(uid, demo)
+    rec = USERS.record(uid) or UserRecord(int(uid))
+    USERS.put_record(dataclass_replace(rec, demo_ai=demo))
+
+async def _demo_quota_ok(uid: int) -> Tuple[bool, str]:
+    return await DEMO_QUOTAS.acheck(uid)
+
+async def _demo_register_hit(uid: int):
+    await DEMO_QUOTAS.ahit(uid)
 
 def _atomic_write(path: str, data: dict):
     """Атомарная запись JSON (через tmp-файл)."""
-    tmp = path + ".tmp"
-    with open(tmp, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-    os.replace(tmp, path)
+    with _file_lock(path):
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, path)
+    _invalidate_json_cache(path)
+
+def _fsync_dir(path: str):
+    """fsync каталога файла path: переименования (os.replace) переживают падение питания."""
+    with suppress(OSError):
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+# ---------------------------
+# ХРАНИЛИЩЕ ПОЛЬЗОВАТЕЛЕЙ (выбор бэкенда: STORAGE_BACKEND=json|journal|sqlite|sharded)
+# ---------------------------
+# STORAGE_BACKEND и WEB_WORKERS выбираются выше, перед FSM-хранилищем.
+USERS_DB_FILE = os.getenv("USERS_DB_FILE") or os.path.join(DATA_DIR, "paid_users.sqlite3")
+USERS_SHARD_DIR = os.getenv("USERS_SHARD_DIR") or os.path.join(DATA_DIR, "users")
+USERS_SHARD_BUCKETS = int(os.getenv("USERS_SHARD_BUCKETS") or 256)
+USERS_FLUSH_DELAY_SEC = float(os.getenv("USERS_FLUSH_DELAY_SEC") or 2.0)
+# как часто (сек) чтения проверяют stat файла на внешнюю замену
+USERS_STAT_CHECK_SEC = float(os.getenv("USERS_STAT_CHECK_SEC") or 1.0)
+# сколько (мс) запрос к SQLite ждёт чужую транзакцию (другой воркер), прежде чем упасть с «database is locked»
+USERS_DB_BUSY_TIMEOUT_MS = int(os.getenv("USERS_DB_BUSY_TIMEOUT_MS") or 1000)
+
+def _purchase_sort_key(item: Tuple[int, Dict[str, Any]]):
+    """Порядок админ-списков: сначала verified, внутри — свежие покупки выше."""
+    _, rec = item
+    return (bool(rec.get("verified")), rec.get("purchase_date") or "")
+
+# --- типизированная запись пользователя ---
+PURCHASE_DATE_FMT = "%Y-%m-%d %H:%M:%S"
+_USER_BASE_FIELDS = ("username", "verified", "purchase_date", "cache", "demo_ai")
+
+def _intern_username(name) -> str:
+    """Одинаковые ники (и 'unknown') в памяти — один объект строки."""
+    return sys.intern(str(name)) if name else "unknown"
+
+def _as_bool(v) -> bool:
+    if isinstance(v, str):
+        return v.strip().lower() in ("1", "true", "yes")
+    return bool(v)
+
+@dataclass(slots=True)
+class UserRecord:
+    """
+    Запись пользователя в памяти: __slots__ вместо словаря на каждого,
+    int-ключ, время покупки — epoch. На диске формат прежний (to_dict/from_dict):
+    {"username", "verified", "purchase_date": "YYYY-mm-dd HH:MM:SS", "cache", "demo_ai", ...}.
+    """
+    id: int
+    username: str = "unknown"
+    verified: bool = False
+    purchased_at: Optional[float] = None       # epoch, сек
+    cache: Optional[Dict[str, str]] = None      # file_id по ключу материала
+    demo_ai: Optional[Dict[str, Any]] = None
+    extra: Optional[Dict[str, Any]] = None      # прочие ключи — сохраняются как есть
+
+    @property
+    def purchase_date(self) -> Optional[str]:
+        if self.purchased_at is None:
+            return None
+        return datetime.fromtimestamp(self.purchased_at).strftime(PURCHASE_DATE_FMT)
+
+    @classmethod
+    def from_dict(cls, user_id, d: Optional[Dict[str, Any]]) -> "UserRecord":
+        d = d if isinstance(d, dict) else {}
+        extra: Optional[Dict[str, Any]] = None
+        purchased_at = None
+        pd = d.get("purchase_date")
+        if isinstance(pd, (int, float)) and not isinstance(pd, bool):
+            purchased_at = float(pd)
+        elif isinstance(pd, str) and pd:
+            try:
+                purchased_at = datetime.strptime(pd[:19], PURCHASE_DATE_FMT).timestamp()
+            except ValueError:
+                extra = {"purchase_date_raw": pd}
+        raw_cache = d.get("cache")
+        cache = {str(k): v for k, v in raw_cache.items() if v} if isinstance(raw_cache, dict) else {}
+        for k, v in d.items():
+            if k in _USER_BASE_FIELDS:
+                continue
+            if k.endswith("_file_id") and isinstance(v, str):
+                cache.setdefault(k, v)  # старый формат: file_id прямо в записи
+                continue
+            if extra is None:
+                extra = {}
+            extra[k] = v
+        demo = d.get("demo_ai")
+        return cls(
+            id=int(user_id),
+            username=_intern_username(d.get("username")),
+            verified=_as_bool(d.get("verified")),
+            purchased_at=purchased_at,
+            cache=cache or None,
+            demo_ai=demo if isinstance(demo, dict) else None,
+            extra=extra,
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        d: Dict[str, Any] = dict(self.extra) if self.extra else {}
+        d["username"] = self.username
+        d["verified"] = self.verified
+        d["purchase_date"] = self.purchase_date
+        d["cache"] = dict(self.cache) if self.cache else {}
+        if self.demo_ai is not None:
+            d["demo_ai"] = dict(self.demo_ai)
+        return d
+
+def _records_from_json(raw) -> Tuple[Dict[int, UserRecord], List[int]]:
+    """
+    {str(uid): dict} → {uid: UserRecord} + id записей, которые при этом поменялись
+    (миграция: file_id из корня записи → cache, verified строкой → bool и т.п.).
+    Записи с нечисловым ключом отбрасываются.
+    """
+    data: Dict[int, UserRecord] = {}
+    migrated: List[int] = []
+    for uid, d in (raw.items() if isinstance(raw, dict) else []):
+        try:
+            rec = UserRecord.from_dict(uid, d)
+        except (TypeError, ValueError):
+            logging.warning("[USERS] skip record with bad id %r", uid)
+            continue
+        data[rec.id] = rec
+        if rec.to_dict() != d:
+            migrated.append(rec.id)
+    return data, migrated
+
+def _merge_user_dicts(base: Optional[Dict[str, Any]], mine: Optional[Dict[str, Any]],
+                      disk: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    Трёхстороннее слияние записи (base — версия, от которой мы начинали менять, mine — наша,
+    disk — записанная другим процессом): на disk накладываются только поля, изменённые
+    у нас относительно base; cache — по ключам. None — записи нет; удаление
+    (своё или чужое) главнее правки.
+    """
+    if mine is None:
+        return None if base is not None else disk  # удалили у себя; создали и удалили — как на диске
+    if disk is None:
+        return mine if base is None else None  # новая у нас — пишем; удалена другим — не воскрешаем
+    base = base or {}
+    out = dict(disk)
+    for key in set(mine) | set(base):
+        if key == "cache":
+            mc, bc = mine.get("cache") or {}, base.get("cache") or {}
+            cache = dict(disk.get("cache") or {})
+            for k in set(mc) | set(bc):
+                if mc.get(k) != bc.get(k):
+                    if k in mc:
+                        cache[k] = mc[k]
+                    else:
+                        cache.pop(k, None)
+            out["cache"] = cache
+        elif mine.get(key) != base.get(key) or (key in mine) != (key in base):
+            if key in mine:
+                out[key] = mine[key]
+            else:
+                out.pop(key, None)
+    return out
+
+def _record_sort_key(rec: UserRecord):
+    return (rec.verified, rec.purchased_at or 0.0)
+
+class UserRepository(abc.ABC):
+    """
+    Общий интерфейс хранилища пользователей.
+    get()/put() работают со словарями вида {"username", "verified", "purchase_date", "cache", ...},
+    record()/put_record() — с UserRecord; ключ — user_id. Полученную запись
+    после изменения нужно вернуть через put()/put_record().
+    Запросы для админки (count/page/ids) по умолчанию делаются перебором all();
+    бэкенды с индексами переопределяют их.
+    blocking_io — чтения идут на диск (SQLite): из хэндлеров их зовут через users_read().
+    all/get/put/remove/replace — абстрактные: бэкенд без них не создастся.
+    """
+
+    blocking_io = False
+
+    @abc.abstractmethod
+    def all(self) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get(self, user_id) -> Optional[Dict[str, Any]]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def put(self, user_id, rec: Dict[str, Any]):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def remove(self, user_id) -> bool:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def replace(self, users: Dict[str, Any]):
+        raise NotImplementedError
+
+    def touch(self):
+        pass
+
+    def reload(self):
+        pass
+
+    def record(self, user_id) -> Optional[UserRecord]:
+        rec = self.get(user_id)
+        return UserRecord.from_dict(user_id, rec) if rec is not None else None
+
+    def put_record(self, rec: UserRecord):
+        self.put(rec.id, rec.to_dict())
+
+    def records(self) -> List[UserRecord]:
+        return [UserRecord.from_dict(uid, rec) for uid, rec in self._items()]
+
+    # --- пакетная фиксация (актор записи) ---
+    _batch_depth = 0
+    _loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def bind_loop(self, loop: asyncio.AbstractEventLoop):
+        """Loop, где планируется фоновая запись, когда изменения приходят из потока актора."""
+        self._loop = loop
+
+    def _defer_to_loop(self, fn) -> bool:
+        """
+        Вызов вне event loop: если репозиторий привязан к loop (команды актора идут
+        в пуле I/O), fn уходит туда — True; False — loop'а нет (CLI), работу делать сразу.
+        """
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return False
+        try:
+            loop.call_soon_threadsafe(fn)
+        except RuntimeError:
+            return False
+        return True
+
+    @contextmanager
+    def batch(self):
+        """Группа изменений с одной фиксацией на диск в конце."""
+        if self._batch_depth == 0:
+            self._begin_batch()
+        self._batch_depth += 1
+        ok = False
+        try:
+            yield self
+            ok = True
+        finally:
+            self._batch_depth -= 1
+            if self._batch_depth == 0:
+                self._end_batch(ok)
+
+    def _begin_batch(self):
+        pass
+
+    def _end_batch(self, ok: bool):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+    # --- изменения с прошлого бэкапа (дельта хэширует только их) ---
+    # {uid: счётчик правок}; None — набор неизвестен (рестарт, замена базы) → полный обход
+    _backup_changed: Optional[Dict[int, int]] = None
+    _backup_lock = threading.Lock()
+
+    def _note_backup(self, user_id):
+        with self._backup_lock:
+            if self._backup_changed is not None:
+                uid = int(user_id)
+                self._backup_changed[uid] = self._backup_changed.get(uid, 0) + 1
+
+    def backup_reset(self):
+        """Набор изменений неизвестен: следующий бэкап сделает полный обход."""
+        with self._backup_lock:
+            self._backup_changed = None
+
+    def backup_changes(self) -> Optional[Dict[int, int]]:
+        """
+        Копия {uid: счётчик} изменённых с прошлого бэкапа. None — набор неизвестен:
+        нужен полный обход, отслеживание начинается с этого момента.
+        """
+        with self._backup_lock:
+            if self._backup_changed is None:
+                self._backup_changed = {}
+                return None
+            return dict(self._backup_changed)
+
+    def backup_done(self, taken: Optional[Dict[int, int]]):
+        """Бэкап записал taken: убираем их, кроме изменённых повторно за время бэкапа."""
+        with self._backup_lock:
+            if not taken or self._backup_changed is None:
+                return
+            for uid, n in taken.items():
+                if self._backup_changed.get(uid) == n:
+                    del self._backup_changed[uid]
+
+    # --- запросы для админки ---
+    def _items(self, verified_only: bool = False) -> List[Tuple[int, Dict[str, Any]]]:
+        items = []
+        for uid, rec in self.all().items():
+            if not isinstance(rec, dict):
+                continue
+            if verified_only and not rec.get("verified"):
+                continue
+            try:
+                items.append((int(uid), rec))
+            except Exception:
+                continue
+        return items
+
+    def count(self, verified_only: bool = False) -> int:
+        return len(self._items(verified_only))
+
+    def page(self, offset: int = 0, limit: Optional[int] = None,
+             verified_only: bool = False) -> List[Tuple[int, Dict[str, Any]]]:
+        """[(user_id, rec)] в порядке _purchase_sort_key (по убыванию)."""
+        items = sorted(self._items(verified_only), key=_purchase_sort_key, reverse=True)
+        end = None if limit is None else offset + limit
+        return items[offset:end]
+
+    def ids(self, verified_only: bool = False) -> List[int]:
+        return [uid for uid, _ in self._items(verified_only)]
+
+    # --- персональный кэш file_id ---
+    def get_file_id(self, user_id, cache_key: str) -> Optional[str]:
+        rec = self.get(user_id) or {}
+        return (rec.get("cache") or {}).get(cache_key) or None
+
+    def set_file_id(self, user_id, cache_key: str, file_id: str):
+        rec = self.get(user_id) or {}
+        rec.setdefault("cache", {})
+        rec["cache"][cache_key] = file_id
+        self.put(user_id, rec)
+
+
+class JsonUserRepository(UserRepository):
+    """
+    Процесс-глобальное хранилище paid_users.json.
+    - файл читается один раз в {uid: UserRecord}, дальше все чтения идут из памяти;
+      записи в старом формате мигрируют при загрузке и переписываются при ближайшей записи;
+    - изменения помечают базу «грязной», запись на диск откладывается на
+      USERS_FLUSH_DELAY_SEC и склеивает все изменения за это окно в одну;
+    - запись атомарная (tmp-файл + os.replace); под локом берётся только копия
+      списка записей, json.dumps и запись идут в фоновом потоке;
+    - flush() — принудительная синхронная запись (on_shutdown, бэкап).
+    get() отдаёт копию-словарь, record() — живой UserRecord (менять только через put_record()).
+    Если файл заменили снаружи (stat изменился), а несохранённых изменений нет —
+    данные перечитываются при следующем обращении; stat проверяется не чаще
+    раза в USERS_STAT_CHECK_SEC, а не на каждом get(). Запись идёт под _file_lock;
+    если файл успел записать другой процесс (воркер), под той же блокировкой
+    перечитывается его версия и на неё накладываются только поля, изменённые у нас
+    (_base — версия записи до наших изменений, слияние — _merge_user_dicts): оплата
+    в одном воркере и обновление кэша той же записи в другом не теряют друг друга.
+    """
+
+    _validate_stamp = True
+
+    def __init__(self, path: str, flush_delay: float = USERS_FLUSH_DELAY_SEC):
+        self.path = path
+        self.flush_delay = max(0.0, flush_delay)
+        self._data: Optional[Dict[int, UserRecord]] = None
+        self._stamp: Optional[Tuple[int, int, int]] = None
+        self._stat_at = 0.0        # monotonic последней проверки stat
+        self._dirty = False
+        self._seq = 0              # номер последнего изменения
+        self._written_seq = 0      # номер изменения, уже лежащего на диске
+        self._lock = threading.RLock()
+        self._io_lock = threading.Lock()
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._migrated: List[int] = []
+        self._changed_ids: set = set()    # uid, изменённые после последнего снапшота
+        self._base: Dict[int, Optional[Dict[str, Any]]] = {}  # uid → версия до наших изменений (для слияния)
+        self._full_write = False          # replace/touch: файл переписывается целиком
+
+    # --- чтение ---
+    def _read_raw(self) -> Dict[str, Any]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            return data if isinstance(data, dict) else {}
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logging.warning("[USERS] read failed for %s: %s", self.path, e)
+            return {}
+
+    def _read_file(self) -> Dict[int, UserRecord]:
+        data, migrated = _records_from_json(self._read_raw())
+        self._migrated = migrated
+        return data
+
+    def _is_stale(self) -> bool:
+        """Файл изменён не нами и в памяти нет несохранённых изменений."""
+        if not self._validate_stamp or self._dirty or self._written_seq < self._seq:
+            return False
+        now = time.monotonic()
+        if now - self._stat_at < USERS_STAT_CHECK_SEC:
+            return False
+        if _file_stamp(self.path) != self._stamp:
+            return True  # _stat_at не двигаем: повторная проверка под локом тоже должна увидеть замену
+        self._stat_at = now
+        return False
+
+    def _ensure_loaded(self) -> Dict[int, UserRecord]:
+        data = self._data
+        if data is None or self._is_stale():
+            with self._lock:
+                if self._data is None or self._is_stale():
+                    self._stamp = _file_stamp(self.path)
+                    self._stat_at = time.monotonic()
+                    self._migrated = []
+                    self._data = self._read_file()
+                    self.backup_reset()  # перечитали файл: что изменилось — неизвестно
+                    logging.info("[USERS] loaded %s records from %s", len(self._data), self.path)
+                    if self._migrated:
+                        logging.info("[USERS] migrated %s records to the current format", len(self._migrated))
+                        self._persist_migrated(self._migrated)
+                data = self._data
+        return data
+
+    def _persist_migrated(self, uids: List[int]):
+        # только помечаем: запишется с ближайшим flush, не изнутри загрузки
+        self._changed_ids.update(uids)
+        self._dirty = True
+        self._seq += 1
+
+    @staticmethod
+    def _uid(user_id) -> Optional[int]:
+        try:
+            return int(user_id)
+        except (TypeError, ValueError):
+            return None
+
+    def all(self) -> Dict[str, Any]:
+        """Копия всей базы в формате файла {str(uid): dict}."""
+        with self._lock:
+            return {str(uid): rec.to_dict() for uid, rec in self._ensure_loaded().items()}
+
+    def get(self, user_id) -> Optional[Dict[str, Any]]:
+        rec = self.record(user_id)
+        return rec.to_dict() if rec is not None else None
+
+    def record(self, user_id) -> Optional[UserRecord]:
+        return self._ensure_loaded().get(self._uid(user_id))
+
+    def records(self) -> List[UserRecord]:
+        with self._lock:
+            return list(self._ensure_loaded().values())
+
+    # --- изменения ---
+    def put(self, user_id, rec: Dict[str, Any]):
+        self.put_record(UserRecord.from_dict(user_id, rec))
+
+    def _remember_base(self, data: Dict[int, UserRecord], uid: int):
+        if self._validate_stamp and uid not in self._base:
+            old = data.get(uid)
+            self._base[uid] = old.to_dict() if old is not None else None
+
+    def put_record(self, rec: UserRecord):
+        with self._lock:
+            data = self._ensure_loaded()
+            self._remember_base(data, rec.id)
+            data[rec.id] = rec
+            self._changed_ids.add(rec.id)
+            self._note_backup(rec.id)
+            self._mark_dirty()
+
+    def remove(self, user_id) -> bool:
+        with self._lock:
+            data = self._ensure_loaded()
+            uid = self._uid(user_id)
+            if uid not in data:
+                return False
+            self._remember_base(data, uid)
+            del data[uid]
+            self._changed_ids.add(uid)
+            self._note_backup(uid)
+            self._mark_dirty()
+            return True
+
+    def replace(self, users: Dict[str, Any]):
+        data, _ = _records_from_json(users)  # разбор — до лока: чтения из loop его не ждут
+        with self._lock:
+            self._data = data
+            self._base = {}  # файл перепишется целиком, сливать нечего
+            self._full_write = True
+            self.backup_reset()
+            self._mark_dirty()
+
+    def touch(self):
+        """Отметить живой словарь изменённым (после мутаций на месте)."""
+        with self._lock:
+            self._ensure_loaded()
+            self._full_write = True
+            self.backup_reset()
+            self._mark_dirty()
+
+    def reload(self):
+        """Сбросить память и перечитать файл (после внешней замены, напр. restore)."""
+        with self._lock:
+            self._cancel_scheduled()
+            self._data = None
+            self._dirty = False
+            self._changed_ids = set()
+            self._base = {}
+            self._full_write = False
+            self._written_seq = self._seq
+        self._ensure_loaded()
+
+    # --- запись ---
+    def _mark_dirty(self):
+        self._dirty = True
+        self._seq += 1
+        self._schedule_flush()
+
+    def _cancel_scheduled(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+    def _end_batch(self, ok: bool):
+        if self._dirty:
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._batch_depth:
+            return  # запись запланируем один раз в конце пакета
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # из потока актора — планируем в его event loop; вне loop (CLI, скрипты) — пишем сразу
+            if not self._defer_to_loop(self._schedule_flush):
+                self.flush()
+            return
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.flush_delay, self._flush_in_background)
+
+    @staticmethod
+    def _dump_records(records: List[UserRecord]) -> str:
+        return json.dumps({str(rec.id): rec.to_dict() for rec in records}, ensure_ascii=False, indent=2)
+
+    def _dump(self) -> str:
+        """Вся база в формате файла; вызывать под self._lock."""
+        return self._dump_records(list(self._ensure_loaded().values()))
+
+    def _snapshot(self) -> Tuple[int, Any]:
+        """
+        Под локом — только копия списка записей: записи не меняются на месте
+        (put_record кладёт новый объект), поэтому json.dumps можно делать в потоке записи.
+        """
+        with self._lock:
+            data = self._ensure_loaded()
+            changes = {uid: (data[uid].to_dict() if uid in data else None) for uid in self._changed_ids}
+            bases = {uid: self._base.pop(uid) for uid in list(self._changed_ids) if uid in self._base}
+            payload = (list(data.values()), changes, bases, self._full_write)
+            self._changed_ids = set()
+            self._full_write = False
+            self._dirty = False
+            return self._seq, payload
+
+    def _merge_external(self, changes: Dict[int, Optional[Dict[str, Any]]],
+                        bases: Dict[int, Optional[Dict[str, Any]]]) -> str:
+        """
+        Файл записал другой процесс (вызывается под _file_lock): перечитываем его версию,
+        накладываем свои изменения по полям и подхватываем чужие записи в память
+        (кроме изменённых у нас после снапшота).
+        """
+        raw = self._read_raw()
+        for uid, mine in changes.items():
+            # без base (миграция формата при загрузке) — своих правок нет, верна версия диска
+            d = _merge_user_dicts(bases.get(uid, mine), mine, raw.get(str(uid)))
+            if d is None:
+                raw.pop(str(uid), None)
+            else:
+                raw[str(uid)] = d
+        merged, _ = _records_from_json(raw)
+        with self._lock:
+            if not self._full_write and self._data is not None:
+                for uid in self._changed_ids:
+                    if uid in self._data:
+                        merged[uid] = self._data[uid]
+                    else:
+                        merged.pop(uid, None)
+                self._data = merged
+                self.backup_reset()  # в памяти чужие записи
+            logging.info("[USERS] merged own %s changes over external write of %s", len(changes), self.path)
+            return json.dumps({str(uid): rec.to_dict() for uid, rec in merged.items()}, ensure_ascii=False, indent=2)
+
+    def _write_payload(self, seq: int, payload: Any):
+        records, changes, bases, full = payload
+        with self._io_lock, _file_lock(self.path):
+            if seq <= self._written_seq:
+                return  # на диске уже более свежая версия
+            try:
+                if self._validate_stamp and not full and _file_stamp(self.path) != self._stamp:
+                    text = self._merge_external(changes, bases)
+                else:
+                    text = self._dump_records(records)
+                tmp = self.path + ".tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    f.write(text)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp, self.path)
+            except Exception:
+                with self._lock:  # повторная запись должна снова знать, что мы меняли
+                    self._changed_ids.update(changes)
+                    self._base.update(bases)  # более старая база главнее записанной после снапшота
+                    self._full_write = self._full_write or full
+                raise
+            self._stamp = _file_stamp(self.path)
+            self._stat_at = time.monotonic()
+            self._written_seq = seq
+
+    def _flush_in_background(self):
+        self._flush_handle = None
+        if not self._dirty:
+            return
+        seq, payload = self._snapshot()
+        loop = asyncio.get_running_loop()
+        fut = loop.run_in_executor(_IO_POOL, self._write_payload, seq, payload)
+
+        def _done(f: asyncio.Future):
+            exc = f.exception()
+            if exc is not None:
+                logging.warning("[USERS] background flush failed: %s", exc)
+                with self._lock:
+                    self._dirty = True
+                    self._schedule_flush()
+
+        fut.add_done_callback(_done)
+
+    def flush(self):
+        """Синхронно сбросить все изменения на диск."""
+        with self._lock:
+            self._cancel_scheduled()
+            if not self._dirty and self._written_seq >= self._seq:
+                return
+            seq, payload = self._snapshot()
+        self._write_payload(seq, payload)
+
+    # --- запросы по записям в памяти (без конвертации в dict) ---
+    def _select(self, verified_only: bool) -> List[UserRecord]:
+        recs = self.records()
+        return [r for r in recs if r.verified] if verified_only else recs
+
+    def count(self, verified_only: bool = False) -> int:
+        if not verified_only:
+            return len(self._ensure_loaded())
+        return sum(1 for r in self.records() if r.verified)
+
+    def page(self, offset: int = 0, limit: Optional[int] = None,
+             verified_only: bool = False) -> List[Tuple[int, Dict[str, Any]]]:
+        recs = sorted(self._select(verified_only), key=_record_sort_key, reverse=True)
+        end = None if limit is None else offset + limit
+        return [(r.id, r.to_dict()) for r in recs[offset:end]]
+
+    def ids(self, verified_only: bool = False) -> List[int]:
+        return [r.id for r in self._select(verified_only)]
+
+    def get_file_id(self, user_id, cache_key: str) -> Optional[str]:
+        rec = self.record(user_id)
+        return (rec.cache or {}).get(cache_key) if rec is not None else None
+
+    def set_file_id(self, user_id, cache_key: str, file_id: str):
+        with self._lock:
+            rec = self.record(user_id) or UserRecord(int(user_id))
+            # новый объект, а не правка живого: его может сериализовать поток записи
+            self.put_record(dataclass_replace(rec, cache={**(rec.cache or {}), cache_key: file_id}))
+
+
+JOURNAL_FSYNC_DELAY_SEC = float(os.getenv("JOURNAL_FSYNC_DELAY_SEC") or 0.2)
+JOURNAL_COMPACT_BYTES = int(os.getenv("JOURNAL_COMPACT_BYTES") or 4 * 1024 * 1024)
+
+class JournalUserRepository(JsonUserRepository):
+    """
+    Журнальный режим (STORAGE_BACKEND=journal) поверх paid_users.json.
+    - каждое изменение (put/remove) — одна JSON-строка в paid_users.json.journal,
+      строки копятся JOURNAL_FSYNC_DELAY_SEC и пишутся пачкой с одним fsync;
+    - на старте состояние = снапшот (paid_users.json) + проигрывание журнала;
+    - когда журнал больше JOURNAL_COMPACT_BYTES, фоном пишется свежий снапшот
+      и журнал обнуляется (компакция); падение посреди компакции разбирается
+      при загрузке (_recover_compaction), старый журнал поверх нового снапшота не проигрывается.
+    Стоимость записи — O(размер записи), а не O(число пользователей).
+    """
+
+    _validate_stamp = False  # снапшот и журнал принадлежат только этому процессу
+
+    def __init__(self, path: str, flush_delay: float = JOURNAL_FSYNC_DELAY_SEC,
+                 compact_bytes: int = JOURNAL_COMPACT_BYTES):
+        super().__init__(path, flush_delay=flush_delay)
+        self.journal_path = path + ".journal"
+        self.compact_bytes = max(64 * 1024, compact_bytes)
+        self._pending: List[str] = []
+        self._journal_size = 0
+        self._compacting = False
+        self._compact_again = False
+
+    @property
+    def _compact_tmp(self) -> str:
+        return self.path + ".compact"
+
+    @property
+    def _old_journal(self) -> str:
+        return self.journal_path + ".old"
+
+    def _recover_compaction(self):
+        """
+        Довести компакцию, прерванную падением (порядок шагов — в _compact):
+        .compact + .old — снапшот дописан, но не поставлен: ставим его, .old не нужен;
+        только .old — снапшот уже на месте: старый журнал не проигрываем;
+        только .compact — журнал не ротирован, снапшот мог не дописаться: выбрасываем.
+        """
+        tmp, old = os.path.exists(self._compact_tmp), os.path.exists(self._old_journal)
+        if not (tmp or old):
+            return
+        if tmp and old:
+            os.replace(self._compact_tmp, self.path)
+        elif tmp:
+            os.remove(self._compact_tmp)
+        if old:
+            os.remove(self._old_journal)
+        _fsync_dir(self.path)
+        logging.warning("[USERS] recovered interrupted journal compaction (snapshot %s)",
+                        "installed" if tmp and old else "kept")
+
+    # --- чтение: снапшот + журнал ---
+    def _read_file(self) -> Dict[int, UserRecord]:
+        self._recover_compaction()
+        data = super()._read_file()
+        replayed = 0
+        try:
+            with open(self.journal_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        ev = json.loads(line)
+                        op, uid = ev.get("op"), int(ev.get("uid"))
+                    except Exception:
+                        continue  # хвост, недописанный при падении
+                    if op == "put" and isinstance(ev.get("rec"), dict):
+                        data[uid] = UserRecord.from_dict(uid, ev["rec"])
+                    elif op == "del":
+                        data.pop(uid, None)
+                    replayed += 1
+            self._journal_size = os.path.getsize(self.journal_path)
+        except FileNotFoundError:
+            self._journal_size = 0
+        if replayed:
+            logging.info("[USERS] replayed %s journal events from %s", replayed, self.journal_path)
+        return data
+
+    # --- изменения ---
+    def _append(self, event: Dict[str, Any]):
+        self._pending.append(json.dumps(event, ensure_ascii=False) + "\n")
+        self._seq += 1
+        self._schedule_flush()
+
+    def _end_batch(self, ok: bool):
+        if self._pending:
+            self._schedule_flush()
+
+    def _persist_migrated(self, uids: List[int]):
+        for uid in uids:
+            rec = self._data[uid].to_dict()
+            self._pending.append(json.dumps({"op": "put", "uid": str(uid), "rec": rec}, ensure_ascii=False) + "\n")
+            self._seq += 1
+
+    def put_record(self, rec: UserRecord):
+        with self._lock:
+            self._ensure_loaded()[rec.id] = rec
+            self._note_backup(rec.id)
+            self._append({"op": "put", "uid": str(rec.id), "rec": rec.to_dict()})
+
+    def remove(self, user_id) -> bool:
+        with self._lock:
+            data = self._ensure_loaded()
+            uid = self._uid(user_id)
+            if data.pop(uid, None) is None:
+                return False
+            self._note_backup(uid)
+            self._append({"op": "del", "uid": str(uid)})
+            return True
+
+    def replace(self, users: Dict[str, Any]):
+        data, _ = _records_from_json(users)
+        with self._lock:
+            self._data = data
+            self._dirty = True
+            self.backup_reset()
+        self._schedule_compact()
+
+    def touch(self):
+        # неизвестно, что поменяли на месте, — фиксируем полным снапшотом
+        with self._lock:
+            self._ensure_loaded()
+            self._dirty = True
+            self.backup_reset()
+        self._schedule_compact()
+
+    def reload(self):
+        with self._lock:
+            self._cancel_scheduled()
+            self._pending.clear()
+            self._data = None
+            self._dirty = False
+        self._ensure_loaded()
+
+    # --- запись журнала ---
+    def _write_journal(self):
+        with self._io_lock:
+            with self._lock:
+                lines, self._pending = self._pending, []
+            if not lines:
+                return
+            chunk = "".join(lines)
+            with open(self.journal_path, "a", encoding="utf-8") as f:
+                f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            self._journal_size += len(chunk.encode("utf-8"))
+
+    def _compact(self):
+        """
+        Свежий снапшот + пустой журнал. Изменения, пришедшие во время записи, остаются в буфере.
+        Шаги: снапшот целиком в .compact (fsync) → журнал переименовывается в .old →
+        .compact ставится на место снапшота → .old удаляется. Переименования атомарны,
+        поэтому по набору файлов после падения однозначно видно, какой снапшот главный.
+        """
+        with self._io_lock:
+            with self._lock:
+                records = list(self._ensure_loaded().values())
+                self._pending.clear()  # всё уже входит в снапшот
+                self._dirty = False
+            try:
+                payload = self._dump_records(records)
+                with open(self._compact_tmp, "w", encoding="utf-8") as f:
+                    f.write(payload)
+                    f.flush()
+                    os.fsync(f.fileno())
+                # с этого момента .compact полон и главнее журнала на диске
+                if os.path.exists(self.journal_path):
+                    os.replace(self.journal_path, self._old_journal)
+                _fsync_dir(self.path)
+                os.replace(self._compact_tmp, self.path)
+                _fsync_dir(self.path)
+            except Exception:
+                self._dirty = True  # буфер уже очищен — снапшот нужно повторить
+                raise
+            with suppress(FileNotFoundError):
+                os.remove(self._old_journal)
+            self._journal_size = 0
+        logging.info("[USERS] journal compacted into %s", self.path)
+
+    def _schedule_compact(self):
+        """
+        Компакция в пуле I/O, а не в обработчике. Пока она не прошла, снапшот
+        в памяти помечен _dirty, и flush() (shutdown) допишет его синхронно.
+        Из потока актора — планируется в event loop, вне loop (CLI) — сразу.
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            if not self._defer_to_loop(self._schedule_compact):
+                self._compact()
+            return
+        if self._compacting:
+            self._compact_again = True  # текущая могла взять снапшот до нашего изменения
+            return
+        self._compacting = True
+        self._compact_again = False
+        comp = loop.run_in_executor(_IO_POOL, self._compact)
+
+        def _compacted(c: asyncio.Future):
+            self._compacting = False
+            if c.exception() is not None:
+                logging.warning("[USERS] journal compaction failed: %s", c.exception())
+                loop.call_later(max(1.0, self.flush_delay), self._schedule_compact)
+            elif self._compact_again:
+                self._schedule_compact()
+
+        comp.add_done_callback(_compacted)
+
+    def _flush_in_background(self):
+        self._flush_handle = None
+        loop = asyncio.get_running_loop()
+        fut = loop.run_in_executor(_IO_POOL, self._write_journal)
+
+        def _done(f: asyncio.Future):
+            exc = f.exception()
+            if exc is not None:
+                logging.warning("[USERS] journal write failed: %s", exc)
+                return
+            if self._journal_size >= self.compact_bytes and not self._compacting:
+                self._schedule_compact()
+
+        fut.add_done_callback(_done)
+
+    def flush(self):
+        with self._lock:
+            self._cancel_scheduled()
+            full = self._dirty
+        if full:
+            self._compact()  # replace/touch, чья фоновая компакция ещё не прошла
+        self._write_journal()
+
+
+class ShardedUserRepository(JsonUserRepository):
+    """
+    Пользователи по корзинам (STORAGE_BACKEND=sharded): USERS_SHARD_DIR/bucket_XX.json,
+    корзина = uid % USERS_SHARD_BUCKETS, рядом verified.json — индекс подтверждённых.
+    - в памяти та же {uid: UserRecord}, что и у json-режима;
+    - изменение помечает «грязной» только свою корзину: flush переписывает
+      один маленький файл (+ индекс, если поменялся набор verified), а не всю базу;
+    - состав корзин (bucket → uid) держится в памяти, так что снапшот берёт под
+      локом только записи грязных корзин, а json.dumps идёт в потоке записи;
+    - если каталога ещё нет, а рядом лежит paid_users.json — он раскладывается
+      по корзинам при первой загрузке (исходный файл не трогаем).
+    """
+
+    _validate_stamp = False
+    INDEX_NAME = "verified.json"
+
+    def __init__(self, shard_dir: str, buckets: int = USERS_SHARD_BUCKETS,
+                 import_from: Optional[str] = None, flush_delay: float = USERS_FLUSH_DELAY_SEC):
+        super().__init__(shard_dir, flush_delay=flush_delay)
+        self.dir = shard_dir
+        self.buckets = max(1, buckets)
+        self.import_from = import_from
+        self._dirty_buckets: set = set()
+        self._members: Dict[int, set] = {}      # bucket → uid в нём
+        self._bucket_seq: Dict[int, int] = {}   # последний записанный seq по корзине
+        self._verified: set = set()
+        self._index_dirty = False
+        self._index_seq = 0
+
+    def bucket_of(self, user_id: int) -> int:
+        return int(user_id) % self.buckets
+
+    def bucket_path(self, bucket: int) -> str:
+        return os.path.join(self.dir, f"bucket_{bucket:02x}.json")
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.dir, self.INDEX_NAME)
+
+    def files(self) -> List[str]:
+        """Файлы раскладки на диске (для бэкапа)."""
+        if not os.path.isdir(self.dir):
+            return []
+        return sorted(
+            os.path.join(self.dir, n) for n in os.listdir(self.dir)
+            if n.endswith(".json") and (n.startswith("bucket_") or n == self.INDEX_NAME)
+        )
+
+    # --- чтение ---
+    def _read_file(self) -> Dict[int, UserRecord]:
+        if not os.path.isdir(self.dir) and self.import_from and os.path.exists(self.import_from):
+            data, _ = _records_from_json(_read_json_safe(self.import_from))
+            self._migrated = list(data)
+            logging.info("[USERS] splitting %s into %s buckets under %s", self.import_from, self.buckets, self.dir)
+        else:
+            raw: Dict[str, Any] = {}
+            for path in self.files():
+                if os.path.basename(path) == self.INDEX_NAME:
+                    continue
+                try:
+                    with open(path, "r", encoding="utf-8") as f:
+                        chunk = json.load(f)
+                    if isinstance(chunk, dict):
+                        raw.update(chunk)
+                except Exception as e:
+                    logging.warning("[USERS] bucket read failed for %s: %s", path, e)
+            data, self._migrated = _records_from_json(raw)
+        self._verified = {uid for uid, rec in data.items() if rec.verified}
+        self._index_members(data)
+        self._index_dirty = not os.path.exists(self.index_path)
+        return data
+
+    def _index_members(self, data: Dict[int, UserRecord]):
+        self._members = {}
+        for uid in data:
+            self._members.setdefault(self.bucket_of(uid), set()).add(uid)
+
+    def _persist_migrated(self, uids: List[int]):
+        self._dirty_buckets.update(self.bucket_of(uid) for uid in uids)
+        self._index_dirty = True
+        self._dirty = True
+        self._seq += 1
+
+    # --- изменения ---
+    def _changed(self, uid: int, verified: bool):
+        self._dirty_buckets.add(self.bucket_of(uid))
+        if verified != (uid in self._verified):
+            (self._verified.add if verified else self._verified.discard)(uid)
+            self._index_dirty = True
+
+    def put_record(self, rec: UserRecord):
+        with self._lock:
+            self._ensure_loaded()[rec.id] = rec
+            self._members.setdefault(self.bucket_of(rec.id), set()).add(rec.id)
+            self._changed(rec.id, rec.verified)
+            self._note_backup(rec.id)
+            self._mark_dirty()
+
+    def remove(self, user_id) -> bool:
+        with self._lock:
+            uid = self._uid(user_id)
+            if self._ensure_loaded().pop(uid, None) is None:
+                return False
+            self._members.get(self.bucket_of(uid), set()).discard(uid)
+            self._changed(uid, False)
+            self._note_backup(uid)
+            self._mark_dirty()
+            return True
+
+    def replace(self, users: Dict[str, Any]):
+        data, _ = _records_from_json(users)
+        with self._lock:
+            self._data = data
+            self._verified = {uid for uid, rec in self._data.items() if rec.verified}
+            self._index_members(self._data)
+            self._dirty_buckets = set(range(self.buckets))
+            self._index_dirty = True
+            self.backup_reset()
+            self._mark_dirty()
+
+    def touch(self):
+        with self._lock:
+            self._ensure_loaded()
+            self._dirty_buckets = set(range(self.buckets))
+            self.backup_reset()
+            self._mark_dirty()
+
+    def reload(self):
+        with self._lock:
+            self._dirty_buckets.clear()
+            self._index_dirty = False
+        super().reload()
+
+    # --- запись: только «грязные» корзины ---
+    def _snapshot(self) -> Tuple[int, Any]:
+        """O(размер грязных корзин): записи берутся по _members, сериализация — в _write_payload."""
+        with self._lock:
+            data = self._ensure_loaded()
+            payload = {
+                "buckets": {b: [data[uid] for uid in self._members.get(b, ()) if uid in data]
+                            for b in self._dirty_buckets},
+                "index": list(self._verified) if self._index_dirty else None,
+            }
+            self._dirty_buckets = set()
+            self._index_dirty = False
+            self._dirty = False
+            return self._seq, payload
+
+    @staticmethod
+    def _replace_file(path: str, text: Optional[str]):
+        if text is None:
+            with suppress(FileNotFoundError):
+                os.remove(path)
+            return
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def _write_payload(self, seq: int, payload: Any):
+        # снапшоты частичные, поэтому пишем каждый, но корзину — только если она не новее на диске
+        with self._io_lock:
+            pending = set(payload["buckets"])
+            try:
+                os.makedirs(self.dir, exist_ok=True)
+                for b, records in payload["buckets"].items():
+                    if seq > self._bucket_seq.get(b, 0):
+                        text = json.dumps({str(rec.id): rec.to_dict() for rec in records},
+                                          ensure_ascii=False) if records else None
+                        self._replace_file(self.bucket_path(b), text)
+                        self._bucket_seq[b] = seq
+                    pending.discard(b)
+                if payload["index"] is not None and seq > self._index_seq:
+                    self._replace_file(self.index_path, json.dumps({"verified": sorted(payload["index"])}))
+                    self._index_seq = seq
+            except Exception:
+                # недописанное вернётся в следующий снапшот
+                with self._lock:
+                    self._dirty_buckets.update(pending)
+                    self._index_dirty = self._index_dirty or payload["index"] is not None
+                raise
+            self._written_seq = max(self._written_seq, seq)
+
+    # --- индекс подтверждённых ---
+    def count(self, verified_only: bool = False) -> int:
+        if verified_only:
+            self._ensure_loaded()
+            return len(self._verified)
+        return super().count()
+
+    def ids(self, verified_only: bool = False) -> List[int]:
+        if verified_only:
+            self._ensure_loaded()
+            return sorted(self._verified)
+        return super().ids()
+
+
+class SqliteUserRepository(UserRepository):
+    """
+    Хранилище пользователей в SQLite (stdlib sqlite3, WAL).
+    - users: основные поля + extra (JSON прочих ключей записи, напр. demo_ai);
+      индексы по verified и purchase_date — админ-списки, статистика и таргетинг
+      рассылки выполняются запросами, а не перебором словаря;
+    - file_cache: персональный кэш file_id отдельной таблицей;
+    - backup_changes: uid, изменённые с прошлого бэкапа, — общая для всех воркеров
+      и пишется в той же транзакции, что и запись. Первый бэкап после старта процесса
+      всё равно делает полный обход (таблица могла вестись не с прошлого бэкапа).
+    Если база пуста, а рядом лежит paid_users.json — он импортируется один раз.
+    Все запросы синхронные: из event loop чтения идут через users_read() (пул I/O),
+    записи — через актор, чей пакет тоже выполняется в пуле I/O. Ожидание чужой
+    транзакции ограничено USERS_DB_BUSY_TIMEOUT_MS.
+    """
+
+    blocking_io = True
+
+    _SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS users (
+            user_id       INTEGER PRIMARY KEY,
+            username      TEXT,
+            verified      INTEGER NOT NULL DEFAULT 0,
+            purchase_date TEXT,
+            extra         TEXT
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_users_verified ON users(verified, purchase_date)",
+        "CREATE INDEX IF NOT EXISTS idx_users_purchase_date ON users(purchase_date)",
+        """CREATE TABLE IF NOT EXISTS file_cache (
+            user_id   INTEGER NOT NULL,
+            cache_key TEXT    NOT NULL,
+            file_id   TEXT    NOT NULL,
+            PRIMARY KEY (user_id, cache_key)
+        )""",
+        """CREATE TABLE IF NOT EXISTS backup_changes (
+            user_id INTEGER PRIMARY KEY,
+            n       INTEGER NOT NULL
+        )""",
+    )
+    _BASE_FIELDS = ("username", "verified", "purchase_date", "cache")
+
+    def __init__(self, path: str, import_from: Optional[str] = None):
+        self.path = path
+        self._lock = threading.RLock()
+        self._backup_tracked = False
+        self._backup_untracked: Dict[int, int] = {}
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None,
+                                     timeout=USERS_DB_BUSY_TIMEOUT_MS / 1000)
+        self._conn.execute(f"PRAGMA busy_timeout={int(USERS_DB_BUSY_TIMEOUT_MS)}")
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        for stmt in self._SCHEMA:
+            self._conn.execute(stmt)
+        if import_from:
+            self._import_json_once(import_from)
+
+    def _import_json_once(self, json_path: str):
+        if self._conn.execute("SELECT 1 FROM users LIMIT 1").fetchone():
+            return
+        legacy = _read_json_safe(json_path)
+        if isinstance(legacy, dict) and legacy:
+            self.replace(legacy)
+            logging.info("[USERS] imported %s records from %s into %s", len(legacy), json_path, self.path)
+
+    # --- (де)сериализация строк ---
+    @classmethod
+    def _split(cls, rec: Dict[str, Any]):
+        extra = {k: v for k, v in rec.items() if k not in cls._BASE_FIELDS}
+        return (
+            rec.get("username"),
+            1 if rec.get("verified") else 0,
+            rec.get("purchase_date"),
+            json.dumps(extra, ensure_ascii=False) if extra else None,
+        )
+
+    @staticmethod
+    def _join(row, cache: Dict[str, str]) -> Dict[str, Any]:
+        username, verified, purchase_date, extra = row
+        rec: Dict[str, Any] = json.loads(extra) if extra else {}
+        rec["username"] = username
+        rec["verified"] = bool(verified)
+        rec["purchase_date"] = purchase_date
+        rec["cache"] = cache
+        return rec
+
+    def _note_backup(self, user_id):
+        self._conn.execute(
+            "INSERT INTO backup_changes(user_id, n) VALUES (?, 1) "
+            "ON CONFLICT(user_id) DO UPDATE SET n = n + 1",
+            (int(user_id),),
+        )
+
+    def _write_rec(self, uid: int, rec: Dict[str, Any]):
+        self._note_backup(uid)
+        self._conn.execute(
+            "INSERT OR REPLACE INTO users(user_id, username, verified, purchase_date, extra) VALUES (?,?,?,?,?)",
+            (uid, *self._split(rec)),
+        )
+        self._conn.execute("DELETE FROM file_cache WHERE user_id=?", (uid,))
+        cache = rec.get("cache") or {}
+        if cache:
+            self._conn.executemany(
+                "INSERT INTO file_cache(user_id, cache_key, file_id) VALUES (?,?,?)",
+                [(uid, k, v) for k, v in cache.items() if v],
+            )
+
+    def _rows_to_items(self, rows) -> List[Tuple[int, Dict[str, Any]]]:
+        if not rows:
+            return []
+        ids = [r[0] for r in rows]
+        caches: Dict[int, Dict[str, str]] = {}
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            q = "SELECT user_id, cache_key, file_id FROM file_cache WHERE user_id IN (%s)" % ",".join("?" * len(chunk))
+            for uid, key, fid in self._conn.execute(q, chunk):
+                caches.setdefault(uid, {})[key] = fid
+        return [(r[0], self._join(r[1:], caches.get(r[0], {}))) for r in rows]
+
+    # --- интерфейс UserRepository ---
+    def all(self) -> Dict[str, Any]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT user_id, username, verified, purchase_date, extra FROM users"
+            ).fetchall()
+            return {str(uid): rec for uid, rec in self._rows_to_items(rows)}
+
+    def get(self, user_id) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT user_id, username, verified, purchase_date, extra FROM users WHERE user_id=?",
+                (int(user_id),),
+            ).fetchone()
+            if row is None:
+                return None
+            return self._rows_to_items([row])[0][1]
+
+    @contextmanager
+    def _tx(self):
+        """Транзакция на одну операцию; внутри batch() — часть общей транзакции пакета."""
+        with self._lock:
+            if self._batch_depth:
+                yield
+                return
+            self._conn.execute("BEGIN")
+            try:
+                yield
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _begin_batch(self):
+        self._lock.acquire()
+        self._conn.execute("BEGIN")
+
+    def _end_batch(self, ok: bool):
+        try:
+            self._conn.execute("COMMIT" if ok else "ROLLBACK")
+        finally:
+            self._lock.release()
+
+    def put(self, user_id, rec: Dict[str, Any]):
+        with self._tx():
+            self._write_rec(int(user_id), rec)
+
+    def remove(self, user_id) -> bool:
+        with self._tx():
+            cur = self._conn.execute("DELETE FROM users WHERE user_id=?", (int(user_id),))
+            self._conn.execute("DELETE FROM file_cache WHERE user_id=?", (int(user_id),))
+            if cur.rowcount > 0:
+                self._note_backup(user_id)
+            return cur.rowcount > 0
+
+    def replace(self, users: Dict[str, Any]):
+        with self._tx():
+            # удалённые тоже попадут в дельту: помечаем всех, кто был до замены
+            self._conn.execute(
+                "INSERT INTO backup_changes(user_id, n) SELECT user_id, 1 FROM users WHERE 1 "
+                "ON CONFLICT(user_id) DO UPDATE SET n = n + 1"
+            )
+            self._conn.execute("DELETE FROM users")
+            self._conn.execute("DELETE FROM file_cache")
+            records, _ = _records_from_json(users)
+            for uid, rec in records.items():
+                self._write_rec(uid, rec.to_dict())
+
+    def close(self):
+        with self._lock, suppress(Exception):
+            self._conn.close()
+
+    def backup_changes(self) -> Optional[Dict[int, int]]:
+        with self._lock:
+            rows = {uid: n for uid, n in self._conn.execute("SELECT user_id, n FROM backup_changes")}
+            if not self._backup_tracked:
+                # полный обход покроет и накопленное в таблице — уберём его после бэкапа
+                self._backup_tracked, self._backup_untracked = True, rows
+                return None
+            return rows
+
+    def backup_reset(self):
+        with self._lock:
+            self._backup_tracked = False
+
+    def backup_done(self, taken: Optional[Dict[int, int]]):
+        if taken is None:
+            taken, self._backup_untracked = self._backup_untracked, {}
+        if not taken:
+            return
+        with self._tx():
+            self._conn.executemany(
+                "DELETE FROM backup_changes WHERE user_id=? AND n=?", list(taken.items())
+            )
+
+    # --- индексные запросы ---
+    def count(self, verified_only: bool = False) -> int:
+        q = "SELECT COUNT(*) FROM users" + (" WHERE verified=1" if verified_only else "")
+        with self._lock:
+            return int(self._conn.execute(q).fetchone()[0])
+
+    def page(self, offset: int = 0, limit: Optional[int] = None,
+             verified_only: bool = False) -> List[Tuple[int, Dict[str, Any]]]:
+        q = ("SELECT user_id, username, verified, purchase_date, extra FROM users"
+             + (" WHERE verified=1" if verified_only else "")
+             + " ORDER BY verified DESC, purchase_date DESC LIMIT ? OFFSET ?")
+        with self._lock:
+            rows = self._conn.execute(q, (-1 if limit is None else int(limit), int(offset))).fetchall()
+            return self._rows_to_items(rows)
+
+    def ids(self, verified_only: bool = False) -> List[int]:
+        q = "SELECT user_id FROM users" + (" WHERE verified=1" if verified_only else "")
+        with self._lock:
+            return [r[0] for r in self._conn.execute(q)]
+
+    def get_file_id(self, user_id, cache_key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT file_id FROM file_cache WHERE user_id=? AND cache_key=?", (int(user_id), cache_key)
+            ).fetchone()
+            return row[0] if row else None
+
+    def set_file_id(self, user_id, cache_key: str, file_id: str):
+        with self._tx():
+            self._note_backup(user_id)
+            self._conn.execute(
+                "INSERT OR IGNORE INTO users(user_id, username, verified) VALUES (?, 'unknown', 0)", (int(user_id),)
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO file_cache(user_id, cache_key, file_id) VALUES (?,?,?)",
+                (int(user_id), cache_key, file_id),
+            )
+
+
+def _make_user_repository() -> UserRepository:
+    if STORAGE_BACKEND == "sqlite":
+        logging.info("[USERS] backend=sqlite (%s)", USERS_DB_FILE)
+        return SqliteUserRepository(USERS_DB_FILE, import_from=DATA_FILE)
+    if STORAGE_BACKEND == "journal":
+        logging.info("[USERS] backend=journal (%s + .journal)", DATA_FILE)
+        return JournalUserRepository(DATA_FILE)
+    if STORAGE_BACKEND == "sharded":
+        logging.info("[USERS] backend=sharded (%s, %s buckets)", USERS_SHARD_DIR, USERS_SHARD_BUCKETS)
+        return ShardedUserRepository(USERS_SHARD_DIR, import_from=DATA_FILE)
+    if STORAGE_BACKEND != "json":
+        logging.warning("[USERS] unknown STORAGE_BACKEND=%s, falling back to json", STORAGE_BACKEND)
+    return JsonUserRepository(DATA_FILE)
+
+USERS = _make_user_repository()
+
+# ---------------------------
+# АКТОР ЗАПИСИ ПОЛЬЗОВАТЕЛЕЙ (единственный писатель)
+# ---------------------------
+USERS_ACTOR_MAX_BATCH = int(os.getenv("USERS_ACTOR_MAX_BATCH") or 256)
+
+class UserStoreActor:
+    """
+    Все изменения пользователей идут через одну asyncio-задачу:
+    хэндлеры кладут команды (обычные sync-функции) в очередь и ждут результат,
+    актор применяет их строго по порядку. Всё, что накопилось в очереди,
+    применяется одним пакетом с одной фиксацией (USERS.batch()) — при всплеске
+    вебхуков это одна запись на диск вместо N. Read-modify-write внутри одной
+    команды атомарен: параллельные хэндлеры не затирают изменения друг друга.
+    Пакет выполняется в пуле I/O (COMMIT SQLite, fsync журнала, replace при restore
+    не держат event loop); пакеты идут строго по одному, так что порядок сохраняется.
+    Команды — синхронные функции без asyncio; результаты отдаются обратно в loop.
+    """
+
+    def __init__(self, repo: UserRepository, max_batch: int = USERS_ACTOR_MAX_BATCH):
+        self.repo = repo
+        self.max_batch = max(1, max_batch)
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"commands": 0, "batches": 0, "errors": 0}
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self):
+        if self.running:
+            return
+        self._queue = asyncio.Queue()
+        self.repo.bind_loop(asyncio.get_running_loop())
+        self._task = asyncio.create_task(self._run())
+        logging.info("[USERS-ACTOR] started (max_batch=%s)", self.max_batch)
+
+    async def stop(self):
+        """Дождаться применения всех команд и остановить задачу."""
+        if not self.running:
+            return
+        await self._queue.join()
+        self._task.cancel()
+        with suppress(asyncio.CancelledError):
+            await self._task
+        self._task = None
+        logging.info("[USERS-ACTOR] stopped; commands=%s batches=%s errors=%s",
+                     self.stats["commands"], self.stats["batches"], self.stats["errors"])
+
+    async def submit(self, fn, *args, **kwargs):
+        """Выполнить fn(*args, **kwargs) в акторе и вернуть результат (или исключение)."""
+        if not self.running:
+            # актор не запущен (CLI, ранний старт) — применяем сразу
+            return fn(*args, **kwargs)
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((fn, args, kwargs, fut))
+        return await fut
+
+    def _apply(self, batch) -> List[Tuple[bool, Any]]:
+        """Пакет команд с одной фиксацией; выполняется в потоке пула I/O."""
+        results = []
+        with self.repo.batch():
+            for fn, args, kwargs, _ in batch:
+                try:
+                    results.append((True, fn(*args, **kwargs)))
+                except Exception as e:
+                    results.append((False, e))
+        return results
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.max_batch and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            live = [cmd for cmd in batch if not cmd[3].cancelled()]
+            try:
+                results = await loop.run_in_executor(_IO_POOL, self._apply, live) if live else []
+            except Exception as e:
+                logging.exception("[USERS-ACTOR] batch commit failed: %s", e)
+                for *_, fut in live:
+                    if not fut.done():
+                        fut.set_exception(e)
+            else:
+                for (*_, fut), (ok, res) in zip(live, results):
+                    if not ok:
+                        self.stats["errors"] += 1
+                    if fut.done():
+                        continue
+                    if ok:
+                        fut.set_result(res)
+                    else:
+                        fut.set_exception(res)
+            finally:
+                self.stats["commands"] += len(batch)
+                self.stats["batches"] += 1
+                for _ in batch:
+                    self._queue.task_done()
+
+USERS_ACTOR = UserStoreActor(USERS)
 
 def load_paid_users() -> Dict[str, Any]:
-    try:
-        with open(DATA_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except Exception:
-        return {}
+    """Все пользователи из активного хранилища (для json — из памяти, без чтения файла)."""
+    return USERS.all()
 
 def save_users(users: dict):
-    _atomic_write(DATA_FILE, users)
+    USERS.replace(users)
 
 def save_pending_user(user_id: int, username: str):
     """Сохраняем запись (ещё не подтверждён)."""
-    users = load_paid_users()
-    rec = users.get(str(user_id), {})
-    rec.setdefault("verified", False)
-    rec.setdefault("purchase_date", None)
-    rec.setdefault("cache", {})  # кэш file_id для этого пользователя
-    rec["username"] = username or rec.get("username", "unknown")
-    users[str(user_id)] = rec
-    save_users(users)
+    rec = USERS.record(user_id) or UserRecord(int(user_id))
+    USERS.put_record(dataclass_replace(rec, username=_intern_username(username or rec.username)))
 
 def save_paid_user(user_id: int, username: str):
     """Подтверждаем оплату пользователя."""
-    users = load_paid_users()
-    rec = users.get(str(user_id), {})
-    rec["username"] = username or rec.get("username", "unknown")
-    rec["purchase_date"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    rec["verified"] = True
-    rec.setdefault("cache", {})
-    users[str(user_id)] = rec
-    save_users(users)
+    rec = USERS.record(user_id) or UserRecord(int(user_id))
+    USERS.put_record(dataclass_replace(
+        rec,
+        username=_intern_username(username or rec.username),
+        purchased_at=float(int(time.time())),
+        verified=True,
+    ))
 
 def is_user_verified(user_id: int) -> bool:
-    return load_paid_users().get(str(user_id), {}).get("verified", False)
+    rec = USERS.record(user_id)
+    return bool(rec and rec.verified)
+
+async def users_read(fn, *args, **kwargs):
+    """
+    Чтение пользователей из хэндлера: бэкенды с базой в памяти (json/journal/sharded)
+    отвечают сразу, SQLite — в пуле I/O, чтобы запрос не держал event loop.
+    """
+    if not USERS.blocking_io:
+        return fn(*args, **kwargs)
+    return await run_io(fn, *args, **kwargs)
 
 def is_admin(user_id: int) -> bool:
     return user_id == ADMIN_ID
 
 def clear_database():
     """Полная очистка БД."""
-    save_users({})
+    DEMO_QUOTAS.reset(shared=True)
+    USERS.replace({})
+    USERS.flush()
+
+def remove_user(user_id: int) -> bool:
+    return USERS.remove(user_id)
+
+def backup_database() -> Optional[str]:
+    """Создаём backup paid_users.json."""
+    try:
+        users = load_paid_users()
+        backup_filename = os.path.join(
+            BASE_DIR, f"paid_users_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+        )
+        _atomic_write(backup_filename, users)
+        return backup_filename
+    except Exception:
+        return None
+
+# ---------------------------
+# ДЕМО-КВОТЫ ИИ (горячие счётчики в памяти)
+# ---------------------------
+DEMO_QUOTA_FLUSH_SEC = int(os.getenv("DEMO_QUOTA_FLUSH_SEC") or 60)
+
+class DemoQuotaEngine:
+    """
+    Лимиты демо-ИИ без обращения к базе на каждое сообщение.
+    - состояние uid → [day, count, last_ts] живёт в памяти; при первом обращении
+      к пользователю берётся из UserRecord.demo_ai (переживает рестарт);
+    - день — бакет YYYY-mm-dd: при смене дня счётчик обнуляется лениво;
+    - изменённые счётчики пишутся в demo_ai пачкой раз в DEMO_QUOTA_FLUSH_SEC
+      (одна команда актора записи = одна фиксация) и на shutdown;
+    - прошедшие дни после записи выбрасываются из памяти;
+    - пауза между вопросами — политика "demo" в RATE_LIMITS (из DEMO_AI_COOLDOWN_SEC или
+      env RATE_LIMITS), своей настройки у движка нет; last_ts — только для админки;
+    - с store (WEB_WORKERS > 1) дневной счётчик — атомарный инкремент в общем
+      SharedLimitStore, а не память процесса и не demo_ai: иначе каждый воркер давал бы
+      свой лимит, а записи demo_ai из разных процессов затирали бы друг друга.
+      Из event loop тогда — только acheck()/ahit().
+    """
+
+    def __init__(self, daily_limit: int = DEMO_AI_DAILY_LIMIT, flush_every: int = DEMO_QUOTA_FLUSH_SEC,
+                 store: Optional[SharedLimitStore] = None):
+        self.daily_limit = daily_limit
+        self.store = store
+        self.flush_every = max(5, flush_every)
+        self._state: Dict[int, List[Any]] = {}
+        self._dirty: set = set()
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"checks": 0, "blocked": 0, "hits": 0, "flushes": 0}
+
+    @property
+    def cooldown_sec(self) -> int:
+        """Действующая пауза между вопросами (0 — политики нет или лимиты выключены)."""
+        pol = RATE_LIMITER._policy("demo")
+        return int(round(1 / pol["rate"])) if pol and pol["rate"] > 0 else 0
+
+    def _get(self, uid: int, demo: Optional[Dict[str, Any]] = None) -> List[Any]:
+        st = self._state.get(uid)
+        if st is None:
+            demo = _get_demo_stats(uid) if demo is None else demo
+            st = [demo.get("date"), int(demo.get("count", 0)), int(demo.get("last_ts", 0))]
+            self._state[uid] = st
+        today = _demo_today_str()
+        if st[0] != today:
+            st[0], st[1] = today, 0
+        return st
+
+    def check(self, uid: int) -> Tuple[bool, str]:
+        if not DEMO_AI_ENABLED:
+            return False, "Демо-режим временно отключён."
+        self.stats["checks"] += 1
+        if self.store is not None:
+            count = self.store.count(("demo", uid), _demo_today_str())
+        else:
+            _, count, _ = self._get(uid)
+        # cooldown — политика "demo" в RATE_LIMITER (списывается в register_hit);
+        # как и остальные политики, выключается RATE_LIMIT_ENABLED=false
+        wait = RATE_LIMITER.peek_policy("demo", uid)
+        if wait > 0:
+            self.stats["blocked"] += 1
+            return False, f"Подождите {max(1, int(wait + 0.999))} сек. перед следующим вопросом."
+        # лимит в день
+        if count >= self.daily_limit:
+            self.stats["blocked"] += 1
+            return False, f"Лимит в демо {self.daily_limit}/день исчерпан. Оформите доступ, чтобы общаться без ограничений."
+        return True, ""
+
+    def register_hit(self, uid: int):
+        if self.store is not None:
+            self.store.incr(("demo", uid), _demo_today_str())
+        else:
+            st = self._get(uid)
+            st[1] += 1
+            st[2] = int(time.time())
+            self._dirty.add(uid)
+        self.stats["hits"] += 1
+        RATE_LIMITER.check("demo", uid)
+
+    def reset(self, shared: bool = False):
+        """
+        Забыть всё (после очистки/восстановления базы) — иначе flush воскресит удалённых.
+        shared=True (очистка базы) — ещё и общие счётчики воркеров в store.
+        """
+        self._state.clear()
+        self._dirty.clear()
+        if shared and self.store is not None:
+            self.store.clear("demo|")
+
+    async def acheck(self, uid: int) -> Tuple[bool, str]:
+        if self.store is not None:
+            return await run_io(self.check, uid)
+        if uid not in self._state and USERS.blocking_io:
+            # первое обращение за процесс — запись из базы читаем в пуле I/O
+            self._get(uid, await users_read(_get_demo_stats, uid))
+        return self.check(uid)
+
+    async def ahit(self, uid: int):
+        if self.store is None:
+            self.register_hit(uid)
+        else:
+            await run_io(self.register_hit, uid)
+
+    def today(self) -> List[Tuple[int, int, int]]:
+        """[(uid, count, last_ts)] за сегодня, по убыванию count — для админки."""
+        today = _demo_today_str()
+        if self.store is not None:
+            return [(int(k.split("|", 1)[1]), n, int(ts)) for k, n, ts in self.store.day_rows("demo|", today)]
+        rows = [(uid, st[1], st[2]) for uid, st in self._state.items() if st[0] == today and st[1]]
+        rows.sort(key=lambda r: (r[1], r[2]), reverse=True)
+        return rows
+
+    # --- запись ---
+    def _write_dirty(self, uids: List[int]):
+        with USERS.batch():
+            for uid in uids:
+                st = self._state.get(uid)
+                if st is not None:
+                    _save_demo_stats(uid, {"date": st[0], "count": st[1], "last_ts": st[2]})
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        uids, self._dirty = list(self._dirty), set()
+        try:
+            await USERS_ACTOR.submit(self._write_dirty, uids)
+            self.stats["flushes"] += 1
+        except Exception as e:
+            self._dirty.update(uids)
+            logging.warning("[DEMO] quota flush failed: %s", e)
+            return
+        # вчерашние счётчики — здесь, в loop: _write_dirty идёт в потоке актора
+        today = _demo_today_str()
+        for uid in [u for u, st in self._state.items() if st[0] != today and u not in self._dirty]:
+            del self._state[uid]
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.flush_every)
+            await self.flush()
+
+    async def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        await self.flush()
+
+DEMO_QUOTAS = DemoQuotaEngine(store=LIMITS_STORE)
+
+# ---------------------------
+# МИГРАЦИЯ ХРАНИЛИЩА (JSON → SQLite без остановки)
+# ---------------------------
+# 1) перенос пачками: каждая пачка — одна команда актора и одна транзакция SQLite,
+#    записи читаются из текущей базы в момент переноса (не из устаревшего снимка);
+# 2) двойная запись: с момента старта каждое изменение идёт в обе базы,
+#    чтения обслуживает старая, сверяя ответ с новой;
+# 3) через MIGRATE_GRACE_SEC — полная сверка; при совпадении USERS переключается на SQLite.
+MIGRATE_BATCH_SIZE = int(os.getenv("MIGRATE_BATCH_SIZE") or 1000)
+MIGRATE_GRACE_SEC = int(os.getenv("MIGRATE_GRACE_SEC") or 300)
+
+def _canon_user(uid, rec: Optional[Dict[str, Any]]) -> Optional[str]:
+    if rec is None:
+        return None
+    return json.dumps(UserRecord.from_dict(uid, rec).to_dict(), ensure_ascii=False, sort_keys=True)
+
+class DualWriteUserRepository(UserRepository):
+    """Старое хранилище — основное (чтения), новое — зеркало всех изменений."""
+
+    def __init__(self, primary: UserRepository, secondary: UserRepository):
+        self.primary = primary
+        self.secondary = secondary
+        self.stats = {"reads": 0, "read_mismatches": 0, "mirror_errors": 0}
+        self.failed_ids: set = set()     # записи, чьё зеркалирование упало (досверяются при переключении)
+        self.bulk_failed = False         # упала массовая запись (replace) — точечной досверки мало
+
+    def _mirror(self, fn, *args, uid=None):
+        try:
+            fn(*args)
+        except Exception as e:
+            self.stats["mirror_errors"] += 1
+            if uid is not None:
+                self.failed_ids.add(int(uid))
+            else:
+                self.bulk_failed = True
+            logging.warning("[MIGRATE] mirror write failed: %s", e)
+
+    def _shadow(self, user_id, rec: Optional[Dict[str, Any]]):
+        self.stats["reads"] += 1
+        try:
+            other = self.secondary.get(user_id)
+        except Exception:
+            other = None
+        if _canon_user(user_id, rec) != _canon_user(user_id, other):
+            self.stats["read_mismatches"] += 1
+
+    # --- чтения: из старого хранилища ---
+    def all(self) -> Dict[str, Any]:
+        return self.primary.all()
+
+    def get(self, user_id) -> Optional[Dict[str, Any]]:
+        rec = self.primary.get(user_id)
+        self._shadow(user_id, rec)
+        return rec
+
+    def record(self, user_id) -> Optional[UserRecord]:
+        rec = self.primary.record(user_id)
+        self._shadow(user_id, rec.to_dict() if rec is not None else None)
+        return rec
+
+    def records(self) -> List[UserRecord]:
+        return self.primary.records()
+
+    def count(self, verified_only: bool = False) -> int:
+        return self.primary.count(verified_only)
+
+    def page(self, offset: int = 0, limit: Optional[int] = None,
+             verified_only: bool = False) -> List[Tuple[int, Dict[str, Any]]]:
+        return self.primary.page(offset, limit, verified_only)
+
+    def ids(self, verified_only: bool = False) -> List[int]:
+        return self.primary.ids(verified_only)
+
+    def get_file_id(self, user_id, cache_key: str) -> Optional[str]:
+        return self.primary.get_file_id(user_id, cache_key)
+
+    # --- записи: в оба ---
+    def put(self, user_id, rec: Dict[str, Any]):
+        self.primary.put(user_id, rec)
+        self._mirror(self.secondary.put, user_id, rec, uid=user_id)
+
+    def put_record(self, rec: UserRecord):
+        self.primary.put_record(rec)
+        self._mirror(self.secondary.put, rec.id, rec.to_dict(), uid=rec.id)
+
+    def remove(self, user_id) -> bool:
+        res = self.primary.remove(user_id)
+        self._mirror(self.secondary.remove, user_id, uid=user_id)
+        return res
+
+    def replace(self, users: Dict[str, Any]):
+        self.primary.replace(users)
+        self._mirror(self.secondary.replace, users)
+
+    def set_file_id(self, user_id, cache_key: str, file_id: str):
+        self.primary.set_file_id(user_id, cache_key, file_id)
+        self._mirror(self.secondary.set_file_id, user_id, cache_key, file_id, uid=user_id)
+
+    def touch(self):
+        self.primary.touch()
+
+    def reload(self):
+        self.primary.reload()
+
+    # бэкап снимается с основного хранилища — и изменения отслеживает оно
+    def backup_changes(self) -> Optional[Dict[int, int]]:
+        return self.primary.backup_changes()
+
+    def backup_done(self, taken: Optional[Dict[int, int]]):
+        self.primary.backup_done(taken)
+
+    def backup_reset(self):
+        self.primary.backup_reset()
+
+    @property
+    def blocking_io(self) -> bool:
+        return self.primary.blocking_io or self.secondary.blocking_io
+
+    def bind_loop(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+        self.primary.bind_loop(loop)
+        self.secondary.bind_loop(loop)
+
+    @contextmanager
+    def batch(self):
+        with self.primary.batch():
+            try:
+                mirror = self.secondary.batch()
+                mirror.__enter__()
+            except Exception as e:
+                self.stats["mirror_errors"] += 1
+                logging.warning("[MIGRATE] mirror batch failed: %s", e)
+                mirror = None
+            try:
+                yield self
+            finally:
+                if mirror is not None:
+                    try:
+                        mirror.__exit__(*sys.exc_info())
+                    except Exception as e:
+                        self.stats["mirror_errors"] += 1
+                        logging.warning("[MIGRATE] mirror commit failed: %s", e)
+
+    def flush(self):
+        self.primary.flush()
+        self._mirror(self.secondary.flush)
+
+    def close(self):
+        self.primary.close()
+        self._mirror(self.secondary.close)
+
+    # --- перенос и сверка ---
+    def copy_ids(self, ids: List[int]) -> int:
+        """Перенести текущие версии записей одной транзакцией; исчезнувшие — удалить."""
+        with self.secondary.batch():
+            for uid in ids:
+                rec = self.primary.get(uid)
+                if rec is None:
+                    self.secondary.remove(uid)
+                else:
+                    self.secondary.put(uid, rec)
+        return len(ids)
+
+    def diff(self, ids: Optional[Iterable[int]] = None) -> List[int]:
+        """
+        user_id, которые в двух базах различаются (или есть только в одной).
+        Без ids — полная сверка по снимкам all(): долго, вызывать через run_io;
+        с ids — точечная по get(), O(len(ids)) — для актора.
+        """
+        if ids is not None:
+            return sorted(int(uid) for uid in set(ids)
+                          if _canon_user(uid, self.primary.get(uid)) != _canon_user(uid, self.secondary.get(uid)))
+        a, b = self.primary.all(), self.secondary.all()
+        return sorted(int(uid) for uid in set(a) | set(b)
+                      if _canon_user(uid, a.get(uid)) != _canon_user(uid, b.get(uid)))
+
+
+def _install_users_repository(repo: UserRepository):
+    """Подменить активное хранилище (вызывать из актора — между командами нет записей)."""
+    global USERS
+    if USERS._loop is not None:
+        repo.bind_loop(USERS._loop)
+    USERS = repo
+    USERS_ACTOR.repo = repo
+
+def _write_storage_marker(backend: str, source: str):
+    _atomic_write(STORAGE_MARKER_FILE, {
+        "backend": backend,
+        "source": source,
+        "migrated_at": datetime.now().strftime(PURCHASE_DATE_FMT),
+    })
+
+class StorageMigration:
+    """Онлайн-перенос пользователей в SQLite: /migrate_storage [status|now|abort]."""
+
+    def __init__(self):
+        self.phase = "idle"          # idle → loading → dual → done | aborted | failed
+        self.dual: Optional[DualWriteUserRepository] = None
+        self.copied = 0
+        self.total = 0
+        self.mismatches: List[int] = []
+        self.started_at: Optional[datetime] = None
+        self._task: Optional[asyncio.Task] = None
+        self._cutover_now = asyncio.Event()
+
+    @property
+    def active(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def _begin(self) -> List[int]:
+        secondary = SqliteUserRepository(USERS_DB_FILE)
+        secondary.replace({})  # остатки прошлой неудачной попытки
+        self.dual = DualWriteUserRepository(USERS, secondary)
+        _install_users_repository(self.dual)
+        return self.dual.primary.ids()
+
+    def _cutover(self, candidates: List[int]) -> List[int]:
+        """
+        В акторе — только финальная дельта: досверить расхождения фоновой сверки и
+        записи с упавшим зеркалом, и если их нет — переключиться.
+        """
+        if self.dual.bulk_failed:
+            raise RuntimeError("зеркало пропустило массовую запись (replace)")
+        ids, self.dual.failed_ids = set(candidates) | self.dual.failed_ids, set()
+        diff = self.dual.diff(ids)
+        if diff:
+            return diff
+        _install_users_repository(self.dual.secondary)
+        _write_storage_marker("sqlite", STORAGE_BACKEND)
+        return []
+
+    def _rollback(self):
+        if USERS is self.dual:
+            _install_users_repository(self.dual.primary)
+        with suppress(Exception):
+            self.dual.secondary.close()
 
-def remove_user(user_id: int) -> bool:
-    users = load_paid_users()
-    if str(user_id) in users:
-        del users[str(user_id)]
-        save_users(users)
+    async def _run(self, notify):
+        try:
+            ids = await USERS_ACTOR.submit(self._begin)
+            self.total, self.phase = len(ids), "loading"
+            for i in range(0, len(ids), MIGRATE_BATCH_SIZE):
+                self.copied += await USERS_ACTOR.submit(self.dual.copy_ids, ids[i:i + MIGRATE_BATCH_SIZE])
+                await asyncio.sleep(0)  # живые команды актора идут между пачками
+            self.phase = "dual"
+            await notify(f"🔁 Перенесено {self.copied} записей, двойная запись включена. "
+                         f"Сверка и переключение через {MIGRATE_GRACE_SEC} сек. (/migrate_storage now — сразу)")
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._cutover_now.wait(), MIGRATE_GRACE_SEC)
+
+            for _ in range(3):
+                # полная сверка — в пуле I/O по снимкам, запись в это время идёт в обе базы;
+                # актор занят только досверкой кандидатов и самим переключением
+                candidates = await run_io(self.dual.diff)
+                self.mismatches = await USERS_ACTOR.submit(self._cutover, candidates)
+                if not self.mismatches:
+                    break
+                # расхождения (напр. ошибка зеркала) — переносим эти записи заново и сверяем ещё раз
+                await USERS_ACTOR.submit(self.dual.copy_ids, self.mismatches)
+            if self.mismatches:
+                raise RuntimeError(f"базы расходятся в {len(self.mismatches)} записях")
+            self.phase = "done"
+            with suppress(Exception):
+                await run_io(self.dual.primary.flush)  # старый файл оставляем согласованным
+            await notify(f"✅ Хранилище переключено на SQLite (<code>{escape(USERS_DB_FILE)}</code>). "
+                         f"Чтений сверено: {self.dual.stats['reads']}, расхождений: {self.dual.stats['read_mismatches']}.")
+        except asyncio.CancelledError:
+            self.phase = "aborted"
+            await USERS_ACTOR.submit(self._rollback)
+            raise
+        except Exception as e:
+            self.phase = "failed"
+            logging.exception("[MIGRATE] failed: %s", e)
+            with suppress(Exception):
+                await USERS_ACTOR.submit(self._rollback)
+            await notify(f"❌ Миграция отменена, работаем на прежнем хранилище: {escape(str(e))}")
+
+    def start(self, notify) -> bool:
+        if self.active:
+            return False
+        self.phase, self.copied, self.total, self.mismatches = "idle", 0, 0, []
+        self.started_at = datetime.now()
+        self._cutover_now = asyncio.Event()
+        self._task = asyncio.create_task(self._run(notify))
         return True
-    return False
 
-def backup_database() -> Optional[str]:
-    """Создаём backup paid_users.json."""
-    try:
-        users = load_paid_users()
-        backup_filename = os.path.join(
-            BASE_DIR, f"paid_users_backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
-        )
-        _atomic_write(backup_filename, users)
-        return backup_filename
-    except Exception:
-        return None
+    def cutover_now(self):
+        self._cutover_now.set()
+
+    async def abort(self):
+        if self.active:
+            self._task.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._task
+
+    def status(self) -> str:
+        lines = [f"Этап: <b>{self.phase}</b>", f"Перенесено: {self.copied}/{self.total}"]
+        if self.dual is not None:
+            st = self.dual.stats
+            lines.append(f"Сверено чтений: {st['reads']} | расхождений: {st['read_mismatches']} | "
+                         f"ошибок зеркала: {st['mirror_errors']}")
+        if self.mismatches:
+            lines.append(f"Расходятся: {', '.join(map(str, self.mismatches[:10]))}")
+        return "\n".join(lines)
+
+STORAGE_MIGRATION = StorageMigration()
+
+def migrate_storage_offline() -> bool:
+    """CLI: python ai_business_kit_bot.py migrate-storage (бот при этом должен быть остановлен)."""
+    if isinstance(USERS, SqliteUserRepository):
+        print(f"[MIGRATE] already on sqlite: {USERS_DB_FILE}")
+        return True
+    dual = DualWriteUserRepository(USERS, SqliteUserRepository(USERS_DB_FILE))
+    dual.secondary.replace({})
+    ids = USERS.ids()
+    for i in range(0, len(ids), MIGRATE_BATCH_SIZE):
+        dual.copy_ids(ids[i:i + MIGRATE_BATCH_SIZE])
+        print(f"[MIGRATE] copied {min(i + MIGRATE_BATCH_SIZE, len(ids))}/{len(ids)}")
+    diff = dual.diff()
+    if diff:
+        print(f"[MIGRATE] verification failed: {len(diff)} mismatching records, e.g. {diff[:10]}")
+        return False
+    dual.secondary.close()
+    _write_storage_marker("sqlite", STORAGE_BACKEND)
+    print(f"[MIGRATE] done: {len(ids)} records → {USERS_DB_FILE}; marker {STORAGE_MARKER_FILE}")
+    return True
 
 # ---------------------------
 # ГЛОБАЛЬНЫЙ КЭШ file_id ДЛЯ МАТЕРИАЛОВ (kit_assets.json)
 # ---------------------------
 def _load_assets() -> Dict[str, Any]:
     try:
-        with open(ASSETS_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
+        return _load_json_cached(ASSETS_FILE)
     except Exception:
         return {}
 
 def _save_assets(d: dict):
     _atomic_write(ASSETS_FILE, d)
 
+_ASSETS_STATS = {"hits": 0, "misses": 0, "reloads": 0}
+_assets_loaded = False
+_assets_stamp: Optional[Tuple[int, int, int]] = None
+_assets_stat_at = 0.0  # monotonic последней проверки stat (как USERS_STAT_CHECK_SEC у пользователей)
+
+def reload_assets_cache() -> Dict[str, Any]:
+    """Перечитать kit_assets.json в ASSETS_CACHE (старт, restore, запись другого воркера)."""
+    global _assets_loaded, _assets_stamp, _assets_stat_at
+    _assets_stamp = _file_stamp(ASSETS_FILE)
+    _assets_stat_at = time.monotonic()
+    d = _load_assets()
+    ASSETS_CACHE.clear()
+    if isinstance(d, dict):
+        ASSETS_CACHE.update(d)
+    _assets_loaded = True
+    _ASSETS_STATS["reloads"] += 1
+    logging.info("[ASSETS] registry loaded: %s keys", len(ASSETS_CACHE))
+    return ASSETS_CACHE
+
+def _assets_registry(fresh: bool = False) -> Dict[str, Any]:
+    """
+    Реестр из памяти. Запись другого воркера замечается по stat файла, но stat —
+    не чаще раза в USERS_STAT_CHECK_SEC (fresh=True — сейчас же, для read-modify-write).
+    """
+    global _assets_stat_at
+    if not _assets_loaded:
+        return reload_assets_cache()
+    now = time.monotonic()
+    if fresh or now - _assets_stat_at >= USERS_STAT_CHECK_SEC:
+        if _file_stamp(ASSETS_FILE) != _assets_stamp:
+            return reload_assets_cache()
+        _assets_stat_at = now
+    return ASSETS_CACHE
+
+def _update_assets(mutate):
+    """Read-modify-write kit_assets.json под файловой блокировкой (безопасно для нескольких воркеров)."""
+    global _assets_stamp
+    with _file_lock(ASSETS_FILE):
+        registry = _assets_registry(fresh=True)  # под блокировкой — видим последнюю чужую запись
+        mutate(registry)
+        _save_assets(registry)
+        _assets_stamp = _file_stamp(ASSETS_FILE)
+
 def get_asset_file_id(key: str) -> Optional[str]:
     """
     key: 'prompts' | 'guide' | 'presentation'
     """
-    d = _load_assets()
-    v = (d.get(key) or {}).get("file_id")
+    v = (_assets_registry().get(key) or {}).get("file_id")
+    _ASSETS_STATS["hits" if v else "misses"] += 1
     return v or None
 
 def get_sbp_qr_file_id() -> Optional[str]:
-    d = _load_assets()
-    return (d.get("sbp_qr") or {}).get("file_id") or None
+    return get_asset_file_id("sbp_qr")
 
 def set_asset_file_id(key: str, file_id: str):
-    d = _load_assets()
-    entry = d.get(key) or {}
-    entry["file_id"] = file_id
-    entry["updated_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    d[key] = entry
-    _save_assets(d)
+    def _set(registry: Dict[str, Any]):
+        entry = dict(registry.get(key) or {})
+        entry["file_id"] = file_id
+        entry["updated_at"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        registry[key] = entry
+    _update_assets(_set)
+
+# --- общий кэш file_id (один на всех пользователей) ---
+# Telegram file_id переиспользуется между чатами, поэтому файл, отправленный по URL
+# или сгенерированный в памяти, загружается один раз — дальше всем уходит file_id.
+# Ключ: cache_key + хэш источника (URL или "sha1:<содержимое>"), чтобы смена
+# ссылки/содержимого сама давала новую загрузку. Хранится в kit_assets.json → "file_cache".
+FILE_CACHE_ASSET_KEY = "file_cache"
+_FILE_CACHE_STATS = {"hits": 0, "misses": 0, "stale": 0}
+
+def _file_cache_slot(cache_key: str, source: str) -> str:
+    return f"{cache_key}:{hashlib.sha1(source.encode('utf-8')).hexdigest()[:16]}"
+
+def content_source(data: bytes) -> str:
+    return "sha1:" + hashlib.sha1(data).hexdigest()
+
+def get_cached_file_id(cache_key: str, source: str) -> Optional[str]:
+    if not source:
+        return None
+    entry = (_assets_registry().get(FILE_CACHE_ASSET_KEY) or {}).get(_file_cache_slot(cache_key, source)) or {}
+    fid = entry.get("file_id")
+    _FILE_CACHE_STATS["hits" if fid else "misses"] += 1
+    return fid or None
+
+def set_cached_file_id(cache_key: str, source: str, file_id: str):
+    if not (source and file_id):
+        return
+    def _set(registry: Dict[str, Any]):
+        cache = dict(registry.get(FILE_CACHE_ASSET_KEY) or {})
+        cache[_file_cache_slot(cache_key, source)] = {
+            "file_id": file_id,
+            "cache_key": cache_key,
+            "source": source if not source.startswith("sha1:") else source[:17],
+            "updated_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        registry[FILE_CACHE_ASSET_KEY] = cache
+    _update_assets(_set)
+
+def drop_cached_file_id(cache_key: str, source: str):
+    """file_id перестал приниматься Telegram — забываем, следующая отправка перезальёт."""
+    def _drop(registry: Dict[str, Any]):
+        cache = dict(registry.get(FILE_CACHE_ASSET_KEY) or {})
+        if cache.pop(_file_cache_slot(cache_key, source), None) is not None:
+            _FILE_CACHE_STATS["stale"] += 1
+            registry[FILE_CACHE_ASSET_KEY] = cache
+    _update_assets(_drop)
+
+# Персональные ключи кэша, которые раньше писались в запись каждого пользователя.
+# URL, с которого получен file_id, в них не записывался, поэтому в общий кэш они
+# не переносятся: после смены URL такой file_id отдал бы старый файл. Первая
+# отправка по текущему URL закэширует свежий file_id сама.
+_LEGACY_USER_CACHE_KEYS = frozenset({
+    "prompts_file_id",
+    "guide_file_id",
+    "presentation_file_id",
+    "guide_pptx_file_id",
+    "bot_template_py_file_id",
+    "env_template_file_id",
+})
+
+def _legacy_cache_updates() -> List[Tuple[UserRecord, UserRecord]]:
+    """[(копия записи как есть, запись без legacy-ключей)] — только чтение, можно в пуле I/O."""
+    pairs = []
+    for rec in USERS.records():
+        if not rec.cache or not _LEGACY_USER_CACHE_KEYS.intersection(rec.cache):
+            continue
+        cache = {k: v for k, v in rec.cache.items() if k not in _LEGACY_USER_CACHE_KEYS}
+        pairs.append((dataclass_replace(rec), dataclass_replace(rec, cache=cache or None)))
+    return pairs
+
+def _apply_legacy_cache_updates(pairs: List[Tuple[UserRecord, UserRecord]]) -> int:
+    """В акторе записи: только записи, не изменившиеся после перебора."""
+    n = 0
+    with USERS.batch():
+        for seen, clean in pairs:
+            if USERS.record(seen.id) == seen:
+                USERS.put_record(clean)
+                n += 1
+    return n
+
+async def migrate_user_file_caches() -> int:
+    """
+    Разовая очистка персональных file_id из записей пользователей (см. выше,
+    почему без переноса в общий кэш): перебор — в пуле I/O, в актор уходят
+    только изменённые записи. Повторный запуск ничего не делает.
+    Возвращает число очищенных записей.
+    """
+    pairs = await run_io(_legacy_cache_updates)
+    if not pairs:
+        return 0
+    n = await USERS_ACTOR.submit(_apply_legacy_cache_updates, pairs)
+    logging.info("[ASSETS] dropped legacy per-user file_id caches: users=%s", n)
+    return n
+
+# ---------------------------
+# АСИНХРОННЫЙ ФАСАД ХРАНИЛИЩА (всё блокирующее — через run_io)
+# ---------------------------
+async def backup_database_async() -> Optional[str]:
+    return await run_io(backup_database)
+
+async def make_backup_zip_file_async(force_full: bool = False) -> tuple[str, str, str]:
+    return await run_io(make_backup_zip_file, force_full)
+
+async def create_bot_template_async() -> str:
+    return await run_io(create_bot_template)
+
+def build_buyers_csv() -> Optional[bytes]:
+    """CSV подтверждённых покупателей (user_id;username;purchase_date) или None, если их нет."""
+    verified = USERS.page(verified_only=True)
+    if not verified:
+        return None
+    output = io.StringIO()
+    writer = csv.writer(output, delimiter=";")
+    writer.writerow(["user_id", "username", "purchase_date"])
+    for uid, u in verified:
+        writer.writerow([uid, u.get("username",""), u.get("purchase_date","")])
+    data = output.getvalue().encode("utf-8")
+    output.close()
+    return data
+
+async def build_buyers_csv_async() -> Optional[bytes]:
+    return await run_io(build_buyers_csv)
 
 # ---------------------------
 # КЛАВИАТУРЫ
@@ -1063,7 +4504,7 @@ def kb_ai_choice_main() -> InlineKeyboardMarkup:
         [InlineKeyboardButton(text="↩️ В меню", callback_data="back_to_main")],
     ])
     
-def kb_start(user_id: int) -> InlineKeyboardMarkup:
+def kb_start(user_id: int, verified: Optional[bool] = None) -> InlineKeyboardMarkup:
     """
     Главное меню.
     - Админ: Админ панель + ИИ + О нас + Поддержка
@@ -1072,7 +4513,8 @@ def kb_start(user_id: int) -> InlineKeyboardMarkup:
     Всё в два столбца (kb.adjust).
     """
     kb = InlineKeyboardBuilder()
-    verified = is_user_verified(user_id)
+    if verified is None:
+        verified = is_user_verified(user_id)
     admin = is_admin(user_id)
 
     # --- Меню для администратора ---
@@ -1139,11 +4581,20 @@ from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
     
     # ✅ Универсальный выбор меню для клиента/админа
-def _menu_kb_for(user_id: int) -> InlineKeyboardMarkup:
+def _menu_kb_for(user_id: int, verified: Optional[bool] = None) -> InlineKeyboardMarkup:
     is_admin = (user_id == ADMIN_ID)
-    if is_user_verified(user_id):
+    if verified is None:
+        verified = is_user_verified(user_id)
+    if verified:
         return kb_after_payment(is_admin=is_admin)
-    return kb_start(user_id)
+    return kb_start(user_id, verified)
+
+# из хэндлеров — эти: статус оплаты читается через users_read()
+async def kb_start_async(user_id: int) -> InlineKeyboardMarkup:
+    return kb_start(user_id, await users_read(is_user_verified, user_id))
+
+async def _menu_kb_for_async(user_id: int) -> InlineKeyboardMarkup:
+    return _menu_kb_for(user_id, await users_read(is_user_verified, user_id))
 
 def kb_back_main() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
@@ -1197,32 +4648,32 @@ def kb_about() -> InlineKeyboardMarkup:
     kb.button(text="📘 Презентация", callback_data="open_presentation")
     kb.button(text="↩️ Назад", callback_data="back_to_main")
     kb.adjust(2, 1)  # FAQ + Презентация / Назад
-    return kb.as_markup()    
+    return kb.as_markup()
 
-    def kb_ai_chat(is_admin: bool = False) -> InlineKeyboardMarkup:
-        kb = InlineKeyboardBuilder()
+def kb_ai_chat(is_admin: bool = False) -> InlineKeyboardMarkup:
+    kb = InlineKeyboardBuilder()
 
-        # Общие кнопки для всех
-        kb.button(
-            text="⏹️ Завершить чат",
-            callback_data=("ai_admin_close" if is_admin else "ai_close")
-        )
-        kb.button(text="↩️ В меню", callback_data="back_to_main")
+    # Общие кнопки для всех
+    kb.button(
+        text="⏹️ Завершить чат",
+        callback_data=("ai_admin_close" if is_admin else "ai_close")
+    )
+    kb.button(text="↩️ В меню", callback_data="back_to_main")
 
-        # Дополнительные инструменты для админа
-        if is_admin:
-            kb.button(text="📥 Покупатели", callback_data="admin_buyers")
-            kb.button(text="📤 Экспорт CSV", callback_data="admin_export_buyers")
-            kb.button(text="💾 Backup", callback_data="create_backup")
-            kb.button(text="♻️ Restore", callback_data="admin_restore")
+    # Дополнительные инструменты для админа
+    if is_admin:
+        kb.button(text="📥 Покупатели", callback_data="admin_buyers")
+        kb.button(text="📤 Экспорт CSV", callback_data="admin_export_buyers")
+        kb.button(text="💾 Backup", callback_data="create_backup")
+        kb.button(text="♻️ Restore", callback_data="admin_restore")
 
-            # Раскладка: первая строка — завершить/меню, затем по 2 кнопки в ряд
-            kb.adjust(2, 2, 2)
-        else:
-            # Для обычного пользователя — 2 кнопки в одной строке
-            kb.adjust(2)
+        # Раскладка: первая строка — завершить/меню, затем по 2 кнопки в ряд
+        kb.adjust(2, 2, 2)
+    else:
+        # Для обычного пользователя — 2 кнопки в одной строке
+        kb.adjust(2)
 
-        return kb.as_markup()
+    return kb.as_markup()
 
 def kb_admin_back() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
@@ -1300,7 +4751,7 @@ async def start_handler(message: types.Message):
 
     await message.answer(
         welcome_text,
-        reply_markup=kb_start(user_id),
+        reply_markup=await kb_start_async(user_id),
         parse_mode="HTML",
     )
     
@@ -1462,7 +4913,7 @@ async def ai_demo_open_cb(callback: types.CallbackQuery, state: FSMContext):
 
 @dp.callback_query(F.data == "open_ai_modes")
 async def open_ai_modes_cb(callback: types.CallbackQuery):
-    if not is_user_verified(callback.from_user.id):
+    if not await users_read(is_user_verified, callback.from_user.id):
         await _safe_cb_answer(callback, "Доступно после оплаты.", show_alert=True)
         return
     await _safe_cb_answer(callback)
@@ -1489,7 +4940,7 @@ async def back_to_main_cb(callback: types.CallbackQuery):
     await _safe_cb_answer(callback)
     await callback.message.edit_text(
         "🏠 Главное меню:",
-        reply_markup=kb_start(callback.from_user.id),
+        reply_markup=await kb_start_async(callback.from_user.id),
         parse_mode="HTML",
     )
 
@@ -1550,7 +5001,7 @@ async def open_presentation_cb(callback: types.CallbackQuery):
 
 @dp.callback_query(F.data == "ai_standard_open")
 async def ai_standard_open_cb(callback: types.CallbackQuery, state: FSMContext):
-    if not is_user_verified(callback.from_user.id):
+    if not await users_read(is_user_verified, callback.from_user.id):
         await _safe_cb_answer(callback, "Доступно после оплаты.", show_alert=True)
         return
     await _safe_cb_answer(callback)
@@ -1564,7 +5015,7 @@ async def ai_standard_open_cb(callback: types.CallbackQuery, state: FSMContext):
 
 @dp.callback_query(F.data == "ai_generator_open")
 async def ai_generator_open_cb(callback: types.CallbackQuery, state: FSMContext):
-    if not is_user_verified(callback.from_user.id):
+    if not await users_read(is_user_verified, callback.from_user.id):
         await _safe_cb_answer(callback, "Доступно после оплаты.", show_alert=True)
         return
     await _safe_cb_answer(callback)
@@ -1576,7 +5027,7 @@ async def ai_generator_open_cb(callback: types.CallbackQuery, state: FSMContext)
         parse_mode="HTML",
     )               
 
-@dp.callback_query(F.data == "ai_admin_open")
+@dp.callback_query(F.data == "ai_admin_open", flags={"rate_limit": "ai_admin"})
 async def ai_admin_open_cb(callback: types.CallbackQuery, state: FSMContext):
     uid = callback.from_user.id
 
@@ -1584,11 +5035,6 @@ async def ai_admin_open_cb(callback: types.CallbackQuery, state: FSMContext):
         await _safe_cb_answer(callback, "Только для администраторов.", show_alert=True)
         return
 
-    # ⛔️ Анти-спам: если админ слишком часто нажимает
-    if _admin_ai_too_fast(uid):
-        await _safe_cb_answer(callback, "Слишком часто. Подожди секунду.")
-        return
-
     await _safe_cb_answer(callback)
     await state.set_state(AIChatStates.chatting)
     await state.update_data(ai_is_admin=True, ai_mode="admin")
@@ -1603,14 +5049,14 @@ async def ai_close_cb(callback: types.CallbackQuery, state: FSMContext):
     await _safe_cb_answer(callback)
     await state.clear()
     uid = callback.from_user.id
-    await callback.message.answer("Чат закрыт. Чем ещё помочь?", reply_markup=_menu_kb_for(uid), parse_mode="HTML")
+    await callback.message.answer("Чат закрыт. Чем ещё помочь?", reply_markup=await _menu_kb_for_async(uid), parse_mode="HTML")
 
 
 @dp.callback_query(F.data == "ai_admin_close")
 async def ai_admin_close_cb(callback: types.CallbackQuery, state: FSMContext):
     await _safe_cb_answer(callback, "Чат ИИ (админ) закрыт")
     await state.clear()
-    await callback.message.answer("Чат ИИ (админ) закрыт.", reply_markup=_menu_kb_for(ADMIN_ID), parse_mode="HTML")
+    await callback.message.answer("Чат ИИ (админ) закрыт.", reply_markup=await _menu_kb_for_async(ADMIN_ID), parse_mode="HTML")
 
 # ---------------------------
 # ВСПОМОГАТЕЛЬНОЕ: ПАГИНАЦИЯ пользователей для «Связаться»
@@ -1620,33 +5066,16 @@ def _paginate_users(page: int = 1, per_page: int = 10, verified_only: bool = Fal
     Возвращает (items, page, pages, total), где:
       items: список кортежей (user_id:int, username:str, verified:bool, purchase_date:str|None)
     """
-    users = load_paid_users()
-    items = []
-    for uid, rec in users.items():
-        if not isinstance(rec, dict):
-            continue
-        if verified_only and not rec.get("verified"):
-            continue
-        try:
-            uid_int = int(uid)
-        except Exception:
-            continue
-        items.append((
-            uid_int,
-            rec.get("username", "unknown"),
-            bool(rec.get("verified", False)),
-            rec.get("purchase_date")
-        ))
-
-    # сортировка: сначала verified, потом по дате (свежие выше)
-    items.sort(key=lambda x: (not x[2], x[3] or ""), reverse=True)
-
-    total = len(items)
+    # сортировка: сначала verified, потом по дате (свежие выше) — делает хранилище
+    total = USERS.count(verified_only=verified_only)
     pages = max(1, (total + per_page - 1) // per_page)
     page = max(1, min(page, pages))
     start = (page - 1) * per_page
-    end = start + per_page
-    return items[start:end], page, pages, total
+    items = [
+        (uid, rec.get("username", "unknown"), bool(rec.get("verified", False)), rec.get("purchase_date"))
+        for uid, rec in USERS.page(start, per_page, verified_only=verified_only)
+    ]
+    return items, page, pages, total
 
 def kb_admin_contact_list(page: int, pages: int, verified_only: bool) -> InlineKeyboardMarkup:
     """Нижняя панель навигации в списке пользователей."""
@@ -1694,7 +5123,7 @@ async def admin_contact_open_cb(callback: types.CallbackQuery, state: FSMContext
         return
     await _safe_cb_answer(callback)  # сразу снимаем «часики»
 
-    users_page, page, pages, total = _paginate_users(page=1, per_page=10, verified_only=True)
+    users_page, page, pages, total = await users_read(_paginate_users, page=1, per_page=10, verified_only=True)
 
     lines = [
         "👤 <b>Выбор пользователя для общения</b>\n",
@@ -1732,7 +5161,7 @@ async def admin_contact_page_cb(callback: types.CallbackQuery, state: FSMContext
     page = int(m.group(1))
     verified_only = bool(int(m.group(2)))
 
-    users_page, page, pages, total = _paginate_users(page=page, per_page=10, verified_only=verified_only)
+    users_page, page, pages, total = await users_read(_paginate_users, page=page, per_page=10, verified_only=verified_only)
 
     lines = [f"👤 <b>Выбор пользователя</b>  |  страница {page}/{pages}\n", f"Пользователи: {total}\n"]
     for uid, uname, ver, _ in users_page:
@@ -1768,7 +5197,7 @@ async def admin_contact_toggle_cb(callback: types.CallbackQuery, state: FSMConte
     verified_only = bool(int(m.group(1)))
     page = int(m.group(2))
 
-    users_page, page, pages, total = _paginate_users(page=page, per_page=10, verified_only=verified_only)
+    users_page, page, pages, total = await users_read(_paginate_users, page=page, per_page=10, verified_only=verified_only)
 
     lines = [f"👤 <b>Выбор пользователя</b>  |  страница {page}/{pages}\n", f"Пользователи: {total}\n"]
     for uid, uname, ver, _ in users_page:
@@ -1797,10 +5226,9 @@ async def admin_contact_pick_cb(callback: types.CallbackQuery, state: FSMContext
     await _safe_cb_answer(callback)
 
     uid = int(callback.data.split("_")[-1])
-    users = load_paid_users()
-    rec = users.get(str(uid)) or {}
-    uname = rec.get("username", "unknown")
-    ver = rec.get("verified", False)
+    rec = await users_read(USERS.record, uid)
+    uname = rec.username if rec else "unknown"
+    ver = bool(rec and rec.verified)
 
     text = (
         "👤 <b>Пользователь выбран</b>\n\n"
@@ -1926,7 +5354,7 @@ async def admin_chat_end_cb(callback: types.CallbackQuery, state: FSMContext):
             await bot.send_message(
                 uid,
                 "✅ Диалог с администратором завершён.",
-                reply_markup=_menu_kb_for(uid),
+                reply_markup=await _menu_kb_for_async(uid),
                 parse_mode="HTML"
             )
 
@@ -1936,7 +5364,7 @@ async def admin_chat_end_cb(callback: types.CallbackQuery, state: FSMContext):
     try:
         await callback.message.edit_text(
             "⛔ Диалог закрыт.",
-            reply_markup=_menu_kb_for(ADMIN_ID),
+            reply_markup=await _menu_kb_for_async(ADMIN_ID),
             parse_mode="HTML"
         )
     except Exception:
@@ -1944,7 +5372,7 @@ async def admin_chat_end_cb(callback: types.CallbackQuery, state: FSMContext):
             await bot.send_message(
                 callback.message.chat.id,
                 "⛔ Диалог закрыт.",
-                reply_markup=_menu_kb_for(ADMIN_ID),
+                reply_markup=await _menu_kb_for_async(ADMIN_ID),
                 parse_mode="HTML"
             )
 
@@ -1990,7 +5418,7 @@ async def admin_chat_relay_media(message: types.Message, state: FSMContext):
         await message.answer(f"❌ Ошибка отправки: {e}")
 
 # Пользователь → админ: ТЕКСТ (если есть активный канал)
-@dp.message(StateFilter(None), F.text & ~F.text.startswith("/"))
+@dp.message(StateFilter(None), F.text & ~F.text.startswith("/"), flags={"rate_limit": "relay"})
 async def user_chat_relay_text(message: types.Message, state: FSMContext):
     """
     Обработка текстовых сообщений вне состояний:
@@ -2032,7 +5460,7 @@ async def user_chat_relay_text(message: types.Message, state: FSMContext):
         await state.set_state(AIChatStates.chatting)
         await state.update_data(ai_is_admin=False)
 
-        verified = is_user_verified(uid)
+        verified = await users_read(is_user_verified, uid)
         if verified:
             await message.answer(
                 "🤖 Готов к диалогу. Спроси про материалы, запуск или маркетинг.",
@@ -2051,7 +5479,7 @@ async def user_chat_relay_text(message: types.Message, state: FSMContext):
             else:
                 await message.answer(
                     "⚠️ Демо-режим временно отключён. Для полного доступа оформите покупку.",
-                    reply_markup=_menu_kb_for(message.from_user.id), parse_mode="HTML"
+                    reply_markup=await _menu_kb_for_async(message.from_user.id), parse_mode="HTML"
                 )
         return
 
@@ -2066,17 +5494,17 @@ async def user_chat_relay_text(message: types.Message, state: FSMContext):
         return
 
     # ---- если ничего не подошло ----
-    if is_user_verified(uid):
+    if await users_read(is_user_verified, uid):
         await message.answer(
             "💬 Нужна помощь? Напишите «поддержка» или нажмите кнопку ниже:",
-            reply_markup=_menu_kb_for(message.from_user.id),
+            reply_markup=await _menu_kb_for_async(message.from_user.id),
             parse_mode="HTML"
         )
     else:
         await message.answer(
             "👋 Доступ к файлам появится после подтверждения оплаты.\n"
             "А пока можно попробовать 🤖 демо-чат с ИИ (кнопка ниже).",
-            reply_markup=_menu_kb_for(message.from_user.id),
+            reply_markup=await _menu_kb_for_async(message.from_user.id),
             parse_mode="HTML"
         )
  
@@ -2091,7 +5519,7 @@ async def user_chat_relay_text(message: types.Message, state: FSMContext):
         logging.warning("Relay user text error: %s", e)
 
 # Пользователь → админ: МЕДИА
-@dp.message(StateFilter(None), F.photo | F.document | F.video | F.animation | F.audio | F.voice)
+@dp.message(StateFilter(None), F.photo | F.document | F.video | F.animation | F.audio | F.voice, flags={"rate_limit": "relay"})
 async def user_chat_relay_media(message: types.Message, state: FSMContext):
     # ⛔ Если ждём скрин оплаты — не перехватываем!
     current = await state.get_state()
@@ -2162,7 +5590,124 @@ async def _safe_send_answer(msg: types.Message, text: str, markup=None):
         plain = re.sub(r"<[^>]+>", "", text or "")
         await msg.answer(plain, reply_markup=markup)
 
-@dp.message(AIChatStates.chatting, F.text & ~F.text.startswith("/"))
+AI_STREAM_ENABLED = (os.getenv("AI_STREAM_ENABLED", "true").lower() == "true")
+AI_STREAM_EDIT_INTERVAL_SEC = float(os.getenv("AI_STREAM_EDIT_INTERVAL_SEC") or 1.5)  # Telegram: ~1 правка/сек на чат
+AI_STREAM_MIN_CHARS = int(os.getenv("AI_STREAM_MIN_CHARS") or 40)  # не дёргать правку ради пары символов
+TG_TEXT_LIMIT = 4096  # в UTF-16 code units, как считает Telegram
+
+def _utf16_len(text: str) -> int:
+    """Длина текста для лимита Telegram: символ вне BMP (эмодзи) — две единицы."""
+    return len(text.encode("utf-16-le")) // 2
+
+def _utf16_tail(text: str, limit: int) -> str:
+    """Самый длинный хвост text не длиннее limit в UTF-16."""
+    units = 0
+    for i in range(len(text) - 1, -1, -1):
+        units += 2 if ord(text[i]) > 0xFFFF else 1
+        if units > limit:
+            return text[i + 1:]
+    return text
+
+def _split_utf16(text: str, limit: int = TG_TEXT_LIMIT) -> List[str]:
+    """
+    Нарезка под лимит Telegram в UTF-16: по последнему переводу строки (или пробелу)
+    во второй половине куска и никогда не внутри HTML-тега.
+    """
+    chunks: List[str] = []
+    while _utf16_len(text) > limit:
+        units, cut = 0, 0
+        for ch in text:
+            units += 2 if ord(ch) > 0xFFFF else 1
+            if units > limit:
+                break
+            cut += 1
+        brk = text.rfind("\n", 0, cut)
+        if brk < cut // 2:
+            brk = text.rfind(" ", 0, cut)
+        if brk >= cut // 2:
+            cut = brk + 1
+        lt = text.rfind("<", 0, cut)
+        if lt > 0 and lt > text.rfind(">", 0, cut):
+            cut = lt
+        chunks.append(text[:cut])
+        text = text[cut:]
+    chunks.append(text)
+    return chunks
+
+async def _answer_html(message: types.Message, text: str, markup=None):
+    """Ответ в HTML; невалидная разметка (например, тег разорван на стыке кусков) — без неё."""
+    try:
+        return await message.answer(text, reply_markup=markup, parse_mode="HTML")
+    except TelegramBadRequest:
+        return await message.answer(re.sub(r"<[^>]+>", "", text), reply_markup=markup, parse_mode=None)
+
+async def _stream_edit(msg: types.Message, text: str, markup=None, html: bool = False) -> bool:
+    """Правка сообщения со стримом; False — Telegram попросил подождать (или текст не сменился)."""
+    try:
+        await msg.edit_text(text, reply_markup=markup, parse_mode="HTML" if html else None)
+        return True
+    except TelegramRetryAfter as e:
+        logging.info("[AI-STREAM] edit throttled by Telegram for %ss", e.retry_after)
+        return False
+    except TelegramBadRequest as e:
+        if "message is not modified" in str(e).lower():
+            return False
+        if html:
+            # модель прислала невалидный HTML — финал без разметки
+            await msg.edit_text(re.sub(r"<[^>]+>", "", text), reply_markup=markup, parse_mode=None)
+            return True
+        raise
+
+async def _stream_ai_answer(message: types.Message, prepared_messages: List[Dict[str, str]],
+                            suffix: str = "", markup=None) -> Tuple[str, bool]:
+    """
+    Ответ ИИ с прогрессивной правкой: заглушка → текст по мере генерации (не чаще
+    AI_STREAM_EDIT_INTERVAL_SEC) → финал в HTML с клавиатурой.
+    Возвращает (ответ, complete); complete=False — стрим оборвался на середине.
+    Если стрим не начался — обычный запрос без стрима.
+    """
+    placeholder = await message.answer("💭 …")
+    parts: List[str] = []
+    shown = 0
+    loop = asyncio.get_running_loop()
+    next_edit = loop.time() + AI_STREAM_EDIT_INTERVAL_SEC
+    interrupted = False
+    try:
+        async for piece in _ai_stream(prepared_messages):
+            parts.append(piece)
+            now = loop.time()
+            size = sum(map(len, parts))
+            if now >= next_edit and size - shown >= AI_STREAM_MIN_CHARS:
+                # черновик — без разметки (тег может быть недописан); длинный — показываем хвост
+                text = re.sub(r"<[^>]*>?$|<[^>]+>", "", "".join(parts))
+                draft = text if _utf16_len(text) < TG_TEXT_LIMIT - 2 else "…" + _utf16_tail(text, TG_TEXT_LIMIT - 4)
+                if not await _stream_edit(placeholder, draft + " ▍"):
+                    next_edit = now + AI_STREAM_EDIT_INTERVAL_SEC * 3
+                    continue
+                shown, next_edit = size, now + AI_STREAM_EDIT_INTERVAL_SEC
+    except asyncio.CancelledError:
+        raise
+    except AIStreamError as e:
+        parts = [str(e)]
+    except Exception as e:
+        if parts:
+            logging.warning("[AI-STREAM] interrupted after %s chars: %s", sum(map(len, parts)), e)
+            interrupted = True
+        else:
+            logging.warning("[AI-STREAM] no tokens (%s), falling back to plain request", e)
+            parts = [await _ai_complete_demo(message.from_user.id, False, prepared_messages)]
+
+    reply = "".join(parts) or "⚠️ Пустой ответ."
+    final = reply + ("\n\n<i>⚠️ Ответ прерван — повторите вопрос.</i>" if interrupted else "") + suffix
+    # длинный ответ: начало — в заглушку, остальное — следующими сообщениями; везде HTML,
+    # клавиатура — у последнего
+    chunks = _split_utf16(final)
+    await _stream_edit(placeholder, chunks[0], markup if len(chunks) == 1 else None, html=True)
+    for i, chunk in enumerate(chunks[1:], 1):
+        await _answer_html(message, chunk, markup if i == len(chunks) - 1 else None)
+    return reply, not interrupted
+
+@dp.message(AIChatStates.chatting, F.text & ~F.text.startswith("/"), flags={"rate_limit": "ai"})
 async def ai_chat_handler(message: types.Message, state: FSMContext):
     logging.info("[AI-HANDLER] enter uid=%s text_len=%s", message.from_user.id, len(message.text or ""))
     data = await state.get_data()
@@ -2174,58 +5719,31 @@ async def ai_chat_handler(message: types.Message, state: FSMContext):
         return
 
     # ✅ БЛОК ПРОВЕРКИ ПРАВ ДОСТУПА ДЛЯ АДМИН-ИИ
-    if ai_mode == "admin" and not is_admin(uid):
+    if ai_mode == "admin" and uid != ADMIN_ID:
         await message.answer("❌ Этот режим доступен только администраторам.", parse_mode="HTML")
         return    
 
     # до оплаты демо только для консультанта/универсала; brand/pay — без лимитов
-    verified = is_user_verified(uid)  # sync
+    verified = await users_read(is_user_verified, uid)
     is_demo_allowed = (not verified) and DEMO_AI_ENABLED and (not is_admin) and (ai_mode in ("", "universal"))
 
     # демо-лимиты
     if is_demo_allowed:
-        ok, reason = _demo_quota_ok(uid)
+        ok, reason = await _demo_quota_ok(uid)
         if not ok:
             logging.info("[AI-HANDLER] demo quota blocked uid=%s reason=%s", uid, reason)
-            await _safe_send_answer(message, "⚠️ " + reason, _menu_kb_for(message.from_user.id))
+            await _safe_send_answer(message, "⚠️ " + reason, await _menu_kb_for_async(message.from_user.id))
             return
 
-    # История: в демо — короче
+    # История: в демо — короче (и по числу реплик, и по бюджету токенов)
     desired_hist = max(2, min(6, AI_MAX_HISTORY)) if is_demo_allowed else None
-    _push_history(uid, is_admin, "user", user_text, desired=desired_hist)
-
-    # Строим сообщения для модели
-    msgs = _build_messages(uid, is_admin, user_text, is_demo=is_demo_allowed)
-
-    # Подмена системного промпта под режим
-    if msgs and msgs[0].get("role") == "system":
-        if   ai_mode == "demo":
-            msgs[0]["content"] = _fmt_prompt(AI_SYSTEM_PROMPT_DEMO_RAW, user_id=uid, is_admin=is_admin)
-        elif ai_mode == "standard":
-            msgs[0]["content"] = _fmt_prompt(AI_SYSTEM_PROMPT_STANDARD_RAW, user_id=uid, is_admin=is_admin)
-        elif ai_mode == "generator":
-            msgs[0]["content"] = _fmt_prompt(AI_SYSTEM_PROMPT_GENERATOR_RAW, user_id=uid, is_admin=is_admin)
-        elif ai_mode == "setup":
-            msgs[0]["content"] = _fmt_prompt(AI_SYSTEM_PROMPT_SETUP_RAW, user_id=uid, is_admin=is_admin)
-        elif ai_mode == "admin":  # ⬅️ новое
-            msgs[0]["content"] = _fmt_prompt(AI_SYSTEM_PROMPT_ADMIN_RAW, user_id=uid, is_admin=is_admin)
-        else:
-            msgs[0]["content"] = _fmt_prompt(AI_SYSTEM_PROMPT_DEMO_RAW, user_id=uid, is_admin=is_admin)
-
-    # «печатает…»
-    with suppress(Exception):
-        await bot.send_chat_action(message.chat.id, "typing")
-
-    # Вызов модели
-    try:
-        logging.info("[AI-HANDLER] call model=%s demo_allowed=%s admin=%s mode=%s",
-                     OPENAI_MODEL, is_demo_allowed, is_admin, ai_mode or "consultant")
-        reply = await _ai_complete_demo(uid, is_admin, msgs)
-    except Exception as e:
-        logging.warning("AI call failed, retry once: %s", e)
-        reply = await _ai_complete_demo(uid, is_admin, msgs)
+    budget_mode = "demo" if is_demo_allowed else (ai_mode or ("admin" if is_admin else "default"))
 
-    _push_history(uid, is_admin, "assistant", reply, desired=desired_hist)
+    # Строим сообщения для модели: системный промпт режима — сразу из реестра
+    # (вопрос — последним, в историю кладём после)
+    msgs = _build_messages(uid, is_admin, user_text, is_demo=is_demo_allowed, mode=budget_mode,
+                           prompt=_prompt_mode_for(ai_mode, is_demo_allowed, is_admin))
+    _push_history(uid, is_admin, "user", msgs[-1]["content"], desired=desired_hist)
 
     # Демо-приписка — только до оплаты
     suffix = ""
@@ -2233,25 +5751,73 @@ async def ai_chat_handler(message: types.Message, state: FSMContext):
         cta = "Нажмите «В меню» ниже → «Оплата по СБП (QR)»."
         suffix = f"\n\n—\n<i>Это демо-режим (есть лимит по сообщениям). Чтобы получить полный доступ и файлы, {cta}</i>"
 
-    logging.info("[AI-HANDLER] reply_len=%s", len(reply or ""))
-
     # ВСЕГДА минимальная клава для клиента в режиме ИИ
     reply_kb = kb_ai_chat(is_admin=is_admin)
 
-    await _safe_send_answer(
-        message,
-        (reply or "⚠️ Пустой ответ.") + suffix,
-        reply_kb
-    )
+    # «печатает…»
+    with suppress(Exception):
+        await bot.send_chat_action(message.chat.id, "typing")
+
+    # Повторный вопрос — из кэша; такой же вопрос уже в работе — ждём его ответ
+    cache_key = AI_CACHE.key(ai_mode, msgs) if AI_CACHE.enabled_for(ai_mode) else None
+    flight_key = AI_FLIGHTS.key(msgs) if AI_FLIGHTS.shareable(ai_mode, is_admin) else None
+    reply = AI_CACHE.get(cache_key) if cache_key else None
+    source = "cache"
+    if reply is None and flight_key and (pending := AI_FLIGHTS.waiter(flight_key)) is not None:
+        reply, source = await AI_FLIGHTS.wait(pending), "coalesced"
+    if reply is not None:
+        logging.info("[AI-HANDLER] %s uid=%s mode=%s", source, uid, ai_mode or "consultant")
+        await _safe_send_answer(message, reply + suffix, reply_kb)
+    else:
+        # Вызов модели
+        logging.info("[AI-HANDLER] call model=%s demo_allowed=%s admin=%s mode=%s stream=%s prompt_chars=%s",
+                     OPENAI_MODEL, is_demo_allowed, is_admin, ai_mode or "consultant", AI_STREAM_ENABLED,
+                     sum(len(m["content"]) for m in msgs))
+        prio = _ai_priority(uid, is_admin, verified, ai_mode)
+        with (AI_FLIGHTS.lead(flight_key) if flight_key else nullcontext({})) as flight:
+            try:
+                # место среди одновременных вызовов — по приоритету; демо при полной очереди — сразу «занято»
+                async with AI_SCHED.slot(prio):
+                    complete = True
+                    if AI_STREAM_ENABLED:
+                        # заглушка правится по мере генерации, финал — с клавиатурой
+                        reply, complete = await _stream_ai_answer(message, msgs, suffix, reply_kb)
+                    else:
+                        try:
+                            reply = await _ai_complete_demo(uid, is_admin, msgs)
+                        except Exception as e:
+                            logging.warning("AI call failed, retry once: %s", e)
+                            reply = await _ai_complete_demo(uid, is_admin, msgs)
+                        await _safe_send_answer(
+                            message,
+                            (reply or "⚠️ Пустой ответ.") + suffix,
+                            reply_kb
+                        )
+            except AIBusy as e:
+                logging.info("[AI-HANDLER] busy uid=%s prio=%s: %s", uid, AI_PRIO_NAMES[prio], e)
+                dq = _user_histories.get(_hist_key(uid, is_admin))
+                if dq:
+                    dq.pop()  # вопрос без ответа — из истории
+                await _safe_send_answer(
+                    message, "⏳ Сейчас очень много запросов к ИИ. Повторите вопрос через минуту.", reply_kb
+                )
+                return
+            if complete and reply and not reply.startswith("⚠️"):
+                flight["reply"] = reply
+        if cache_key and complete:
+            AI_CACHE.put(cache_key, reply)
+
+    _push_history(uid, is_admin, "assistant", reply, desired=desired_hist)
+    logging.info("[AI-HANDLER] reply_len=%s", len(reply or ""))
 
     if is_demo_allowed:
-        _demo_register_hit(uid)
+        await _demo_register_hit(uid)
 
 
 @dp.message(Command("ai"))
 async def ai_open_cmd(message: types.Message, state: FSMContext):
     uid = message.from_user.id
-    verified = is_user_verified(uid)
+    verified = await users_read(is_user_verified, uid)
 
     await state.set_state(AIChatStates.chatting)
     await state.update_data(ai_is_admin=False)
@@ -2263,7 +5829,7 @@ async def ai_open_cmd(message: types.Message, state: FSMContext):
         )
     else:
         await message.answer(
-            f"🧪 Демо-режим: до {DEMO_AI_DAILY_LIMIT} сообщений/день, пауза {DEMO_AI_COOLDOWN_SEC} сек.\n"
+            f"🧪 Демо-режим: до {DEMO_AI_DAILY_LIMIT} сообщений/день, пауза {DEMO_QUOTAS.cooldown_sec} сек.\n"
             "Задайте вопрос — отвечу кратко и по делу.",
             reply_markup=kb_ai_chat(is_admin=False)
         )
@@ -2306,21 +5872,21 @@ async def back_to_main_cb(callback: types.CallbackQuery):
                 document=PRESENTATION_FILE_ID,
                 caption=text,
                 parse_mode="HTML",
-                reply_markup=_menu_kb_for(callback.from_user.id)
+                reply_markup=await _menu_kb_for_async(callback.from_user.id)
             )
         elif PRESENTATION_URL:
             await callback.message.answer_document(
                 document=PRESENTATION_URL,
                 caption=text,
                 parse_mode="HTML",
-                reply_markup=_menu_kb_for(callback.from_user.id)
+                reply_markup=await _menu_kb_for_async(callback.from_user.id)
             )
         else:
             # Если нет файла вообще — просто текст
             await callback.message.answer(
                 text,
                 parse_mode="HTML",
-                reply_markup=_menu_kb_for(callback.from_user.id)
+                reply_markup=await _menu_kb_for_async(callback.from_user.id)
             )
 
     except Exception as e:
@@ -2329,24 +5895,24 @@ async def back_to_main_cb(callback: types.CallbackQuery):
         await callback.message.answer(
             text,
             parse_mode="HTML",
-            reply_markup=_menu_kb_for(callback.from_user.id)
+            reply_markup=await _menu_kb_for_async(callback.from_user.id)
         )
 
 # ---------------------------
 # АДМИН: /admin + общий рендер панели
 # ---------------------------
 def _render_admin_home_text() -> str:
-    users = load_paid_users()
-    verified = [u for u in users.values() if isinstance(u, dict) and u.get("verified")]
+    total = USERS.count()
+    verified = USERS.count(verified_only=True)
     return (
         "👑 <b>Панель администратора</b>\n\n"
-        f"💰 Подтвержденных: {len(verified)}\n"
-        f"👥 Всего записей: {len(users)}\n"
-        f"🎯 Конверсия: {len(verified)/max(len(users),1)*100:.1f}%\n"
+        f"💰 Подтвержденных: {verified}\n"
+        f"👥 Всего записей: {total}\n"
+        f"🎯 Конверсия: {verified/max(total,1)*100:.1f}%\n"
     )
 
 async def _go_admin_home(chat_id: int, as_edit: Optional[types.Message] = None):
-    text = _render_admin_home_text()
+    text = await users_read(_render_admin_home_text)
     if as_edit:
         try:
             await as_edit.edit_text(text, reply_markup=kb_admin_panel(), parse_mode="HTML")
@@ -2360,7 +5926,7 @@ async def admin_handler(message: types.Message):
     if message.from_user.id != ADMIN_ID:
         await message.answer("❌ Нет доступа")
         return
-    await message.answer(_render_admin_home_text(), reply_markup=kb_admin_panel(), parse_mode="HTML")
+    await message.answer(await users_read(_render_admin_home_text), reply_markup=kb_admin_panel(), parse_mode="HTML")
 
 @dp.callback_query(F.data == "admin_home")
 async def admin_home_cb(callback: types.CallbackQuery):
@@ -2390,8 +5956,8 @@ async def clear_db_handler(message: types.Message):
     if message.from_user.id != ADMIN_ID:
         await message.answer("❌ Нет доступа")
         return
-    backup_file = backup_database()
-    clear_database()
+    backup_file = await backup_database_async()
+    await USERS_ACTOR.submit(clear_database)
     text = "🗑️ <b>База очищена.</b>"
     if backup_file:
         text += f"\n💾 Backup: <code>{os.path.basename(backup_file)}</code>"
@@ -2404,8 +5970,9 @@ async def backup_handler(message: types.Message, state: FSMContext):
         return
 
     try:
-        # 1) Создаём ZIP и получаем метаданные
-        zip_path, human, changes_text = make_backup_zip_file()
+        # 1) Создаём ZIP и получаем метаданные. Ручной бэкап всегда полный:
+        #    архив уходит админу и должен восстанавливаться сам, без цепочки дельт
+        zip_path, human, changes_text = await make_backup_zip_file_async(force_full=True)
         zip_name = os.path.basename(zip_path)
         size_mb = os.path.getsize(zip_path) / (1024 * 1024)
 
@@ -2440,7 +6007,7 @@ async def backup_handler(message: types.Message, state: FSMContext):
 async def assets_debug(message: types.Message):
     if message.from_user.id != ADMIN_ID:
         return await message.answer("❌ Нет доступа")
-    d = _load_assets()
+    d = _assets_registry()
     keys = ", ".join(sorted(d.keys())) or "—"
     await message.answer(
         "🧩 <b>kit_assets.json</b>\n"
@@ -2449,7 +6016,119 @@ async def assets_debug(message: types.Message):
         f"guide: {bool((d.get('guide') or {}).get('file_id'))}\n"
         f"presentation: {bool((d.get('presentation') or {}).get('file_id'))}\n"
         f"bot_template: {bool((d.get('bot_template') or {}).get('file_id'))}\n"
-        f"sbp_qr: {bool((d.get('sbp_qr') or {}).get('file_id'))}",
+        f"sbp_qr: {bool((d.get('sbp_qr') or {}).get('file_id'))}\n\n"
+        f"Кэш: hits={_ASSETS_STATS['hits']} misses={_ASSETS_STATS['misses']} reloads={_ASSETS_STATS['reloads']}\n"
+        f"Общий кэш file_id: {len(d.get(FILE_CACHE_ASSET_KEY) or {})} шт., "
+        f"hits={_FILE_CACHE_STATS['hits']} misses={_FILE_CACHE_STATS['misses']} stale={_FILE_CACHE_STATS['stale']}",
+        parse_mode="HTML"
+    )
+
+@dp.message(Command("demo_stats"))
+async def demo_stats_cmd(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return await message.answer("❌ Нет доступа")
+    rows = await run_io(DEMO_QUOTAS.today)
+    st = DEMO_QUOTAS.stats
+    lines = [
+        "🧪 <b>Демо-ИИ за сегодня</b>\n",
+        f"Пользователей: <b>{len(rows)}</b> | сообщений: <b>{sum(r[1] for r in rows)}</b>",
+        f"Лимит: {DEMO_QUOTAS.daily_limit}/день, пауза {DEMO_QUOTAS.cooldown_sec} сек.",
+        f"Проверок: {st['checks']} | отказов: {st['blocked']} | сбросов в базу: {st['flushes']}\n",
+    ]
+    for uid, count, last_ts in rows[:30]:
+        mark = "⛔" if count >= DEMO_QUOTAS.daily_limit else "•"
+        lines.append(f"{mark} <code>{uid}</code> — {count} (последний: {datetime.fromtimestamp(last_ts).strftime('%H:%M')})")
+    if len(rows) > 30:
+        lines.append(f"... и ещё {len(rows) - 30}")
+    await message.answer("\n".join(lines), parse_mode="HTML")
+
+@dp.message(Command("migrate_storage"))
+async def migrate_storage_cmd(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return await message.answer("❌ Нет доступа")
+    arg = ((message.text or "").split()[1:2] or [""])[0].lower()
+    if arg == "status" or (arg == "" and STORAGE_MIGRATION.active):
+        return await message.answer("🗄 <b>Миграция хранилища</b>\n" + STORAGE_MIGRATION.status(), parse_mode="HTML")
+    if arg == "now":
+        STORAGE_MIGRATION.cutover_now()
+        return await message.answer("⏩ Сверка и переключение запущены.")
+    if arg == "abort":
+        await STORAGE_MIGRATION.abort()
+        return await message.answer("⏹ Миграция остановлена, работаем на прежнем хранилище.")
+    if isinstance(USERS, SqliteUserRepository):
+        return await message.answer("ℹ️ Пользователи уже хранятся в SQLite.")
+    if _FSM_MULTI_WORKER:
+        return await message.answer(
+            "⚠️ Запущено несколько воркеров — онлайн-миграция недоступна.\n"
+            "Остановите сервис и выполните <code>python ai_business_kit_bot.py migrate-storage</code>.",
+            parse_mode="HTML"
+        )
+    chat_id = message.chat.id
+
+    async def notify(text: str):
+        with suppress(Exception):
+            await bot.send_message(chat_id, text, parse_mode="HTML")
+
+    total = await users_read(USERS.count)
+    STORAGE_MIGRATION.start(notify)
+    await message.answer(
+        f"🚚 Миграция {STORAGE_BACKEND} → SQLite запущена ({total} записей).\n"
+        "Статус: /migrate_storage status | отмена: /migrate_storage abort"
+    )
+
+@dp.message(Command("reload_prompts"))
+async def reload_prompts_cmd(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return await message.answer("❌ Нет доступа")
+    changed = await run_io(PROMPTS.reload)
+    AI_CACHE.clear()  # ответы под старые промпты больше не годятся
+    await message.answer(
+        "🔄 Промпты перечитаны. Изменились: " + (", ".join(changed) if changed else "—")
+    )
+
+@dp.message(Command("ai_queue"))
+async def ai_queue_cmd(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return await message.answer("❌ Нет доступа")
+    st = AI_SCHED.stats
+    waited = st["queued"] - st["timeouts"] - st["evicted"]
+    by_prio: Dict[str, int] = {}
+    for prio, _, fut in AI_SCHED._heap:
+        if not fut.done():
+            by_prio[AI_PRIO_NAMES[prio]] = by_prio.get(AI_PRIO_NAMES[prio], 0) + 1
+    rates = ", ".join(f"{k} {v['allowed']}/{v['limited']}/{v['global']}" for k, v in RATE_LIMITER.stats.items())
+    await message.answer(
+        "🚦 <b>Очередь к ИИ</b>\n"
+        f"В работе: {AI_SCHED.active}/{AI_SCHED.limit} | в очереди: {AI_SCHED.depth}/{AI_SCHED.queue_max} "
+        f"({', '.join(f'{k}: {v}' for k, v in by_prio.items()) or '—'})\n"
+        f"Макс. очередь: {st['max_depth']} | ожидание: среднее {st['wait_total'] / waited if waited > 0 else 0:.1f} с, "
+        f"макс. {st['wait_max']:.1f} с (лимит {AI_SCHED.max_wait:.0f} с)\n"
+        f"Запущено: {st['started']} | ждали: {st['queued']} | «занято»: {st['busy']} | "
+        f"таймаут: {st['timeouts']} | вытеснено: {st['evicted']}\n"
+        f"Лимиты частоты (пропущено/отбито/из них общим): {rates or '—'}"
+        f" | вёдер: {len(RATE_LIMITER)}, выброшено: {RATE_LIMITER.evicted}",
+        parse_mode="HTML"
+    )
+
+@dp.message(Command("ai_cache"))
+async def ai_cache_cmd(message: types.Message):
+    if message.from_user.id != ADMIN_ID:
+        return await message.answer("❌ Нет доступа")
+    if (message.text or "").split()[1:2] == ["clear"]:
+        AI_CACHE.clear()
+        return await message.answer("🧹 Кэш ответов ИИ очищен.")
+    st, fl = AI_CACHE.stats, AI_FLIGHTS.stats
+    total = st["hits"] + st["misses"]
+    await message.answer(
+        "🧠 <b>Кэш ответов ИИ</b>\n"
+        f"Записей: {len(AI_CACHE)}/{AI_CACHE.size} | TTL: {AI_CACHE.ttl // 60} мин.\n"
+        f"Режимы: {', '.join(sorted(AI_CACHE_MODES)) or '—'}\n"
+        f"Попаданий: {st['hits']} | промахов: {st['misses']} "
+        f"({(100 * st['hits'] / total) if total else 0:.0f}% hit)\n"
+        f"Сохранено: {st['stores']} | вытеснено: {st['evictions']} | устарело: {st['expired']}\n\n"
+        f"Singleflight: вызовов {fl['leaders']} | сэкономлено {fl['coalesced']} | "
+        f"повторено после сбоя {fl['fallbacks']}\n\n"
+        "Очистить: /ai_cache clear",
         parse_mode="HTML"
     )
 
@@ -2504,20 +6183,19 @@ async def remove_user_handler(message: types.Message):
     except Exception:
         await message.answer("Использование: <code>/remove_user USER_ID</code>", parse_mode="HTML")
         return
-    ok = remove_user(user_id)
+    ok = await USERS_ACTOR.submit(remove_user, user_id)
     await message.answer("✅ Удалён" if ok else "❌ Не найден", reply_markup=kb_admin_back())
 
 @dp.message(Command("buyers"))
 async def buyers_handler(message: types.Message):
     if message.from_user.id != ADMIN_ID:
         await message.answer("❌ Нет доступа"); return
-    users = load_paid_users()
-    verified = [(uid, u) for uid, u in users.items() if isinstance(u, dict) and u.get("verified")]
+    verified = await users_read(USERS.page, 0, 70, verified_only=True)
     if not verified:
         await message.answer("📭 Пока нет подтверждённых покупателей.")
         return
     lines = ["👥 <b>Покупатели</b> (первые 70):\n"]
-    for uid, u in verified[:70]:
+    for uid, u in verified:
         line = f"✅ @{u.get('username','unknown')} | ID: {uid}"
         if u.get("purchase_date"):
             line += f" | {u['purchase_date'][:16]}"
@@ -2528,19 +6206,10 @@ async def buyers_handler(message: types.Message):
 async def export_buyers_handler(message: types.Message):
     if message.from_user.id != ADMIN_ID:
         await message.answer("❌ Нет доступа"); return
-    users = load_paid_users()
-    verified = [(uid, u) for uid, u in users.items() if isinstance(u, dict) and u.get("verified")]
-    if not verified:
+    data = await build_buyers_csv_async()
+    if not data:
         await message.answer("📭 Нет данных для экспорта."); return
 
-    output = io.StringIO()
-    writer = csv.writer(output, delimiter=";")
-    writer.writerow(["user_id", "username", "purchase_date"])
-    for uid, u in verified:
-        writer.writerow([uid, u.get("username",""), u.get("purchase_date","")])
-    data = output.getvalue().encode("utf-8")
-    output.close()
-
     await bot.send_document(
         message.chat.id,
         document=types.BufferedInputFile(data, filename=f"buyers_{datetime.now().strftime('%Y%m%d_%H%M')}.csv"),
@@ -2554,14 +6223,13 @@ async def admin_buyers_cb(callback: types.CallbackQuery):
         await _safe_cb_answer(callback, "❌ Нет доступа", show_alert=True); return
     await _safe_cb_answer(callback)
 
-    users = load_paid_users()
-    verified = [(uid, u) for uid, u in users.items() if isinstance(u, dict) and u.get("verified")]
+    verified = await users_read(USERS.page, 0, 70, verified_only=True)
     if not verified:
         await callback.message.edit_text("📭 Пока нет подтверждённых покупателей.", reply_markup=kb_admin_back())
         return
 
     lines = ["👥 <b>Покупатели</b> (первые 70):\n"]
-    for uid, u in verified[:70]:
+    for uid, u in verified:
         line = f"✅ @{u.get('username','unknown')} | ID: {uid}"
         if u.get("purchase_date"):
             line += f" | {u['purchase_date'][:16]}"
@@ -2578,20 +6246,11 @@ async def admin_export_buyers_cb(callback: types.CallbackQuery):
         await _safe_cb_answer(callback, "❌ Нет доступа", show_alert=True); return
     await _safe_cb_answer(callback)
 
-    users = load_paid_users()
-    verified = [(uid, u) for uid, u in users.items() if isinstance(u, dict) and u.get("verified")]
-    if not verified:
+    data = await build_buyers_csv_async()
+    if not data:
         await callback.message.edit_text("📭 Нет данных для экспорта.", reply_markup=kb_admin_back())
         return
 
-    output = io.StringIO()
-    writer = csv.writer(output, delimiter=";")
-    writer.writerow(["user_id", "username", "purchase_date"])
-    for uid, u in verified:
-        writer.writerow([uid, u.get("username",""), u.get("purchase_date","")])
-    data = output.getvalue().encode("utf-8")
-    output.close()
-
     await bot.send_document(
         callback.message.chat.id,
         document=types.BufferedInputFile(data, filename=f"buyers_{datetime.now().strftime('%Y%m%d_%H%M')}.csv"),
@@ -2632,9 +6291,7 @@ async def bind_sbp_qr_cmd(message: types.Message):
         file_id = message.reply_to_message.document.file_id
     if not file_id:
         await message.answer("Нужна картинка или документ с QR."); return
-    d = _load_assets()
-    d["sbp_qr"] = {"file_id": file_id, "updated_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
-    _save_assets(d)
+    set_asset_file_id("sbp_qr", file_id)
     await message.answer("✅ QR СБП привязан по file_id. Теперь будет использоваться кэш.")
 
 @dp.message(Command("bind_prompts"))
@@ -2708,8 +6365,8 @@ async def cb_clear_all(callback: types.CallbackQuery):
         await _safe_cb_answer(callback, "❌ Нет доступа", show_alert=True); return
     await _safe_cb_answer(callback)
 
-    backup_file = backup_database()
-    clear_database()
+    backup_file = await backup_database_async()
+    await USERS_ACTOR.submit(clear_database)
     txt = "🗑️ База данных очищена."
     if backup_file:
         txt += f"\n💾 Backup: <code>{os.path.basename(backup_file)}</code>"
@@ -2721,13 +6378,13 @@ async def cb_admin_stats(callback: types.CallbackQuery):
         await _safe_cb_answer(callback, "❌ Нет доступа", show_alert=True); return
     await _safe_cb_answer(callback)
 
-    users = load_paid_users()
-    verified = [u for u in users.values() if isinstance(u, dict) and u.get("verified")]
+    total = await users_read(USERS.count)
+    verified = await users_read(USERS.count, verified_only=True)
     txt = (
         "📊 <b>Статистика</b>\n\n"
-        f"💰 Подтверждено: {len(verified)}\n"
-        f"👥 Всего: {len(users)}\n"
-        f"🎯 Конверсия: {len(verified)/max(len(users),1)*100:.1f}%"
+        f"💰 Подтверждено: {verified}\n"
+        f"👥 Всего: {total}\n"
+        f"🎯 Конверсия: {verified/max(total,1)*100:.1f}%"
     )
     await callback.message.edit_text(txt, reply_markup=kb_admin_back(), parse_mode="HTML")
 
@@ -2741,8 +6398,8 @@ async def create_backup_cb(callback: types.CallbackQuery, state: FSMContext):
     await _safe_cb_answer(callback)
 
     try:
-        # 1) Создаём ZIP и получаем метаданные
-        zip_path, human, changes_text = make_backup_zip_file()
+        # 1) Создаём ZIP и получаем метаданные (всегда полный — см. /backup)
+        zip_path, human, changes_text = await make_backup_zip_file_async(force_full=True)
         zip_name = os.path.basename(zip_path)
         size_mb = os.path.getsize(zip_path) / (1024 * 1024)
 
@@ -2784,13 +6441,13 @@ async def cb_list_users(callback: types.CallbackQuery):
         await _safe_cb_answer(callback, "❌ Нет доступа", show_alert=True); return
     await _safe_cb_answer(callback)
 
-    users = load_paid_users()
+    users = await users_read(USERS.page, 0, 80)
     if not users:
         await callback.message.edit_text("📭 База пустая", reply_markup=kb_admin_back())
         return
 
     lines = ["👥 <b>Пользователи</b>\n"]
-    for uid, u in list(users.items())[:80]:
+    for uid, u in users:
         mark = "✅" if u.get("verified") else "❌"
         line = f"{mark} @{u.get('username','unknown')} | ID: {uid}"
         if u.get("purchase_date"):
@@ -2907,7 +6564,7 @@ async def process_screenshot(message: types.Message, state: FSMContext):
     order_id = data.get("order_id") or _gen_order_id()
 
     # Подстрахуемся, что юзер записан
-    save_pending_user(user_id, username)
+    await USERS_ACTOR.submit(save_pending_user, user_id, username)
 
     # Кнопки для админа
     kb = InlineKeyboardMarkup(inline_keyboard=[[
@@ -2968,11 +6625,11 @@ async def approve_payment_handler(callback: types.CallbackQuery):
         )
         return
 
-    users = load_paid_users()
-    username = (users.get(str(user_id)) or {}).get("username", "unknown")
+    rec = await users_read(USERS.record, user_id)
+    username = rec.username if rec else "unknown"
 
     # Отмечаем пользователя как оплаченного
-    save_paid_user(user_id, username)
+    await USERS_ACTOR.submit(save_paid_user, user_id, username)
 
     # Выдаём файлы + показываем экран купившего
     try:
@@ -3301,6 +6958,182 @@ async def _broadcast_send_to(user_id: int, p: Dict[str, Any]) -> bool:
         logging.warning("Broadcast fail to %s: %s", user_id, e)
         return False
 
+# === ВОССТАНОВЛЕНИЕ ===
+# Файл качается потоком во временный файл TMP_DIR (с лимитом), разбирается и проверяется
+# в пуле ввода-вывода, затем применяется одним набором в очереди записи пользователей:
+# при ошибке всё откатывается к снимку. После применения перечитываются все кэши процесса.
+RESTORE_MAX_MB = int(os.getenv("RESTORE_MAX_MB") or 20)                    # Bot API больше 20 МБ не отдаёт
+RESTORE_MAX_UNPACKED_MB = int(os.getenv("RESTORE_MAX_UNPACKED_MB") or 200)  # защита от zip-бомб
+
+class _CappedWriter:
+    """Приёмник для bot.download_file: пишет в файл и обрывает закачку сверх лимита."""
+
+    def __init__(self, f, limit: int):
+        self._f, self._limit, self.size = f, limit, 0
+
+    def write(self, chunk: bytes) -> int:
+        self.size += len(chunk)
+        if self.size > self._limit:
+            raise ValueError(f"файл больше {RESTORE_MAX_MB} МБ")
+        return self._f.write(chunk)
+
+    def flush(self):
+        self._f.flush()
+
+def _validate_restore_item(arcname: str, data):
+    if arcname == "users_delta.json":
+        if not isinstance(data, dict) or not isinstance(data.get("put") or {}, dict) \
+                or not isinstance(data.get("del") or [], list):
+            raise ValueError("invalid delta")
+        return
+    if not isinstance(data, dict):
+        raise ValueError("expected JSON object")
+    if arcname == "paid_users.json":
+        for uid, rec in data.items():
+            if not str(uid).lstrip("-").isdigit() or not isinstance(rec, dict):
+                raise ValueError(f"bad record {str(uid)[:20]!r}")
+
+def _load_restore_file(path: str, file_name: str) -> Tuple[List[Tuple[str, str, Any]], Dict[str, Any]]:
+    """Разобрать скачанный файл (в пуле): [(arcname, realpath, data)] и _meta.json. Любая ошибка — ValueError."""
+    if file_name.endswith(".zip"):
+        with zipfile.ZipFile(path) as zf:
+            unpacked = sum(i.file_size for i in zf.infolist())
+            if unpacked > RESTORE_MAX_UNPACKED_MB * 1024 * 1024:
+                raise ValueError(f"архив распаковывается больше чем в {RESTORE_MAX_UNPACKED_MB} МБ")
+        items, errors, meta = _parse_backup_zip(path)
+        if errors:
+            raise ValueError("; ".join(errors))
+        if not items:
+            raise ValueError("в архиве нет файлов базы")
+    else:
+        realpath = BACKUP_FILES.get(file_name)
+        if not realpath:
+            raise ValueError("имя файла не распознано")
+        with open(path, "r", encoding="utf-8") as f:
+            items, meta = [(file_name, realpath, json.load(f))], {}
+    for arcname, _, data in items:
+        try:
+            _validate_restore_item(arcname, data)
+        except ValueError as e:
+            raise ValueError(f"{arcname}: {e}") from None
+    return items, meta
+
+_RESTORE_USER_FILES = ("users_delta.json", "paid_users.json")
+
+async def reload_runtime_caches():
+    """Перечитать всё, что процесс держит в памяти поверх файлов базы."""
+    DEMO_QUOTAS.reset()
+    _invalidate_json_cache(DATA_FILE)
+    await run_io(reload_assets_cache)
+    with suppress(Exception):
+        await migrate_user_file_caches()
+
+def _swap_restored_users(items: List[Tuple[str, str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    В акторе записи: подменить пользователей в памяти (запись на диск — отдельно).
+    Возвращает прежнюю базу для отката или None, если пользователей в наборе нет.
+    """
+    if not any(arcname in _RESTORE_USER_FILES for arcname, _, _ in items):
+        return None
+    users_before = USERS.all()
+    try:
+        with USERS.batch():
+            for arcname, realpath, data in items:
+                if arcname == "users_delta.json":
+                    _apply_users_delta(data)
+                elif arcname == "paid_users.json":
+                    USERS.replace(data)
+    except Exception:
+        USERS.replace(users_before)
+        raise
+    return users_before
+
+def _write_restored_files(items: List[Tuple[str, str, Any]]):
+    for arcname, realpath, data in items:
+        if arcname not in _RESTORE_USER_FILES:
+            _write_json_atomic(realpath, data)
+
+async def apply_restore_set(items: List[Tuple[str, str, Any]]):
+    """
+    Применить файлы бэкапа набором: либо все, либо ни одного.
+    В актор уходит только подмена пользователей в памяти; файлы материалов,
+    сброс базы на диск и перечитывание кэшей идут через run_io.
+    """
+    assets_before = await run_io(_read_json_safe, ASSETS_FILE)
+    users_before = await USERS_ACTOR.submit(_swap_restored_users, items)
+    try:
+        await run_io(_write_restored_files, items)
+        await run_io(USERS.flush)
+    except Exception:
+        logging.exception("[RESTORE] apply failed, rolling back")
+        if users_before is not None:
+            await USERS_ACTOR.submit(USERS.replace, users_before)
+            await run_io(USERS.flush)
+        if assets_before is not None:
+            await run_io(_write_json_atomic, ASSETS_FILE, assets_before)
+        raise
+    finally:
+        await reload_runtime_caches()
+
+def _parse_backup_zip(src) -> Tuple[List[Tuple[str, str, Any]], List[str], Dict[str, Any]]:
+    """Распаковать ZIP-бэкап (путь или буфер): [(arcname, realpath, data)], список ошибок по файлам и _meta.json."""
+    items, errors = [], []
+    with zipfile.ZipFile(src) as zf:
+        names = set(zf.namelist())
+        meta: Dict[str, Any] = {}
+        if "_meta.json" in names:
+            with suppress(Exception):
+                meta = json.loads(zf.read("_meta.json").decode("utf-8"))
+        if meta.get("kind") == "delta" and "users_delta.json" in names:
+            body = zf.read("users_delta.json").decode("utf-8")
+            if hashlib.sha1(((meta.get("parent") or "") + body).encode("utf-8")).hexdigest() != meta.get("hash"):
+                raise ValueError("дельта повреждена (hash не совпадает)")
+            items.append(("users_delta.json", "", json.loads(body)))
+        for arcname, realpath in BACKUP_FILES.items():
+            if arcname in names:
+                try:
+                    data = json.loads(zf.read(arcname).decode("utf-8"))
+                    if data is None:
+                        raise ValueError("invalid json")
+                    items.append((arcname, realpath, data))
+                except Exception as e:
+                    errors.append(f"{arcname}: {e}")
+        # архив только с раскладкой users/bucket_*.json — собираем её в paid_users.json
+        buckets = sorted(n for n in names if n.startswith("users/bucket_") and n.endswith(".json"))
+        if buckets and "paid_users.json" not in names:
+            merged: Dict[str, Any] = {}
+            for arcname in buckets:
+                try:
+                    chunk = json.loads(zf.read(arcname).decode("utf-8"))
+                    if not isinstance(chunk, dict):
+                        raise ValueError("invalid bucket")
+                    merged.update(chunk)
+                except Exception as e:
+                    errors.append(f"{arcname}: {e}")
+            items.insert(0, ("paid_users.json", DATA_FILE, merged))
+    return items, errors, meta
+
+# звено цепочки, на котором стоит восстановление: следующая дельта должна ссылаться на него
+_RESTORE_CURSOR: Dict[str, Any] = {}
+
+def _check_restore_chain(meta: Dict[str, Any]) -> Optional[str]:
+    """None — архив можно применять; иначе текст ошибки."""
+    if meta.get("kind") != "delta":
+        return None
+    if _RESTORE_CURSOR.get("hash") != meta.get("parent"):
+        expected = int(meta.get("seq") or 1) - 1
+        what = "полный архив" if expected == 0 else f"дельту #{expected}"
+        return (f"Это дельта #{meta.get('seq')} — сначала восстановите {what} "
+                f"той же цепочки ({str(meta.get('chain_id'))[:8]}).")
+    return None
+
+def _apply_users_delta(delta: Dict[str, Any]):
+    with USERS.batch():
+        for uid, rec in (delta.get("put") or {}).items():
+            USERS.put(uid, rec)
+        for uid in delta.get("del") or []:
+            USERS.remove(uid)
+
 @dp.message(AdminRestore.waiting_file, F.document)
 async def backup_restore_file(message: types.Message, state: FSMContext):
     if message.from_user.id != ADMIN_ID:
@@ -3308,61 +7141,58 @@ async def backup_restore_file(message: types.Message, state: FSMContext):
 
     doc = message.document
     file_name = (doc.file_name or "").lower()
+    if not file_name.endswith((".zip", ".json")):
+        return await message.answer("⚠️ Пришлите .zip или .json")
+    if file_name.endswith(".json") and file_name not in BACKUP_FILES:
+        return await message.answer(
+            "⚠️ Имя файла не распознано. Ожидаю <code>paid_users.json</code> или <code>kit_assets.json</code>.",
+            parse_mode="HTML"
+        )
+    if (doc.file_size or 0) > RESTORE_MAX_MB * 1024 * 1024:
+        return await message.answer(f"⚠️ Файл больше {RESTORE_MAX_MB} МБ")
 
-    # Скачиваем в память
-    file = await bot.get_file(doc.file_id)
-    buf = io.BytesIO()
-    await bot.download_file(file.file_path, buf)
-    buf.seek(0)
-
-    restored, errors = [], []
-
+    # Качаем потоком во временный файл, не держа весь архив в памяти
+    fd, tmp_path = tempfile.mkstemp(dir=TMP_DIR, suffix="_" + os.path.basename(file_name))
     try:
-        if file_name.endswith(".zip"):
-            with zipfile.ZipFile(buf) as zf:
-                for arcname, realpath in BACKUP_FILES.items():
-                    if arcname in zf.namelist():
-                        try:
-                            data = json.loads(zf.read(arcname).decode("utf-8"))
-                            if data is None:
-                                raise ValueError("invalid json")
-                            _write_json_atomic(realpath, data)
-                            restored.append(arcname)
-                        except Exception as e:
-                            errors.append(f"{arcname}: {e}")
-        elif file_name.endswith(".json"):
-            # одиночный JSON: определим по имени
-            target = None
-            for arcname, realpath in BACKUP_FILES.items():
-                if file_name == arcname:
-                    target = realpath
-                    break
-            if not target:
-                return await message.answer(
-                    "⚠️ Имя файла не распознано. Ожидаю <code>paid_users.json</code> или <code>kit_assets.json</code>.",
-                    parse_mode="HTML"
-                )
-            data = json.loads(buf.read().decode("utf-8"))
-            _write_json_atomic(target, data)
-            restored.append(file_name)
-        else:
-            return await message.answer("⚠️ Пришлите .zip или .json")
+        with os.fdopen(fd, "wb") as f:
+            file = await bot.get_file(doc.file_id)
+            await bot.download_file(file.file_path, _CappedWriter(f, RESTORE_MAX_MB * 1024 * 1024), seek=False)
+
+        items, meta = await run_io(_load_restore_file, tmp_path, file_name)
+        chain_error = _check_restore_chain(meta)
+        if chain_error:
+            return await message.answer("⚠️ " + chain_error)
+        await apply_restore_set(items)
+        restored, errors = [arcname for arcname, _, _ in items], []
     except zipfile.BadZipFile:
         return await message.answer("⚠️ Невалидный ZIP-архив")
     except json.JSONDecodeError:
         return await message.answer("⚠️ Невалидный JSON")
+    except ValueError as e:
+        return await message.answer(f"⚠️ Архив не применён: {e}")
     except Exception as e:
         logging.exception("Restore failed: %s", e)
-        return await message.answer(f"❌ Ошибка восстановления: {e}")
+        return await message.answer(f"❌ Ошибка восстановления (изменения откатены): {e}")
+    finally:
+        with suppress(OSError):
+            os.remove(tmp_path)
 
-    await state.clear()
     ok_list = "• " + "\n• ".join(restored) if restored else "—"
     err_list = "• " + "\n• ".join(errors) if errors else "—"
+    chain_note = ""
+    if file_name.endswith(".zip") and meta.get("chain_id") and restored and not errors:
+        # звено цепочки применено — ждём следующую дельту в том же режиме
+        _RESTORE_CURSOR.update(chain_id=meta["chain_id"], seq=meta.get("seq", 0), hash=meta.get("hash"))
+        chain_note = (f"🧩 Применено звено #{meta.get('seq', 0)} цепочки {str(meta['chain_id'])[:8]}. "
+                      "Пришлите следующую дельту или /cancel.\n\n")
+    else:
+        await state.clear()
     await message.answer(
         "✅ Восстановление завершено.\n\n"
         f"<b>Обновлены:</b>\n{ok_list}\n\n"
         f"<b>Ошибки:</b>\n{err_list}\n\n"
-        "ℹ️ Для надёжности перезапусти сервис на Render, если файлы критичны.",
+        + chain_note +
+        "♻️ Кэши перечитаны — перезапуск не нужен.",
         parse_mode="HTML"
     )
 
@@ -3389,17 +7219,7 @@ async def broadcast_do_send(callback: types.CallbackQuery, state: FSMContext):
         await state.clear()
         return
 
-    users = load_paid_users()
-    targets: List[int] = []
-    for uid, info in users.items():
-        if not isinstance(info, dict):
-            continue
-        if BROADCAST_VERIFIED_ONLY and not info.get("verified"):
-            continue
-        try:
-            targets.append(int(uid))
-        except Exception:
-            pass
+    targets: List[int] = await users_read(USERS.ids, verified_only=BROADCAST_VERIFIED_ONLY)
 
     total, ok, fail = len(targets), 0, 0
     await callback.message.edit_text(f"🚀 Рассылка запущена ({total} получателей)…")
@@ -3432,8 +7252,8 @@ async def _send_document_safely(
     Стратегия отправки (экономим трафик):
     0) file_id_override (kit_assets.json, /bind_*) — самый приоритетный
     1) file_id из .env
-    2) персональный кэш file_id (paid_users.json)
-    3) передать URL напрямую (Telegram сам скачает) → закэшировать file_id
+    2) общий кэш file_id по (cache_key, url) — заполнен первой отправкой по URL
+    3) передать URL напрямую (Telegram сам скачает) → закэшировать file_id для всех
     4) fallback: отправить ссылку текстом
     """
 
@@ -3453,17 +7273,15 @@ async def _send_document_safely(
         except Exception as e:
             logging.warning("ENV file_id failed (%s): %s", cache_key, e)
 
-    # 2) кэшированный file_id (персонально на пользователя)
-    users = load_paid_users()
-    rec = users.get(str(chat_id), {}) if isinstance(users, dict) else {}
-    cache = rec.get("cache", {})
-    file_id_cached = cache.get(cache_key)
+    # 2) общий кэш file_id (один на всех, ключ — материал + URL)
+    file_id_cached = get_cached_file_id(cache_key, url)
     if file_id_cached:
         try:
             msg = await bot.send_document(chat_id, file_id_cached, caption=caption, parse_mode="HTML")
             return msg
         except Exception as e:
             logging.warning("Cached file_id failed (%s): %s", cache_key, e)
+            await run_io(drop_cached_file_id, cache_key, url)
 
     # 3) отдаём URL напрямую — Telegram сам скачает (трафик Render ≈ 0) и кэшируем новый file_id
     if url:
@@ -3474,16 +7292,11 @@ async def _send_document_safely(
                 caption=caption,
                 parse_mode="HTML"
             )
-            # кэшируем новый file_id
+            # кэшируем новый file_id для всех следующих получателей
             try:
                 file_id_new = msg.document.file_id if (msg and getattr(msg, "document", None)) else None
                 if file_id_new:
-                    users = load_paid_users()
-                    rec = users.get(str(chat_id), {}) if isinstance(users, dict) else {}
-                    rec.setdefault("cache", {})
-                    rec["cache"][cache_key] = file_id_new
-                    users[str(chat_id)] = rec
-                    save_users(users)
+                    await run_io(set_cached_file_id, cache_key, url, file_id_new)
             except Exception as e:
                 logging.warning("Cache update after URL send failed (%s): %s", cache_key, e)
             return msg
@@ -3497,6 +7310,30 @@ async def _send_document_safely(
         await bot.send_message(chat_id, f"{caption}\n(файл временно недоступен)", parse_mode="HTML")
     return None
 
+async def _send_buffer_cached(chat_id: int, data: bytes, filename: str, caption: str, cache_key: str):
+    """
+    Отправка файла, собранного в памяти: по хэшу содержимого берём общий file_id,
+    загружаем байты только если такого содержимого ещё не отправляли.
+    """
+    source = content_source(data)
+    file_id_cached = get_cached_file_id(cache_key, source)
+    if file_id_cached:
+        try:
+            return await bot.send_document(chat_id, file_id_cached, caption=caption, parse_mode="HTML")
+        except Exception as e:
+            logging.warning("Cached file_id failed (%s): %s", cache_key, e)
+            await run_io(drop_cached_file_id, cache_key, source)
+    msg = await bot.send_document(
+        chat_id,
+        document=types.BufferedInputFile(data, filename=filename),
+        caption=caption,
+        parse_mode="HTML"
+    )
+    file_id_new = msg.document.file_id if (msg and getattr(msg, "document", None)) else None
+    if file_id_new:
+        await run_io(set_cached_file_id, cache_key, source, file_id_new)
+    return msg
+
 # убедись, что сверху файла есть: import os
 async def send_files_to_user(user_id: int, include_presentation: bool = False):
     """
@@ -3581,42 +7418,28 @@ async def send_files_to_user(user_id: int, include_presentation: bool = False):
                     tpl_url = (os.getenv("BOT_TEMPLATE_URL") or "").strip()
                     if tpl_url:
                         try:
-                            with urllib.request.urlopen(tpl_url, timeout=10) as resp:
-                                code_bytes = resp.read()
-                            await bot.send_document(
-                                user_id,
-                                document=aio_types.BufferedInputFile(code_bytes, filename="ai_business_bot_template.py"),
-                                caption="🤖 <b>AI Business Bot Template</b> — готовый код для запуска",
-                                parse_mode="HTML"
+                            def _fetch_tpl() -> bytes:
+                                with urllib.request.urlopen(tpl_url, timeout=10) as resp:
+                                    return resp.read()
+                            code_bytes = await run_io(_fetch_tpl)
+                            await _send_buffer_cached(
+                                user_id, code_bytes, "ai_business_bot_template.py",
+                                "🤖 <b>AI Business Bot Template</b> — готовый код для запуска",
+                                cache_key="bot_template_py_file_id",
                             )
                             bot_tpl_sent = True
                         except Exception as e_dl:
                             logging.warning("Download BOT_TEMPLATE_URL failed: %s", e_dl)
 
         # 4.5 если ни один из путей не сработал — сформируем код из функции-генератора
+        #     (4.6 file_id кэшируется по хэшу содержимого — повторно файл не загружается)
         if not bot_tpl_sent:
-            from aiogram import types as aio_types
-            bot_template_code = create_bot_template()  # твоя функция-генератор кода
-            msg = await bot.send_document(
-                user_id,
-                document=aio_types.BufferedInputFile(
-                    bot_template_code.encode("utf-8"),
-                    filename="ai_business_bot_template.py"
-                ),
-                caption="🤖 <b>AI Business Bot Template</b> — готовый код для запуска",
-                parse_mode="HTML"
+            bot_template_code = await create_bot_template_async()  # твоя функция-генератор кода
+            await _send_buffer_cached(
+                user_id, bot_template_code.encode("utf-8"), "ai_business_bot_template.py",
+                "🤖 <b>AI Business Bot Template</b> — готовый код для запуска",
+                cache_key="bot_template_py_file_id",
             )
-            # 4.6 кэшируем выданный file_id, чтобы в следующий раз не дергать сеть/генерацию
-            try:
-                if msg and msg.document and msg.document.file_id:
-                    users = load_paid_users()
-                    rec = users.get(str(user_id), {}) if isinstance(users, dict) else {}
-                    rec.setdefault("cache", {})
-                    rec["cache"]["bot_template_py_file_id"] = msg.document.file_id
-                    users[str(user_id)] = rec
-                    save_users(users)
-            except Exception:
-                pass
             bot_tpl_sent = True
 
     except Exception as e:
@@ -3631,14 +7454,10 @@ async def send_files_to_user(user_id: int, include_presentation: bool = False):
     # 5) README
     try:
         readme_text = create_readme()
-        await bot.send_document(
-            user_id,
-            document=types.BufferedInputFile(
-                readme_text.encode("utf-8"),
-                filename="README_AI_Business_Bot_Template.txt"
-            ),
-            caption="🧾 README (бот из шаблона)",
-            parse_mode="HTML"
+        await _send_buffer_cached(
+            user_id, readme_text.encode("utf-8"), "README_AI_Business_Bot_Template.txt",
+            "🧾 README (бот из шаблона)",
+            cache_key="readme_file_id",
         )
     except Exception as e:
         logging.warning("Send README failed for %s: %s", user_id, e)
@@ -3656,34 +7475,19 @@ async def send_files_to_user(user_id: int, include_presentation: bool = False):
             )
         else:
             env_text = create_env_template()
-            msg = await bot.send_document(
-                user_id,
-                document=types.BufferedInputFile(
-                    env_text.encode("utf-8"),
-                    filename=".env.example"
-                ),
-                caption="⚙️ <b>.env.example</b> — заполни и переименуй в <code>.env</code>",
-                parse_mode="HTML"
+            # file_id кэшируется по хэшу содержимого — следующим покупателям без загрузки
+            await _send_buffer_cached(
+                user_id, env_text.encode("utf-8"), ".env.example",
+                "⚙️ <b>.env.example</b> — заполни и переименуй в <code>.env</code>",
+                cache_key="env_template_file_id",
             )
-            # закэшируем file_id, чтобы в следующий раз не собирать заново
-            try:
-                if msg and msg.document and msg.document.file_id:
-                    users = load_paid_users()
-                    rec = users.get(str(user_id), {})
-                    rec.setdefault("cache", {})
-                    rec["env_template_file_id"] = msg.document.file_id
-                    users[str(user_id)] = rec
-                    save_users(users)
-            except Exception:
-                pass
     except Exception as e:
         logging.warning("Send .env.example failed for %s: %s", user_id, e)
 
     # 7) Уведомление админу
     try:
-        users = load_paid_users()
-        rec = users.get(str(user_id), {}) if isinstance(users, dict) else {}
-        uname = rec.get("username", "unknown")
+        rec = await users_read(USERS.record, user_id)
+        uname = rec.username if rec else "unknown"
         when = datetime.now().strftime("%H:%M %d.%m.%Y")
         await bot.send_message(
             ADMIN_ID,
@@ -3891,7 +7695,7 @@ async def send_welcome_files(message: types.Message):
 # ---------------------------
 # Обработка поддержки (текст) + вспомогательная функция
 # ---------------------------
-@dp.message(SupportStates.waiting_text)
+@dp.message(SupportStates.waiting_text, flags={"rate_limit": "support"})
 async def process_support_message(message: types.Message, state: FSMContext):
     """
     Любое входящее сообщение пользователя в режиме поддержки уходит админу
@@ -3902,7 +7706,7 @@ async def process_support_message(message: types.Message, state: FSMContext):
     uname = user.username or "без_username"
 
     # Сохраним пользователя в базе (если вдруг его нет)
-    save_pending_user(uid, uname)
+    await USERS_ACTOR.submit(save_pending_user, uid, uname)
 
     kb = kb_admin_quick_reply(uid)
 
@@ -3974,12 +7778,12 @@ async def process_support_message(message: types.Message, state: FSMContext):
     # Подтверждение пользователю
     await message.answer(
         "✅ Сообщение отправлено в поддержку. Обычно отвечаем в течение 5–15 минут.",
-        reply_markup=_menu_kb_for(uid),
+        reply_markup=await _menu_kb_for_async(uid),
         parse_mode="HTML"
     )
     await state.clear()
 
-@dp.message(SupportStates.waiting_text)
+@dp.message(SupportStates.waiting_text, flags={"rate_limit": "support"})
 async def support_waiting_text(message: types.Message, state: FSMContext):
     await process_support_message(message, state)
 
@@ -3992,11 +7796,11 @@ async def get_files_again_cb(callback: types.CallbackQuery):
     uid = callback.from_user.id
 
     # Проверка статуса пользователя
-    if not is_user_verified(uid):
+    if not await users_read(is_user_verified, uid):
         await callback.message.answer(
             "❌ Доступ ещё не активирован. "
             "Нажмите «Я оплатил(а)» и отправьте скрин подтверждения.",
-            reply_markup=_menu_kb_for(uid),
+            reply_markup=await _menu_kb_for_async(uid),
             parse_mode="HTML"
         )
         return
@@ -4039,7 +7843,7 @@ async def endchat_cmd(message: types.Message, state: FSMContext):
             await bot.send_message(
                 uid,
                 "✅ Диалог с администратором завершён.",
-                reply_markup=_menu_kb_for(uid),
+                reply_markup=await _menu_kb_for_async(uid),
                 parse_mode="HTML"
             )
 
@@ -4048,7 +7852,7 @@ async def endchat_cmd(message: types.Message, state: FSMContext):
     # админу — меню админа
     await message.answer(
         "⛔ Диалог закрыт.",
-        reply_markup=_menu_kb_for(ADMIN_ID),
+        reply_markup=await _menu_kb_for_async(ADMIN_ID),
         parse_mode="HTML"
     )
 
@@ -4080,7 +7884,7 @@ async def unknown_command(message: types.Message):
         # Для обычного пользователя — стандартный ответ и меню
         await message.answer(
             "🤖 Неизвестная команда. Нажмите /start или воспользуйтесь меню ниже.",
-            reply_markup=_menu_kb_for(uid),
+            reply_markup=await _menu_kb_for_async(uid),
             parse_mode="HTML"
         )
 
@@ -4097,10 +7901,20 @@ async def on_startup():
     except Exception:
         pass
 
-    if not os.path.exists(DATA_FILE):
-        save_users({})
+    if STORAGE_BACKEND == "json" and not os.path.exists(DATA_FILE):
+        USERS.replace({})
+        USERS.flush()
+    else:
+        await run_io(USERS.count)  # прогреваем хранилище один раз на старте
     if not os.path.exists(ASSETS_FILE):
         _save_assets({})
+    await run_io(reload_assets_cache)
+    await migrate_user_file_caches()
+    await AI_HTTP.start()
+    await run_io(_token_encoder, OPENAI_MODEL)  # словарь tiktoken грузим заранее, не на первом сообщении
+
+    await USERS_ACTOR.start()
+    await DEMO_QUOTAS.start()
 
     logging.info("📦 База: %s | Кэш: %s",
                  os.path.basename(DATA_FILE), os.path.basename(ASSETS_FILE))
@@ -4116,10 +7930,15 @@ async def on_startup():
     except Exception as e:
         logging.warning("[HEARTBEAT] start failed: %s", e)
 
+    try:
+        await start_backup_scheduler()
+    except Exception as e:
+        logging.warning("[BACKUP] scheduler start failed: %s", e)
+
     # --- Preview системных промптов в лог (безопасно) ---
     try:
-        logging.info("[PROMPT_USER] %s", _fmt_prompt(AI_SYSTEM_PROMPT_USER_RAW)[:160].replace("\n", " "))
-        logging.info("[PROMPT_ADMIN] %s", _fmt_prompt(AI_SYSTEM_PROMPT_ADMIN_RAW)[:160].replace("\n", " "))
+        logging.info("[PROMPT_USER] %s", PROMPTS.render("user")[:160].replace("\n", " "))
+        logging.info("[PROMPT_ADMIN] %s", PROMPTS.render("admin")[:160].replace("\n", " "))
     except Exception as e:
         logging.warning("Prompt preview skipped: %s", e)
 
@@ -4133,6 +7952,26 @@ async def on_shutdown():
     except Exception as e:
         logging.warning("[HEARTBEAT] stop failed: %s", e)
 
+    # Плановый бэкап, если он сейчас пишется, доделается в пуле — цикл просто снимаем
+    try:
+        await stop_backup_scheduler()
+    except Exception as e:
+        logging.warning("[BACKUP] scheduler stop failed: %s", e)
+
+    # Дожидаемся очереди записи, сбрасываем изменения на диск и закрываем хранилище
+    try:
+        await STORAGE_MIGRATION.abort()  # незавершённая миграция откатывается на прежнее хранилище
+        await DEMO_QUOTAS.stop()
+        if LIMITS_STORE is not None:
+            LIMITS_STORE.close()
+        await USERS_ACTOR.stop()
+        USERS.close()
+        await AI_HTTP.close()
+        await dp.fsm.storage.close()
+        _IO_POOL.shutdown(wait=True)
+    except Exception as e:
+        logging.warning("[USERS] final flush failed: %s", e)
+
     logging.info("✅ Завершение on_shutdown завершено.")
         
 # ================= MAIN (замена) =================
@@ -4165,6 +8004,8 @@ async def main():
             await bot.session.close()
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ["migrate-storage"]:
+        sys.exit(0 if migrate_storage_offline() else 1)
     try:
         asyncio.run(main())
     except KeyboardInterrupt:
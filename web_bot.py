@@ -10,7 +10,7 @@ from fastapi import FastAPI, Request, Response
 from aiogram.types import Update
 
 # --- Бот / диспетчер и регистрация хэндлеров — из основного файла ---
-from ai_business_kit_bot import bot, dp, register_handlers, on_startup, on_shutdown
+from ai_business_kit_bot import bot, dp, register_handlers, on_startup, on_shutdown, WEB_WORKERS
 
 # опционально импортнём ADMIN_ID, если есть (не обязательно)
 try:
@@ -22,6 +22,9 @@ except Exception:
 BASE_URL = (os.getenv("BASE_URL") or "").strip().rstrip("/")
 WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "ul_kit_123secret")
 PORT = int(os.getenv("PORT", "10000"))
+# Число uvicorn-воркеров (WEB_WORKERS) берём из ai_business_kit_bot: там оно уже приведено
+# к 1 для journal/sharded. json (с файловыми блокировками) и sqlite безопасны для нескольких
+# процессов на одном DATA_DIR; демо-квоты и лимиты частоты тогда живут в общем SQLite.
 
 # Как часто проверяем вебхук и шлём heartbeat-лог (сек)
 HEARTBEAT_INTERVAL_SEC = int(os.getenv("HEARTBEAT_INTERVAL_SEC", "30"))  # минимум 30
@@ -156,7 +159,22 @@ async def lifespan(app: FastAPI):
 
     # 2) Ставим вебхук (если BASE_URL задан)
     try:
-        if BASE_URL:
+        if BASE_URL and WEB_WORKERS > 1:
+            # Воркеры стартуют одновременно: не сносим вебхук и не сбрасываем очередь апдейтов,
+            # только ставим, если он ещё не наш
+            info = await bot.get_webhook_info()
+            if (info.url or "").rstrip("/") != WEBHOOK_URL:
+                await bot.set_webhook(
+                    url=WEBHOOK_URL,
+                    secret_token=WEBHOOK_SECRET,
+                    drop_pending_updates=False,
+                    allowed_updates=["message", "callback_query"],
+                )
+                logger.info("[WEBHOOK] set to %s (pid=%s)", WEBHOOK_URL, os.getpid())
+
+            # Сторож вебхука
+            asyncio.create_task(webhook_watchdog())
+        elif BASE_URL:
             # Сносим старый, ставим новый с секретом
             await bot.delete_webhook(drop_pending_updates=True)
             await bot.set_webhook(
@@ -320,6 +338,8 @@ async def ping_head():
 
 if __name__ == "__main__":
     import uvicorn
-    logger.info("Starting webhook app on 0.0.0.0:%s", PORT)
-    # workers=1 и небольшой keep-alive — стабильнее на бесплатных/малых инстансах
-    uvicorn.run("web_bot:app", host="0.0.0.0", port=PORT, workers=1, timeout_keep_alive=5)
+    # воркеры импортируют модули заново — пусть видят то же эффективное значение
+    os.environ["WEB_WORKERS"] = str(WEB_WORKERS)
+    logger.info("Starting webhook app on 0.0.0.0:%s (workers=%s)", PORT, WEB_WORKERS)
+    # по умолчанию workers=1 и небольшой keep-alive — стабильнее на бесплатных/малых инстансах
+    uvicorn.run("web_bot:app", host="0.0.0.0", port=PORT, workers=WEB_WORKERS, timeout_keep_alive=5)